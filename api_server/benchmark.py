@@ -0,0 +1,211 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Author: Dylan Curley
+
+"""This module benchmarks the API query path against an in-memory backend.
+
+Each scenario issues a set of random queries through the query engine twice:
+first cold, with new (empty) metric and locale managers, then warm, repeating
+the same queries.  Throughput, latency percentiles, backend calls, and peak
+memory are reported for each pass, eg:
+
+    cd api_server && python benchmark.py --requests=1000 --latency=0.01
+"""
+
+import argparse
+import random
+import resource
+import time
+
+from common import locales
+from common import memory_backend
+from common import metrics
+import query_engine
+
+SCENARIOS = ('single', 'range', 'rank', 'locale', 'nearest')
+
+# Number of most recent months queried.
+QUERY_MONTHS = 24
+
+# Number of months in each range query.
+RANGE_MONTHS = 12
+
+
+class _Managers(object):
+    """A new set of managers, with empty caches.
+    """
+    def __init__(self, backend):
+        self.metrics = metrics.MetricsManager(backend)
+        self.locales = locales.LocalesManager(
+            backend, locale_index=self.metrics.locale_index)
+        self.finder = locales.LocaleFinder(backend)
+
+
+def MakeQueries(scenario, backend, count, rand):
+    """Generates random queries for a scenario.
+
+    Args:
+        scenario (string): One of 'SCENARIOS'.
+        backend (MemoryBackend object): Backend the queries will be issued to.
+        count (int): Number of queries.
+        rand (Random object): Source of randomness.
+
+    Returns:
+        (list) Queries, each a function taking a _Managers and issuing the
+        query through the query engine.
+    """
+    metric_names = sorted(backend.GetMetricInfo())
+    countries = [row[1] for row in backend.GetLocaleData('country')['data']]
+    locale_names = ['world']
+    for locale_type in ('country', 'region', 'city'):
+        locale_names.extend(row[1] for row in
+                            backend.GetLocaleData(locale_type)['data'])
+    dates = [(d.year, d.month) for d in backend.ExistingDates()]
+    dates = dates[-QUERY_MONTHS:]
+
+    queries = []
+    for _ in xrange(count):
+        metric = rand.choice(metric_names)
+        locale = rand.choice(locale_names)
+        year, month = rand.choice(dates)
+        if scenario == 'single':
+            queries.append(
+                lambda m, metric=metric, locale=locale, year=year, month=month:
+                query_engine.HandleMetricQuery(m.metrics, metric, locale,
+                                               year, month))
+        elif scenario == 'range':
+            start = dates[rand.randrange(len(dates) - RANGE_MONTHS + 1)]
+            end = dates[dates.index(start) + RANGE_MONTHS - 1]
+            queries.append(
+                lambda m, metric=metric, locale=locale, start=start, end=end:
+                query_engine.HandleMetricSeriesQuery(
+                    m.metrics, metric, locale, start[0], start[1], end[0],
+                    end[1]))
+        elif scenario == 'rank':
+            parent = rand.choice(countries)
+            queries.append(
+                lambda m, metric=metric, year=year, month=month, parent=parent:
+                query_engine.HandleRankQuery(m.metrics, metric, year, month,
+                                             'city', parent, 20, 'desc'))
+        elif scenario == 'locale':
+            queries.append(
+                lambda m, locale=locale:
+                query_engine.HandleLocaleQuery(m.locales, locale))
+        elif scenario == 'nearest':
+            lat = rand.uniform(-60, 70)
+            lon = rand.uniform(-180, 180)
+            queries.append(
+                lambda m, lat=lat, lon=lon:
+                query_engine.HandleNearestNeighborQuery(m.finder, lat, lon))
+        else:
+            raise ValueError('Unknown scenario: %s' % scenario)
+    return queries
+
+
+def RunQueries(queries, managers, backend):
+    """Issues queries one at a time, timing each.
+
+    Returns:
+        (dict) Results of the run.  Specifically,
+        { 'requests': (int) <number of queries>,
+          'errors': (int) <number of queries that raised an error>,
+          'error': (string) <first error, or None>,
+          'qps': (float) <queries per second>,
+          'p50': (float) <median latency, in milliseconds>,
+          'p99': (float) <99th percentile latency, in milliseconds>,
+          'backend_calls': (int) <number of backend calls>,
+          'max_rss': (int) <peak memory use of the process, in KB> }
+    """
+    latencies = []
+    errors = 0
+    first_error = None
+    calls = backend.calls
+
+    start_time = time.time()
+    for query in queries:
+        query_start = time.time()
+        try:
+            query(managers)
+        except query_engine.LookupError:
+            pass  # Missing data is an expected response.
+        except Exception as e:
+            errors += 1
+            if first_error is None:
+                first_error = '%s: %s' % (type(e).__name__, e)
+        latencies.append(time.time() - query_start)
+    elapsed = time.time() - start_time
+
+    latencies.sort()
+    return {'requests': len(queries),
+            'errors': errors,
+            'error': first_error,
+            'qps': len(queries) / elapsed if elapsed else float('inf'),
+            'p50': 1000 * latencies[len(latencies) // 2],
+            'p99': 1000 * latencies[min(len(latencies) - 1,
+                                        len(latencies) * 99 // 100)],
+            'backend_calls': backend.calls - calls,
+            'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def main():
+    """Runs the benchmark and prints the results.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='queries per scenario')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='simulated backend latency, in seconds')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='fraction of the default data cardinalities')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma-separated scenarios to run')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the data and queries')
+    args = parser.parse_args()
+
+    def Scaled(n):
+        return max(1, int(n * args.scale))
+
+    setup_start = time.time()
+    backend = memory_backend.MemoryBackend(
+        countries=Scaled(memory_backend.DEFAULT_COUNTRIES),
+        regions=Scaled(memory_backend.DEFAULT_REGIONS),
+        cities=Scaled(memory_backend.DEFAULT_CITIES),
+        months=memory_backend.DEFAULT_MONTHS,
+        metrics=memory_backend.DEFAULT_METRICS,
+        seed=args.seed)
+    print 'Generated data in %.2fs.' % (time.time() - setup_start)
+    rand = random.Random(args.seed)
+
+    print '%-8s %-5s %8s %6s %10s %10s %10s %9s %10s' % (
+        'scenario', 'pass', 'requests', 'errors', 'qps', 'p50 (ms)',
+        'p99 (ms)', 'backend', 'rss (KB)')
+    for scenario in args.scenarios.split(','):
+        queries = MakeQueries(scenario, backend, args.requests, rand)
+        backend.latency = args.latency
+        managers = _Managers(backend)
+        for pass_name in ('cold', 'warm'):
+            result = RunQueries(queries, managers, backend)
+            print '%-8s %-5s %8d %6d %10.1f %10.3f %10.3f %9d %10d' % (
+                scenario, pass_name, result['requests'], result['errors'],
+                result['qps'], result['p50'], result['p99'],
+                result['backend_calls'], result['max_rss'])
+            if result['error'] is not None:
+                print '    first error: %s' % result['error']
+        backend.latency = 0.0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Author: Dylan Curley
+
+"""This module benchmarks common.kd_tree against the bundled deps.kdtree.
+
+Both trees are built over the same random locations and searched for the
+same random points, and their answers are checked against each other, eg:
+
+    cd api_server && python kd_tree_benchmark.py --points=100000
+"""
+
+import argparse
+import math
+import random
+import time
+
+from common import kd_tree
+from deps import kdtree
+
+
+def RandomPoints(count, rand):
+    """Generates random points on a sphere, as GeoTree places locales.
+
+    Returns:
+        (list) Points, each a 3-tuple of int cartesian coordinates.
+    """
+    r = (2 ** 31) - 1
+    points = []
+    for _ in xrange(count):
+        lat = math.radians(rand.uniform(-90, 90))
+        lon = math.radians(rand.uniform(-180, 180))
+        points.append((int(r * math.cos(lat) * math.cos(lon)),
+                       int(r * math.cos(lat) * math.sin(lon)),
+                       int(r * math.sin(lat))))
+    return points
+
+
+def main():
+    """Runs the benchmark and prints the results.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--points', type=int, default=100000,
+                        help='points in each tree')
+    parser.add_argument('--queries', type=int, default=10000,
+                        help='nearest neighbor searches')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the points and queries')
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    objects = [(point, i) for (i, point) in
+               enumerate(RandomPoints(args.points, rand))]
+    queries = RandomPoints(args.queries, rand)
+
+    start_time = time.time()
+    old_tree = kdtree.KDTree(3, objects)
+    old_build = time.time() - start_time
+
+    start_time = time.time()
+    new_tree = kd_tree.KDTree(3, objects)
+    new_build = time.time() - start_time
+
+    start_time = time.time()
+    old_results = [old_tree.nearest_neighbor(q) for q in queries]
+    old_query = time.time() - start_time
+
+    start_time = time.time()
+    new_results = new_tree.NearestNeighborOfEach(queries)
+    new_query = time.time() - start_time
+
+    # Labels may differ between equidistant points, but distances may not.
+    mismatches = sum(1 for (q, old, new) in
+                     zip(queries, old_results, new_results)
+                     if kdtree.square_distance(old[0], q) !=
+                     kdtree.square_distance(map(int, new[0]), q))
+
+    print '%d points, %d queries' % (args.points, args.queries)
+    print '%-14s %10s %10s %8s' % ('', 'deps.kdtree', 'kd_tree', 'speedup')
+    print '%-14s %10.3f %10.3f %7.1fx' % ('build (s)', old_build, new_build,
+                                          old_build / new_build)
+    print '%-14s %10.1f %10.1f %7.1fx' % (
+        'query (us)', 1e6 * old_query / args.queries,
+        1e6 * new_query / args.queries, old_query / new_query)
+    print 'mismatched distances: %d' % mismatches
+
+
+if __name__ == '__main__':
+    main()
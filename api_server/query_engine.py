@@ -18,15 +18,49 @@
 
 Specifically, there are functions to manage a request for more detail on a
 locale (HandleLocaleQuery), on a metric for some specific region and date
-(HandleMetricQuery), or on the nearest defined locales to a set of latitude
-and longitude coordinates (HandleNearestNeighborQuery).
+(HandleMetricQuery), for a range of dates (HandleMultiMetricQuery and
+HandleMetricSeriesQuery) or for all of a region's children
+(HandleChildrenMetricQuery), on many metrics, regions, and dates at once
+(HandleBatchQuery), for the locales ranked highest by a metric
+(HandleRankQuery), for a bulk export of a metric (HandleExportQuery), or on
+the nearest defined locales to a set of latitude and longitude coordinates
+(HandleNearestNeighborQuery), which can also list the k nearest or those
+within a radius, or to many such sets at once
+(HandleNearestNeighborBatchQuery).
 """
 
+import csv
+import json
 import logging
+import math
+import StringIO
 
+from common import locales
 from common import metrics
+from common import parallel
 from datetime import date
 
+# Maximum number of queries accepted in a single batch request.
+MAX_BATCH_QUERIES = 1000
+
+# Maximum number of concurrent backend loads issued for a single request.
+MAX_CONCURRENT_LOADS = 4
+
+# Maximum number of coordinates accepted in a single nearest-neighbor batch.
+MAX_NEAREST_BATCH_COORDINATES = 10000
+
+# Maximum number of locales listed in a single k-nearest or radius search.
+MAX_NEAREST_RESULTS = 1000
+
+# Maximum number of locales listed in a single ranking.
+MAX_RANK_RESULTS = 1000
+
+# Number of rows formatted into each chunk of a streamed export.
+EXPORT_ROWS_PER_CHUNK = 500
+
+# Supported export formats.
+EXPORT_FORMATS = ('csv', 'ndjson')
+
 class Error(Exception):
     """Common exception that all other exceptions in this module inherit from.
     """
@@ -90,9 +124,7 @@ def HandleMetricQuery(metrics_manager, metric, locale, year, month):
         (dict) Data about the requested metric at the given year & month for
         the given locale.
     """
-    # Anticipate non-standard locale= requests for world data.
-    if locale in ('', '""', "''", 'world', 'global'):
-        locale = 'world'
+    locale = NormalizeLocale(locale)
 
     # Validate query parameters.
     if metric is None:
@@ -110,15 +142,80 @@ def HandleMetricQuery(metrics_manager, metric, locale, year, month):
 
     # Lookup & return the data.
     try:
-        logging.debug('getting ' + metric + ' for ' + str(year) + '-' +
-                      str(month))
+        logging.debug('getting %s for %d-%d', metric, year, month)
         data = metrics_manager.LookupResult(metric, year, month, locale)
-    except metrics.Error as e:
+    except (metrics.Error, KeyError) as e:
         raise LookupError(e)
 
     return data
 
 
+def HandleChildrenMetricQuery(metrics_manager, locales_manager, metric, locale,
+                              year, month):
+    """Verifies passed arguments and issues a lookup of metric data for all of
+    a locale's children.
+
+    Args:
+        metrics_manager (MetricsManager object): Metrics manager.
+        locales_manager (LocalesManager object): Locale manager.
+        metric (string): Name of the metric to be queried.
+        locale (string): Locale whose children are of interest.
+        year (int): Year of interest.
+        month (int): Month of interest.
+
+    Raises:
+        LookupError: If an error occurred during lookup, e.g. the requested
+        locale is unkown.
+        SyntaxError: If expected parameters are not provided (are None).
+
+    Returns:
+        (dict) Data about the requested metric at the given year & month for
+        each child of the given locale.  Specifically,
+        { 'metric': (string) <metric name>,
+          'units': (string) <metric units>,
+          'locale': (string) <locale>,
+          'children': (dict) <metric value, or None if there's no data, keyed
+                              by child locale> }
+    """
+    locale = NormalizeLocale(locale)
+
+    # Validate query parameters.
+    if metric is None:
+        raise SyntaxError('Must provide a parameter "name" identifying the'
+                          ' metric you wish to query.')
+
+    if year is None or month is None:
+        raise SyntaxError('Must provide parameters "year" and "month"'
+                          ' identifying the date you wish to query.')
+
+    if locale is None:
+        raise SyntaxError('Must provide a parameter "locale" identifying the'
+                          ' locale whose children you wish to query.  For'
+                          ' example, "", "100", or "100_az".')
+
+    # Lookup & return the data.
+    try:
+        if locale == 'world':  # Countries aren't linked to the world locale.
+            children = locales_manager.LocalesByType('country')
+        else:
+            children = locales_manager.Locale(locale).children
+    except KeyError as e:
+        raise LookupError(e)
+
+    try:
+        logging.debug('getting %s for %d-%d, children of %s',
+                      metric, year, month, locale)
+        units = metrics_manager.Metric(metric).units
+        values = metrics_manager.LookupMany(metric, year, month, children)
+    except (metrics.Error, KeyError) as e:
+        raise LookupError(e)
+
+    return {'metric': metric,
+            'units': units,
+            'locale': locale,
+            'children': values}
+
+
 def HandleMultiMetricQuery(metrics_manager, metric, locale,
                            startyear, startmonth, endyear, endmonth):
     """Verifies passed arguments and issues a lookup of metric data.
@@ -141,9 +238,550 @@ def HandleMultiMetricQuery(metrics_manager, metric, locale,
         (dict) Data about the requested metric for all years and months between
         startyear-startmonth and endyear-endmonth inclusive.
     """
-    # Anticipate non-standard locale= requests for world data.
-    if locale in ('', '""', "''", 'world', 'global'):
-        locale = 'world'
+    locale, start, end = _ValidateRangeQuery(
+        metric, locale, startyear, startmonth, endyear, endmonth)
+
+    logging.debug('getting %s from %d-%d to %d-%d', metric, start[0], start[1],
+                  end[0], end[1])
+    try:
+        values = metrics_manager.LookupRange(
+            metric, start, end, locale, max_threads=MAX_CONCURRENT_LOADS)
+        units = metrics_manager.Metric(metric).units
+    except (metrics.Error, KeyError) as e:
+        raise LookupError(e)
+
+    results = {}
+    for ((year, month), value) in values:
+        if value is None:
+            raise LookupError('No data for metric=%s, year=%d, month=%d,'
+                              ' locale=%s.' % (metric, year, month, locale))
+        results['%d-%d' % (year, month)] = {'metric': metric,
+                                            'units': units,
+                                            'value': value}
+
+    return results
+
+
+def HandleMetricSeriesQuery(metrics_manager, metric, locale,
+                            startyear, startmonth, endyear, endmonth):
+    """Verifies passed arguments and issues a lookup of a metric time series.
+
+    Like HandleMultiMetricQuery(), but the result is columnar: the metric name
+    and units are given once, followed by one value per month in order.
+    Months without data have a value of None rather than failing the query.
+
+    Args:
+        metrics_manager (MetricsManager object): Metrics manager.
+        metric (string): Name of the metric to be queried.
+        locale (string): Locale of interest.
+        startyear (int): Start year of interest.
+        startmonth (int): Start month of interest.
+        endyear (int): End year of interest.
+        endmonth (int): End month of interest.
+
+    Raises:
+        LookupError: If an error occurred during lookup, eg, the requested
+        metric is unknown.
+        SyntaxError: If expected parameters are not provided (are None).
+
+    Returns:
+        (dict) The requested metric for all months between
+        startyear-startmonth and endyear-endmonth inclusive.  Specifically,
+        { 'metric': (string) <metric name>,
+          'units': (string) <metric units>,
+          'start': (string) <first month, eg "2012-1">,
+          'values': (list) <(float) metric value, or None, for each month> }
+    """
+    locale, start, end = _ValidateRangeQuery(
+        metric, locale, startyear, startmonth, endyear, endmonth)
+
+    logging.debug('getting %s series from %d-%d to %d-%d', metric, start[0],
+                  start[1], end[0], end[1])
+    try:
+        values = metrics_manager.LookupRange(
+            metric, start, end, locale, max_threads=MAX_CONCURRENT_LOADS)
+        units = metrics_manager.Metric(metric).units
+    except (metrics.Error, KeyError) as e:
+        raise LookupError(e)
+
+    return {'metric': metric,
+            'units': units,
+            'start': '%d-%d' % start,
+            'values': [value for (_, value) in values]}
+
+
+def HandleBatchQuery(metrics_manager, queries):
+    """Verifies passed arguments and issues lookups for a batch of metric data.
+
+    Queries are grouped by metric and date so that each locale scope missing
+    from the metric cache costs exactly one backend load, however many queries
+    share it.  Up to 'MAX_CONCURRENT_LOADS' groups are loaded at once.
+    Errors are reported per query; one bad query doesn't fail the whole batch.
+
+    Args:
+        metrics_manager (MetricsManager object): Metrics manager.
+        queries (list): Queries to be looked up, each a dict with the keys
+            "metric", "locale", "year", and "month".
+
+    Raises:
+        SyntaxError: If 'queries' isn't a list of at most MAX_BATCH_QUERIES
+        dicts.
+
+    Returns:
+        (dict) The results of each query, in order.  Specifically,
+        { 'results': [ { 'metric': (string) <metric name>,
+                         'locale': (string) <locale>,
+                         'year': (int) <year>,
+                         'month': (int) <month>,
+                         'units': (string) <metric units>,
+                         'value': (float) <metric value> }, ... ] }
+        where a query that failed has an 'error' message instead of 'units'
+        and 'value'.
+    """
+    if (not isinstance(queries, list) or
+        not all(isinstance(q, dict) for q in queries)):
+        raise SyntaxError('Must provide a list of queries, each with "metric",'
+                          ' "locale", "year", and "month".')
+    if len(queries) > MAX_BATCH_QUERIES:
+        raise SyntaxError('Too many queries in one batch (%d).  At most %d are'
+                          ' allowed.' % (len(queries), MAX_BATCH_QUERIES))
+
+    # Validate queries, and group the valid ones by metric and date.
+    results = []
+    groups = {}
+    for query in queries:
+        result = {'metric': query.get('metric'),
+                  'locale': NormalizeLocale(query.get('locale')),
+                  'year': query.get('year'),
+                  'month': query.get('month')}
+        results.append(result)
+
+        if None in result.values():
+            result['error'] = ('Must provide "metric", "locale", "year", and'
+                               ' "month" for each query.')
+            continue
+        if (not isinstance(result['metric'], basestring) or
+            not isinstance(result['locale'], basestring)):
+            result['error'] = '"metric" and "locale" must be strings.'
+            continue
+        try:
+            result['year'] = int(result['year'])
+            result['month'] = int(result['month'])
+        except (TypeError, ValueError) as e:
+            result['error'] = '%s' % e
+            continue
+        try:
+            metrics.DetermineLocaleType(result['locale'])
+        except KeyError:
+            result['error'] = 'Malformed locale: %s' % result['locale']
+            continue
+
+        group = (result['metric'], result['year'], result['month'])
+        groups.setdefault(group, []).append(result)
+
+    # Lookup each group's data, loading uncached groups concurrently.
+    def LookupGroup(group):
+        (metric, year, month), group_results = group
+        logging.debug('getting %s for %d-%d, %d locales',
+                      metric, year, month, len(group_results))
+        try:
+            units = metrics_manager.Metric(metric).units
+            values = metrics_manager.LookupMany(
+                metric, year, month, [r['locale'] for r in group_results])
+        except metrics.Error as e:
+            for result in group_results:
+                result['error'] = '%s' % e
+            return
+
+        for result in group_results:
+            if values[result['locale']] is None:
+                result['error'] = ('No data for metric=%s, year=%d, month=%d,'
+                                   ' locale=%s.' % (metric, year, month,
+                                                    result['locale']))
+            else:
+                result['units'] = units
+                result['value'] = values[result['locale']]
+
+    parallel.Map(LookupGroup, groups.items(), MAX_CONCURRENT_LOADS)
+    return {'results': results}
+
+
+def HandleRankQuery(metrics_manager, metric, year, month, locale_type, parent,
+                    n, order, locale=None):
+    """Verifies passed arguments and issues a ranking of locales by a metric.
+
+    Args:
+        metrics_manager (MetricsManager object): Metrics manager.
+        metric (string): Name of the metric to rank by.
+        year (int): Year of interest.
+        month (int): Month of interest.
+        locale_type (string): Type of locales to rank, eg "city".
+        parent (string): If not None, only locales within this locale are
+            ranked, eg "840" for the cities of a country.
+        n (int): Number of top ranked locales to list.
+        order (string): "desc" to rank larger values higher, or "asc" to rank
+            smaller values higher.
+        locale (string): If not None, a ranked locale whose rank and
+            percentile are also given.
+
+    Raises:
+        LookupError: If an error occurred during lookup, eg, the requested
+        metric is unknown.
+        SyntaxError: If expected parameters are not provided (are None) or are
+        invalid.
+
+    Returns:
+        (dict) The top ranked locales.  Specifically,
+        { 'metric': (string) <metric name>,
+          'units': (string) <metric units>,
+          'locale_type': (string) <type of ranked locales>,
+          'parent': (string) <parent locale, or None>,
+          'order': (string) <"desc" or "asc">,
+          'count': (int) <number of ranked locales>,
+          'ranking': [ { 'rank': (int) <rank, shared by equal values>,
+                         'locale': (string) <locale>,
+                         'value': (float) <metric value> }, ... ] }
+        and, if 'locale' was given,
+        { 'locale': { 'rank': (int) <rank>,
+                      'locale': (string) <locale>,
+                      'value': (float) <metric value>,
+                      'percentile': (float) <percentage of ranked locales
+                                             with a smaller value> } }
+    """
+    # Validate query parameters.
+    if metric is None:
+        raise SyntaxError('Must provide a parameter "name" identifying the'
+                          ' metric you wish to rank by.')
+
+    if year is None or month is None:
+        raise SyntaxError('Must provide parameters "year" and "month"'
+                          ' identifying the date you wish to query.')
+
+    if locale_type is None:
+        raise SyntaxError('Must provide a parameter "locale_type", eg "city",'
+                          ' identifying the type of locales you wish to rank.')
+
+    if order not in ('desc', 'asc'):
+        raise SyntaxError('Unsupported order "%s".  Must be "desc" or "asc".'
+                          % order)
+
+    if not 1 <= n <= MAX_RANK_RESULTS:
+        raise SyntaxError('"n" must be from 1 to %d.' % MAX_RANK_RESULTS)
+
+    if parent is not None:
+        parent = NormalizeLocale(parent)
+    descending = (order == 'desc')
+
+    # Lookup & return the data.
+    try:
+        logging.debug('ranking %s %s locales by %s for %d-%d',
+                      parent, locale_type, metric, year, month)
+        ranking = metrics_manager.Rank(metric, year, month, locale_type,
+                                       parent)
+        units = metrics_manager.Metric(metric).units
+    except (metrics.Error, KeyError) as e:
+        raise LookupError(e)
+
+    result = {'metric': metric,
+              'units': units,
+              'locale_type': locale_type,
+              'parent': parent,
+              'order': order,
+              'count': len(ranking),
+              'ranking': [{'rank': ranking.Position(value, descending),
+                           'locale': ranked_locale,
+                           'value': value}
+                          for (ranked_locale, value) in
+                          ranking.Top(n, descending)]}
+
+    if locale is not None:
+        locale = NormalizeLocale(locale)
+        try:
+            ranked = (metrics.DetermineLocaleType(locale) == locale_type and
+                      (parent in (None, 'world') or
+                       locale.startswith('%s_' % parent)))
+        except KeyError:  # Malformed locale.
+            ranked = False
+        if not ranked:
+            raise LookupError('%s is not among the ranked locales.' % locale)
+        try:
+            value = metrics_manager.LookupMany(metric, year, month,
+                                               [locale])[locale]
+        except (metrics.Error, KeyError) as e:
+            raise LookupError(e)
+        if value is None:
+            raise LookupError('No data for metric=%s, year=%d, month=%d,'
+                              ' locale=%s.' % (metric, year, month, locale))
+        result['locale'] = {'rank': ranking.Position(value, descending),
+                            'locale': locale,
+                            'value': value,
+                            'percentile': ranking.Percentile(value)}
+
+    return result
+
+
+def HandleExportQuery(metrics_manager, metric, start, end, locale_type,
+                      output_format):
+    """Verifies passed arguments and issues a bulk export of metric data.
+
+    The data is streamed from the backend and formatted as it arrives, so the
+    full export is never held in memory.
+
+    Args:
+        metrics_manager (MetricsManager object): Metrics manager.
+        metric (string): Name of the metric to be exported.
+        start (tuple): First month to export, as ints (year, month).
+        end (tuple): Last month to export, as ints (year, month).
+        locale_type (string): Type of locales to export ('world', 'country',
+            'region', or 'city'), or None for all locales.
+        output_format (string): 'csv' or 'ndjson'.
+
+    Raises:
+        LookupError: If an error occurred during lookup, eg, the requested
+        metric is unknown.
+        SyntaxError: If expected parameters are not provided (are None) or are
+        invalid.
+
+    Returns:
+        (generator) Chunks of the formatted export, as strings.  CSV exports
+        have the columns "date", "locale", and "value".  NDJSON exports have
+        one object per line with those keys.  An export that fails part way
+        ends with an error record instead (see _FormatExport()).
+    """
+    if metric is None:
+        raise SyntaxError('Must provide a parameter "name" identifying the'
+                          ' metric you wish to export.')
+    if start is None or end is None:
+        raise SyntaxError('Must provide parameters "start" and "end", eg'
+                          ' "2012-01", identifying the months you wish to'
+                          ' export.')
+    _ValidateMonth(start[1], 'start')
+    _ValidateMonth(end[1], 'end')
+    if end < start:
+        raise SyntaxError('"end" must be after "start".')
+    if locale_type not in (None, 'world', 'country', 'region', 'city'):
+        raise SyntaxError('Unknown locale type "%s".  Must be one of "world",'
+                          ' "country", "region", or "city".' % locale_type)
+    if output_format not in EXPORT_FORMATS:
+        raise SyntaxError('Unsupported format "%s".  Must be one of %s.'
+                          % (output_format, ', '.join(EXPORT_FORMATS)))
+
+    try:
+        rows = metrics_manager.ExportData(metric, start, end, locale_type)
+    except metrics.Error as e:
+        raise LookupError(e)
+
+    return _FormatExport(metric, rows, output_format)
+
+
+def HandleNearestNeighborQuery(locale_finder, lat, lon, k=None,
+                               radius_km=None, types=None):
+    """Verifies passed arguments and issues a nearest neighbor lookup.
+
+    If neither 'k' nor 'radius_km' is given, the single nearest city, region,
+    and country are looked up.  Otherwise the 'k' nearest locales of each
+    type, or those within 'radius_km', or the 'k' nearest within 'radius_km',
+    are listed with their distances.  At most MAX_NEAREST_RESULTS locales of
+    each type are listed, nearest first.
+
+    Args:
+        locale_finder (LocaleFinder object): Locale finder.
+        lat (float): Latitude of interest.
+        lon (float): Longitude of interest.
+        k (int): If not None, number of nearest locales of each type to list.
+        radius_km (float): If not None, only locales within this great-circle
+            distance, in kilometers, are listed.
+        types (list): If not None, the locale types to look up, each one of
+            "country", "region", or "city".  Otherwise all three.
+
+    Raises:
+        LookupError: If an error occurred during lookup, eg, the locale data
+        couldn't be loaded.
+        SyntaxError: If expected parameters are not provided (are None), or
+        'lat', 'lon', 'k', 'radius_km', or 'types' is out of range.
+
+    Returns:
+        (dict) The nearest city, region, and country to the provided latitude
+        and longitude coordinates, for the requested types.  Or, if 'k' or
+        'radius_km' was given, a list of the nearest locales for each
+        requested type, eg,
+        { 'city': (list) <nearest cities, each as
+                          { 'locale': (string) <city ID>,
+                            'distance_km': (float) <great-circle distance> }> }
+    """
+    if lat is None or lon is None:
+        raise SyntaxError('Must provide parameters "lat" and "lon" identifying'
+                          ' the latitude and logitude of interest.')
+    _ValidateCoordinates(lat, lon)
+    types = _ValidateNearestTypes(types)
+
+    if k is None and radius_km is None:
+        try:
+            return locale_finder.FindNearestNeighbors(lat, lon, types)
+        except locales.Error as e:
+            raise LookupError(e)
+
+    if k is None:
+        k = MAX_NEAREST_RESULTS
+    elif not 1 <= k <= MAX_NEAREST_RESULTS:
+        raise SyntaxError('"k" must be from 1 to %d.' % MAX_NEAREST_RESULTS)
+    if radius_km is not None and not radius_km >= 0:
+        raise SyntaxError('"radius_km" must not be negative.')
+
+    result = {}
+    for locale_type in types:
+        try:
+            nearest = locale_finder.FindNearestLocales(lat, lon, locale_type,
+                                                       k, radius_km)
+        except locales.Error as e:
+            raise LookupError(e)
+        result[locale_type] = [{'locale': locale,
+                                'distance_km': round(distance, 3)}
+                               for (locale, distance) in nearest]
+    return result
+
+
+def HandleNearestNeighborBatchQuery(locale_finder, coordinates, types=None):
+    """Verifies passed arguments and issues nearest neighbor lookups for a
+    batch of coordinates.
+
+    Coordinates are verified as for HandleNearestNeighborQuery(), but errors
+    are reported per coordinate; one bad coordinate doesn't fail the whole
+    batch.
+
+    Args:
+        locale_finder (LocaleFinder object): Locale finder.
+        coordinates (list): Coordinates of interest, each a list [latitude,
+            longitude].
+        types (list): If not None, the locale types to look up, each one of
+            "country", "region", or "city".  Otherwise all three.
+
+    Raises:
+        LookupError: If an error occurred during lookup, eg, the locale data
+        couldn't be loaded.
+        SyntaxError: If 'coordinates' isn't a list of at most
+        MAX_NEAREST_BATCH_COORDINATES pairs, or 'types' is out of range.
+
+    Returns:
+        (dict) The nearest city, region, and country to each of the provided
+        coordinates, for the requested types.  Specifically,
+        { 'country': (list) <nearest country ID for each coordinate>,
+          'region': (list) <nearest region ID for each coordinate>,
+          'city': (list) <nearest city ID for each coordinate>,
+          'errors': (list) <{ 'index': (int) <index in 'coordinates'>,
+                              'error': (string) <error message> }
+                            for each coordinate that was rejected> }
+        where each list of locales is in the same order as 'coordinates', with
+        None for rejected coordinates.
+    """
+    types = _ValidateNearestTypes(types)
+    if (not isinstance(coordinates, list) or
+        not all(isinstance(c, list) and len(c) == 2 for c in coordinates)):
+        raise SyntaxError('Must provide a list of coordinates, each a list'
+                          ' [latitude, longitude].')
+    if len(coordinates) > MAX_NEAREST_BATCH_COORDINATES:
+        raise SyntaxError('Too many coordinates in one batch (%d).  At most %d'
+                          ' are allowed.' % (len(coordinates),
+                                             MAX_NEAREST_BATCH_COORDINATES))
+
+    lats, lons, indexes, errors = [], [], [], []
+    for (index, (lat, lon)) in enumerate(coordinates):
+        try:
+            lat, lon = float(lat), float(lon)
+            _ValidateCoordinates(lat, lon)
+        except (TypeError, ValueError):
+            errors.append({'index': index,
+                           'error': 'Latitude and longitude must be numbers.'})
+            continue
+        except SyntaxError as e:
+            errors.append({'index': index, 'error': '%s' % e})
+            continue
+        lats.append(lat)
+        lons.append(lon)
+        indexes.append(index)
+
+    logging.debug('finding nearest locales to %d coordinates', len(lats))
+    try:
+        result = locale_finder.FindNearestNeighborsMany(lats, lons, types)
+    except locales.Error as e:
+        raise LookupError(e)
+
+    if errors:
+        # Put the locales found back in place among the rejected coordinates.
+        for (locale_type, nearest) in result.items():
+            placed = [None] * len(coordinates)
+            for (index, locale) in zip(indexes, nearest):
+                placed[index] = locale
+            result[locale_type] = placed
+    result['errors'] = errors
+    return result
+
+
+def _FormatExport(metric, rows, output_format):
+    """Formats exported metric data, a chunk of rows at a time.
+
+    The response has already started by the time rows are formatted, so a
+    backend error ends the export early with a trailing error record, after
+    the rows read so far: a CSV row "error,,<message>", or an NDJSON line
+    {"error": <message>}.
+
+    Args:
+        metric (string): Name of the metric being exported.
+        rows (generator): Metric data, as returned by
+            MetricsManager.ExportData().
+        output_format (string): 'csv' or 'ndjson'.
+
+    Yields:
+        (string) Chunks of the formatted export.
+    """
+    def Format(records):
+        if output_format == 'csv':
+            out = StringIO.StringIO()
+            csv.writer(out).writerows(records)
+            return out.getvalue()
+        return ''.join('%s\n' % json.dumps(record) for record in records)
+
+    def Record(date, locale, value):
+        if output_format == 'csv':
+            return ('%d-%02d' % date, locale, repr(value))
+        return {'date': '%d-%02d' % date, 'locale': locale, 'value': value}
+
+    if output_format == 'csv':
+        yield 'date,locale,value\r\n'
+
+    chunk = []
+    try:
+        while True:
+            for row in rows:
+                chunk.append(Record(*row))
+                if len(chunk) == EXPORT_ROWS_PER_CHUNK:
+                    break
+            if not chunk:
+                return
+            yield Format(chunk)
+            chunk = []
+    except metrics.Error as e:
+        logging.error('Export of %s ended early: %s' % (metric, e))
+        if output_format == 'csv':
+            chunk.append(('error', '', '%s' % e))
+        else:
+            chunk.append({'error': '%s' % e})
+        yield Format(chunk)
+
+
+def _ValidateRangeQuery(metric, locale, startyear, startmonth, endyear,
+                        endmonth):
+    """Verifies the arguments of a query for a range of months.
+
+    Raises:
+        SyntaxError: If expected parameters are not provided (are None), a
+        month isn't from 1 to 12, or the range ends before it starts.
+
+    Returns:
+        (tuple) The normalized locale, and the first and last months of the
+        range as tuples of ints (year, month).
+    """
+    locale = NormalizeLocale(locale)
 
     # Validate query parameters.
     if metric is None:
@@ -163,51 +801,80 @@ def HandleMultiMetricQuery(metrics_manager, metric, locale,
                           ' locale you wish to query.  For example, "", "100",'
                           ' "100_az", or "100_az_tucson".')
 
-    # Lookup & return the data.
-    results = {}
-    current_date = date(startyear, startmonth, 1)
-    end_date = date(endyear, endmonth, 1)
-    if end_date < current_date:
+    _ValidateMonth(startmonth, 'month')
+    _ValidateMonth(endmonth, 'endmonth')
+
+    start = (startyear, startmonth)
+    end = (endyear, endmonth)
+    if date(endyear, endmonth, 1) < date(startyear, startmonth, 1):
         raise SyntaxError('"endyear"-"endmonth" must be after'
                           ' "startyear"-"startmonth"')
 
-    logging.debug('getting multiple from ' + str(current_date) + ' to ' +
-                  str(end_date))
-    while current_date <= end_date:
-        try:
-            logging.debug('getting ' + metric + ' for ' + str(current_date))
-            key = str(current_date.year) + '-' + str(current_date.month)
-            results[key] = metrics_manager.LookupResult(
-                metric, current_date.year, current_date.month, locale)
+    return (locale, start, end)
 
-        except metrics.Error as e:
-            raise LookupError(e)
-        new_month = current_date.month + 1
-        new_year = current_date.year
-        if new_month == 13:
-            new_month = 1
-            new_year = new_year + 1
-        current_date = date(new_year, new_month, 1)
 
-    return results
+def _ValidateMonth(month, param):
+    """Verifies that a month is from 1 to 12.
+
+    Args:
+        month (int): Month to verify.
+        param (string): Request parameter the month was given in.
 
+    Raises:
+        SyntaxError: If the month is out of range.
+    """
+    if not 1 <= month <= 12:
+        raise SyntaxError('Malformed "%s".  Months must be from 1 to 12.'
+                          % param)
 
-def HandleNearestNeighborQuery(locale_finder, lat, lon):
-    """Verifies passed arguments and issues a nearest neighbor lookup.
+
+def _ValidateCoordinates(lat, lon):
+    """Verifies the latitude and longitude of a nearest neighbor lookup.
 
     Args:
-        lat (float): Latitude of interest.
-        lon (float): Longitude of interest.
+        lat (float): Latitude.
+        lon (float): Longitude.
 
     Raises:
-        SyntaxError: If expected parameters are not provided (are None).
+        SyntaxError: If either isn't a finite number, or is out of range.
+    """
+    if math.isnan(lat) or math.isnan(lon) or math.isinf(lat) or math.isinf(lon):
+        raise SyntaxError('Latitude and longitude must be finite numbers.')
+    if not -90 <= lat <= 90:
+        raise SyntaxError('Latitude must be from -90 to 90.')
+    if not -180 <= lon <= 180:
+        raise SyntaxError('Longitude must be from -180 to 180.')
+
+
+def _ValidateNearestTypes(types):
+    """Verifies the locale types requested of a nearest neighbor lookup.
+
+    Args:
+        types (list): Locale types, or None for all of them.
+
+    Raises:
+        SyntaxError: If any type isn't one of "country", "region", or "city".
 
     Returns:
-        (dict) The nearest city, region, and country to the provided latitude
-        and longitude coordinates.
+        (tuple) The requested locale types, without repeats.
     """
-    if lat is None or lon is None:
-        raise SyntaxError('Must provide parameters "lat" and "lon" identifying'
-                          ' the latitude and logitude of interest.')
+    if types is None:
+        return locales.NEAREST_LOCALE_TYPES
+
+    for locale_type in types:
+        if locale_type not in locales.NEAREST_LOCALE_TYPES:
+            raise SyntaxError('Unknown locale type "%s".  Must be one of'
+                              ' "country", "region", or "city".' % locale_type)
+    return tuple(t for t in locales.NEAREST_LOCALE_TYPES if t in types)
+
+
+def NormalizeLocale(locale):
+    """Anticipates non-standard locale= requests for world data.
 
-    return locale_finder.FindNearestNeighbors(lat, lon)
+    Returns:
+        (string) 'world' if 'locale' looks like a request for world data,
+        otherwise 'locale' unchanged.
+    """
+    if locale in ('', '""', "''", 'world', 'global'):
+        return 'world'
+    return locale
@@ -23,8 +23,14 @@ the project name of "API Server".
 The API Server is designed to run on Google AppEngine.
 """
 
+from datetime import date
+import email.utils
+import hashlib
 import json
 import logging
+import os
+import time
+import zlib
 
 from deps import bottle
 from deps.bottle import response
@@ -33,15 +39,40 @@ from deps.bottle import route
 from deps.bottle import view
 from google.appengine.ext.webapp.util import run_wsgi_app
 
+from common import background_refresh
 from common import locales
+from common import lru_cache
 from common import metrics
+from common import snapshot
 import query_engine
+import stats
+import warmup
+
+# Cache-Control max-age for API responses, in seconds.
+CLOSED_MONTH_MAX_AGE = 7 * 24 * 60 * 60  # Data for months that have ended.
+OPEN_MONTH_MAX_AGE = 60 * 60  # Data for this month (or later) may change.
+LOCALE_MAX_AGE = 24 * 60 * 60
+
+# Snapshot of metric and locale data, served at startup if it's deployed.
+SNAPSHOT_FILE = os.path.join(os.path.dirname(__file__), 'snapshot.bin')
+
+# API responses smaller than this many bytes are sent uncompressed, since
+# compressing them saves little.
+COMPRESSION_MIN_BYTES = 1024
+
+# Bounds on the cache of encoded API responses.
+MAX_CACHED_RESPONSES = 10000
+MAX_CACHED_RESPONSE_BYTES = 16 * 1024 * 1024  # 16MB
 
 _backend = None
 _locale_finder = None
 _locales_manager = None
 _metrics_manager = None
 
+# Normalized query -> (version, encoded JSON response, gzipped response).
+_response_cache = lru_cache.LRUCache(MAX_CACHED_RESPONSES,
+                                     MAX_CACHED_RESPONSE_BYTES)
+
 
 def start(backend):
     """Start the bottle web framework on AppEngine.
@@ -59,12 +90,64 @@ def start(backend):
     # AppEngine restarts the app for every request, but global data persists
     # across restarts so there's rarely reason to recreate it.
     if None in (_backend, _locale_finder, _locales_manager, _metrics_manager):
-        _backend = backend
+        _backend = stats.InstrumentedBackend(backend)
         _locale_finder = locales.LocaleFinder(_backend)
-        _locales_manager = locales.LocalesManager(_backend)
         _metrics_manager = metrics.MetricsManager(_backend)
+        _locales_manager = locales.LocalesManager(
+            _backend, locale_index=_metrics_manager.locale_index)
+        _LoadSnapshot(SNAPSHOT_FILE)
+
+    run_wsgi_app(background_refresh.Middleware(
+        stats.Middleware(bottle.default_app())))
+
+
+def _LoadSnapshot(path):
+    """Loads the locale and metric caches and the locale finder from a
+    snapshot file, if it exists.
+
+    This lets a new instance serve immediately.  Data older than the refresh
+    rates is served while it's refreshed in the background.
+
+    Args:
+        path (string): Snapshot file.
+    """
+    if not os.path.exists(path):
+        return
+
+    try:
+        snap = snapshot.Read(path)
+    except (IOError, snapshot.Error) as e:
+        logging.error('Failed to read snapshot %s: %s' % (path, e))
+        return
+
+    # Locales first, so that metric data is laid out in locale order.
+    _locales_manager.LoadSnapshot(snap)
+    _metrics_manager.LoadSnapshot(snap)
+    try:
+        _locale_finder.LoadSnapshot(snap)
+    except ValueError as e:  # The finder just loads on first use instead.
+        logging.error('Failed to load search trees from snapshot %s: %s'
+                      % (path, e))
+    logging.info('Loaded snapshot %s, created %s.' % (path, snap.created))
+
 
-    run_wsgi_app(bottle.default_app())
+@route('/_ah/warmup')
+def warmup_request():
+    """Handle an AppEngine warmup request by pre-warming the caches.
+
+    AppEngine sends this request to new instances before they receive user
+    requests.
+
+    Returns:
+        (string) A summary of the warmup, in JSON.
+    """
+    try:
+        config = warmup.Config()
+    except ValueError as e:
+        logging.error('Malformed warmup configuration: %s' % e)
+        config = {}
+    return warmup.Warmup(_metrics_manager, _locales_manager, _locale_finder,
+                         **config)
 
 
 @route('/api/locale/<locale_name>')
@@ -84,10 +167,10 @@ def locale_api_query(locale_name):
         errors.
     """
     response.headers['Access-Control-Allow-Origin'] = '*'  # Enable CORS.
-    try:
-        return query_engine.HandleLocaleQuery(_locales_manager, locale_name)
-    except query_engine.Error as e:
-        return {'error': '%s' % e}
+    return _ConditionalResponse(
+        lambda: query_engine.HandleLocaleQuery(_locales_manager, locale_name),
+        _locales_manager.LastRefreshTime, LOCALE_MAX_AGE,
+        cache_key=('locale', locale_name))
 
 
 @route('/api/metric/<metric_name>')
@@ -101,6 +184,14 @@ def metric_api_query(metric_name):
     There are optional GET params "endyear" and "endmonth" that can be set to
     get metrics for a range of time.
 
+    There is an optional GET param "expand" that can be set to "children" to
+    get the metric for every child of "locale" instead, eg for every state of a
+    country.  It can't be combined with a range of time.
+
+    There is an optional GET param "format" that can be set to "series" to get
+    a compact response with one value per month, in order, with null for
+    months without data.  It can't be combined with "expand".
+
     This function will return a dict which is then JSONified by Bottle. If the
     requested metric does not exist or if any expected GET parameters are not
     specified, a JSON error is returned.  Otherwise metric details are returned
@@ -125,8 +216,39 @@ def metric_api_query(metric_name):
     endyear = request.GET.get('endyear', None)
     endmonth = request.GET.get('endmonth', None)
 
-    try:
-        if endyear != None and endmonth != None:
+    # If set to 'children', the metric for every child of locale is returned.
+    expand = request.GET.get('expand', None)
+
+    # If set to 'series', the metric is returned as a time series.
+    output_format = request.GET.get('format', None)
+
+    if output_format is not None:
+        if output_format != 'series':
+            return {'error': 'Unsupported format "%s".  Only "series" is'
+                             ' supported.' % output_format}
+        if expand is not None:
+            return {'error': 'format=series cannot be combined with "expand".'}
+
+    if expand is not None:
+        if expand != 'children':
+            return {'error': 'Unsupported expand "%s".  Only "children" is'
+                             ' supported.' % expand}
+        if endyear != None or endmonth != None:
+            return {'error': 'expand=children cannot be combined with'
+                             ' "endyear" and "endmonth".'}
+
+    def lookup():
+        if expand is not None:
+            logging.info('Redirecting to children metric query')
+            return query_engine.HandleChildrenMetricQuery(
+                _metrics_manager, _locales_manager, metric_name, locale,
+                int(year), int(month))
+        elif output_format is not None:
+            logging.info('Redirecting to metric series query')
+            return query_engine.HandleMetricSeriesQuery(
+                _metrics_manager, metric_name, locale, start[0], start[1],
+                end[0], end[1])
+        elif endyear != None and endmonth != None:
             logging.info('Redirecting to multi metric query')
             return query_engine.HandleMultiMetricQuery(
                 _metrics_manager, metric_name, locale, int(year), int(month),
@@ -135,9 +257,211 @@ def metric_api_query(metric_name):
             logging.info('Redirecting to single metric query')
             return query_engine.HandleMetricQuery(
                 _metrics_manager, metric_name, locale, int(year), int(month))
-    except (query_engine.Error, ValueError) as e:
+
+    try:
+        start = (int(year), int(month))
+        end = start
+        if endyear != None and endmonth != None:
+            end = (int(endyear), int(endmonth))
+    except (TypeError, ValueError) as e:
+        if year is None or month is None:
+            e = ('Must provide parameters "year" and "month" identifying the'
+                 ' date you wish to query.')
+        return {'error': '%s' % e}
+
+    # Data for months that have ended rarely changes, so can be cached longer.
+    today = date.today()
+    if end < (today.year, today.month):
+        max_age = CLOSED_MONTH_MAX_AGE
+    else:
+        max_age = OPEN_MONTH_MAX_AGE
+
+    return _ConditionalResponse(
+        lookup,
+        lambda: _MetricVersion(metric_name, locale, start, end, expand),
+        max_age,
+        cache_key=('metric', metric_name,
+                   query_engine.NormalizeLocale(locale), start, end, expand,
+                   output_format))
+
+
+@route('/api/rank/<metric_name>')
+def rank_api_query(metric_name):
+    """Handle a ranking API query and send a response in JSON.
+
+    Expects GET params "year", "month", and "locale_type" to rank every locale
+    of a type by the metric for a month.  For example one can ask for the
+    cities with the highest median throughput in July 2011.
+
+    There are optional GET params "parent" to rank only the locales within a
+    locale, eg "840" (required for cities), "n" for the number of top ranked
+    locales listed (10 by default), "order" which can be "desc" (the default)
+    to rank larger values higher or "asc" to rank smaller values higher, and
+    "locale" to also get the rank and percentile of one locale.
+
+    This function will return a dict which is then JSONified by Bottle. If the
+    requested metric does not exist or if any expected GET parameters are not
+    specified, a JSON error is returned.  Otherwise the top ranked locales are
+    returned.
+
+    Args:
+        metric_name (string): The metric to rank by.
+
+    Returns:
+        (string) JSON describing either the ranked locales or any lookup
+        errors.
+    """
+    response.headers['Access-Control-Allow-Origin'] = '*'  # Enable CORS.
+    year = request.GET.get('year', None)
+    month = request.GET.get('month', None)
+    locale_type = request.GET.get('locale_type', None)
+    parent = request.GET.get('parent', None)
+    order = request.GET.get('order', 'desc')
+    locale = request.GET.get('locale', None)
+
+    try:
+        year, month = int(year), int(month)
+        n = int(request.GET.get('n', 10))
+    except (TypeError, ValueError) as e:
+        if year is None or month is None:
+            e = ('Must provide parameters "year" and "month" identifying the'
+                 ' date you wish to query.')
+        return {'error': '%s' % e}
+
+    def version():
+        try:
+            return _metrics_manager.LastRankLoadTime(
+                metric_name, year, month, locale_type,
+                query_engine.NormalizeLocale(parent))
+        except KeyError:  # Malformed locale type or parent.
+            return None
+
+    # Data for months that have ended rarely changes, so can be cached longer.
+    today = date.today()
+    if (year, month) < (today.year, today.month):
+        max_age = CLOSED_MONTH_MAX_AGE
+    else:
+        max_age = OPEN_MONTH_MAX_AGE
+
+    return _ConditionalResponse(
+        lambda: query_engine.HandleRankQuery(
+            _metrics_manager, metric_name, year, month, locale_type, parent,
+            n, order, locale),
+        version, max_age,
+        cache_key=('rank', metric_name, year, month, locale_type,
+                   query_engine.NormalizeLocale(parent), n, order,
+                   query_engine.NormalizeLocale(locale)))
+
+
+@route('/api/batch', method='POST')
+def batch_api_query():
+    """Handle a batch metric API query and send a response in JSON.
+
+    Expects a POSTed JSON list of queries, each an object with the keys
+    "metric", "locale", "year", and "month".  For example one can ask for
+    several metrics for Tokyo and London on July 2011 with a single request.
+
+    This function will return a dict which is then JSONified by Bottle. If the
+    request is malformed, a JSON error is returned.  Otherwise results are
+    returned for each query in order, with an error in place of the metric
+    value for any query that could not be answered.
+
+    Returns:
+        (string) JSON describing either the results of each query or any
+        request errors.
+    """
+    response.headers['Access-Control-Allow-Origin'] = '*'  # Enable CORS.
+    try:
+        queries = json.loads(request.body.read())
+    except ValueError as e:
+        return {'error': 'Malformed JSON request: %s' % e}
+
+    try:
+        result = query_engine.HandleBatchQuery(_metrics_manager, queries)
+    except query_engine.Error as e:
+        return {'error': '%s' % e}
+
+    return _EncodeResponse(json.dumps(result))
+
+
+@route('/api/export/<metric_name>')
+def export_api_query(metric_name):
+    """Handle a bulk export API query, streaming the response.
+
+    Expects GET params "start" and "end", the first and last months to export,
+    eg "2012-01".  There are optional GET params "locale_type" to export only
+    locales of one type, eg "country", and "format", which can be "csv" (the
+    default) or "ndjson".
+
+    Every value of the metric for the requested months and locales is streamed
+    from the backend as it's read, rather than being loaded into memory first.
+    If the request is invalid, a JSON error is returned instead.
+
+    The response has started, with a 200 status, before the data is read.  So
+    if reading fails part way, the export is cut short and ends with an error
+    record after the rows read so far: a CSV row whose "date" is "error" and
+    whose "value" is the error message, or an NDJSON line {"error": <message>}.
+    A complete export has no such record.
+
+    Args:
+        metric_name (string): The metric to export.
+
+    Returns:
+        (generator) Chunks of the export, or a (dict) JSON error.
+    """
+    response.headers['Access-Control-Allow-Origin'] = '*'  # Enable CORS.
+    start = request.GET.get('start', None)
+    end = request.GET.get('end', None)
+    locale_type = request.GET.get('locale_type', None)
+    output_format = request.GET.get('format', 'csv')
+
+    try:
+        if start is not None:
+            start = metrics.ParseDate(start)
+        if end is not None:
+            end = metrics.ParseDate(end)
+    except ValueError:
+        return {'error': 'Malformed "start" or "end".  Months should be given'
+                         ' as eg "2012-01".'}
+
+    try:
+        chunks = query_engine.HandleExportQuery(
+            _metrics_manager, metric_name, start, end, locale_type,
+            output_format)
+    except query_engine.Error as e:
         return {'error': '%s' % e}
 
+    if output_format == 'csv':
+        response.content_type = 'text/csv; charset=utf-8'
+    else:
+        response.content_type = 'application/x-ndjson; charset=utf-8'
+    response.headers['Content-Disposition'] = (
+        'attachment; filename="%s.%s"' % (metric_name, output_format))
+    return chunks
+
+
+@route('/api/stats')
+def stats_api_query():
+    """Handle a request for the API Server's statistics.
+
+    There is an optional GET param "format" that can be set to "prometheus"
+    to get the statistics in Prometheus text format instead of JSON.
+
+    Returns:
+        (dict) Statistics, as returned by stats.Stats(), JSONified by Bottle.
+        (string) Statistics in Prometheus text format.
+    """
+    caches = {'metric_data': _metrics_manager.CacheStats(),
+              'metric_misses': _metrics_manager.MissCacheStats(),
+              'locales': _locales_manager.CacheStats(),
+              'locale_finder': _locale_finder.CacheStats(),
+              'responses': _response_cache.Stats()}
+
+    if request.GET.get('format', None) == 'prometheus':
+        response.content_type = 'text/plain; version=0.0.4'
+        return stats.PrometheusText(caches)
+    return stats.Stats(caches)
+
 
 @route('/api/nearest')
 def nearest_api_query():
@@ -147,6 +471,13 @@ def nearest_api_query():
     that will be used for a nearest neighbor lookup.  If the lookup succeeds the
     user will receive the nearest country, region, and city.
 
+    Optional GET params "k" and "radius_km" instead list the "k" nearest
+    locales, or those within "radius_km" kilometers, or both, with their
+    great-circle distances.  For example one can find every city within 50km
+    of a point to aggregate its metrics.  Optional GET param "types", a comma
+    separated list of "country", "region", and "city", limits the lookup to
+    those locale types.
+
     This function will return a dict which is then JSONified by Bottle. If there
     is a problem looking up nearest locales or if any expected GET parameters
     are not specified, a JSON error is returned.  Otherwise nearest locales are
@@ -159,13 +490,287 @@ def nearest_api_query():
     response.headers['Access-Control-Allow-Origin'] = '*'  # Enable CORS.
     lat = request.GET.get('lat', None)
     lon = request.GET.get('lon', None)
+    k = request.GET.get('k', None)
+    radius_km = request.GET.get('radius_km', None)
+    types = request.GET.get('types', None)
+    if types is not None:
+        types = tuple(types.split(','))
+
+    try:
+        lat, lon = float(lat), float(lon)
+        if k is not None:
+            k = int(k)
+        if radius_km is not None:
+            radius_km = float(radius_km)
+    except (TypeError, ValueError) as e:
+        if lat is None or lon is None:
+            e = ('Must provide parameters "lat" and "lon" identifying the'
+                 ' latitude and logitude of interest.')
+        return {'error': '%s' % e}
+
+    return _ConditionalResponse(
+        lambda: query_engine.HandleNearestNeighborQuery(
+            _locale_finder, lat, lon, k, radius_km, types),
+        _locale_finder.LastRefreshTime, LOCALE_MAX_AGE,
+        cache_key=('nearest', lat, lon, k, radius_km, types))
+
+
+@route('/api/nearest/batch', method='POST')
+def nearest_batch_api_query():
+    """Handle a batch nearest-neighbor API query and send a response in JSON.
+
+    Expects a POSTed JSON list of coordinates, each a list [latitude,
+    longitude].  For example one can map thousands of test endpoints to their
+    nearest locales with a single request.  Optional GET param "types", as for
+    nearest_api_query(), limits the lookup to those locale types.
+
+    This function will return a dict which is then JSONified by Bottle. If the
+    request is malformed, a JSON error is returned.  Otherwise the nearest
+    countries, regions, and cities are returned as lists, in the same order as
+    the coordinates.  Coordinates that aren't finite or are out of range are
+    listed under "errors", with null in place of their locales.
+
+    Returns:
+        (string) JSON describing either the locales nearest to each of the
+        coordinates, or any request errors.
+    """
+    response.headers['Access-Control-Allow-Origin'] = '*'  # Enable CORS.
+    types = request.GET.get('types', None)
+    if types is not None:
+        types = types.split(',')
+
+    try:
+        coordinates = json.loads(request.body.read())
+    except ValueError as e:
+        return {'error': 'Malformed JSON request: %s' % e}
 
     try:
-        return query_engine.HandleNearestNeighborQuery(
-            _locale_finder, float(lat), float(lon))
+        result = query_engine.HandleNearestNeighborBatchQuery(
+            _locale_finder, coordinates, types)
+    except query_engine.Error as e:
+        return {'error': '%s' % e}
+
+    return _EncodeResponse(json.dumps(result))
+
+
+def _ConditionalResponse(lookup_fn, version_fn, max_age, cache_key=None):
+    """Answers an API query, honoring HTTP conditional request headers.
+
+    Responses are given a weak ETag and a Last-Modified time derived from the
+    version of the cached data they're built from, and a Cache-Control max-age.
+    If the client (or an edge cache) already has the current version, as told
+    by If-None-Match or If-Modified-Since, a "304 Not Modified" is sent
+    instead of the response.  When the version is known up front this avoids
+    the lookup entirely.
+
+    Successful responses are also cached, JSON encoded and gzipped, by
+    'cache_key' along with their version.  A cached response is served only
+    while its version is current, so it's invalidated whenever the data it's
+    built from is reloaded.
+
+    Responses are compressed as allowed by the request's Accept-Encoding (see
+    _EncodeResponse()).
+
+    Args:
+        lookup_fn (function): Called with no arguments to answer the query.
+        version_fn (function): Called with no arguments to determine the
+            version of the data, returning a (datetime) load time or None if
+            the version is unknown, eg because the data isn't cached.
+        max_age (int): Cache-Control max-age for the response, in seconds.
+        cache_key (hashable): Normalized query, identifying the response in
+            the response cache.  If None, the response isn't cached.
+
+    Returns:
+        (string) The JSON encoded, possibly compressed, query response.
+        (dict) An error.
+        (HTTPResponse) A "304 Not Modified" response.
+    """
+    version = version_fn()
+    if version is not None:
+        if _SetCacheHeaders(version, max_age):
+            return bottle.HTTPResponse(status=304)
+
+        if cache_key is not None:
+            cached = _response_cache.Get(cache_key)
+            if cached is not None and cached[0] == version:
+                return _EncodeResponse(cached[1], gzipped=cached[2])
+
+    try:
+        result = lookup_fn()
     except (query_engine.Error, ValueError) as e:
+        for header in ('ETag', 'Last-Modified', 'Cache-Control'):
+            if header in response.headers:
+                del response.headers[header]
         return {'error': '%s' % e}
 
+    version = version_fn()
+    if version is not None and _SetCacheHeaders(version, max_age):
+        return bottle.HTTPResponse(status=304)
+
+    body = json.dumps(result)
+    if version is None or cache_key is None:
+        return _EncodeResponse(body)
+
+    gzipped = None
+    if len(body) >= COMPRESSION_MIN_BYTES:
+        gzipped = _Gzip(body)
+    _response_cache.Set(cache_key, (version, body, gzipped),
+                        len(body) + len(gzipped or ''))
+    return _EncodeResponse(body, gzipped=gzipped)
+
+
+def _EncodeResponse(body, gzipped=None):
+    """Prepares a JSON response body, compressing it if the client allows.
+
+    Bodies of at least 'COMPRESSION_MIN_BYTES' are compressed with gzip or
+    deflate, whichever the request's Accept-Encoding prefers (gzip on a tie).
+
+    Args:
+        body (string): JSON encoded response.
+        gzipped (string): 'body' already compressed with gzip, if available.
+
+    Returns:
+        (string) The response body to be sent.
+    """
+    response.content_type = 'application/json'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if len(body) < COMPRESSION_MIN_BYTES:
+        return body
+
+    encoding = _AcceptedEncoding(request.headers.get('Accept-Encoding', ''))
+    if encoding == 'gzip':
+        body = gzipped or _Gzip(body)
+    elif encoding == 'deflate':
+        body = zlib.compress(body)
+    else:
+        return body
+
+    response.headers['Content-Encoding'] = encoding
+    return body
+
+
+def _AcceptedEncoding(accept_encoding):
+    """Chooses a content encoding for a response.
+
+    Args:
+        accept_encoding (string): The request's Accept-Encoding header, eg
+            'gzip, deflate;q=0.5'.
+
+    Returns:
+        (string) 'gzip' or 'deflate', or None if neither is acceptable.
+    """
+    qualities = {}
+    for item in accept_encoding.split(','):
+        params = item.strip().split(';')
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[params[0].strip().lower()] = quality
+
+    any_quality = qualities.get('*', 0.0)
+    gzip = qualities.get('gzip', qualities.get('x-gzip', any_quality))
+    deflate = qualities.get('deflate', any_quality)
+    if max(gzip, deflate) <= 0:
+        return None
+    return 'gzip' if gzip >= deflate else 'deflate'
+
+
+def _Gzip(body):
+    """Compresses a response body with gzip.
+
+    Returns:
+        (string) The compressed body.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def _SetCacheHeaders(version, max_age):
+    """Sets caching headers for the current response.
+
+    Args:
+        version (datetime): Version of the data the response is built from.
+        max_age (int): Cache-Control max-age for the response, in seconds.
+
+    Returns:
+        (bool) True if the request's conditional headers show the client
+        already has this version of the response, otherwise False.
+    """
+    last_modified = int(time.mktime(version.timetuple()))
+    # The ETag is weak, since the same tag is sent whether the response is
+    # compressed with gzip, deflate, or not at all.
+    opaque_tag = '"%s"' % hashlib.md5('%s?%s@%d' % (
+        request.path, request.query_string, last_modified)).hexdigest()
+
+    response.headers['ETag'] = 'W/%s' % opaque_tag
+    response.headers['Last-Modified'] = email.utils.formatdate(
+        last_modified, usegmt=True)
+    response.headers['Cache-Control'] = 'public, max-age=%d' % max_age
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        # If-None-Match uses the weak comparison, which ignores the W/ prefix.
+        tags = [t.strip() for t in if_none_match.split(',')]
+        return (if_none_match.strip() == '*' or
+                opaque_tag in [t[2:] if t.startswith('W/') else t
+                               for t in tags])
+
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since is not None:
+        since = bottle.parse_date(if_modified_since)
+        return since is not None and since >= last_modified
+
+    return False
+
+
+def _MetricVersion(metric_name, locale, start, end, expand):
+    """Determines the version of the cached data for a metric API query.
+
+    Args:
+        metric_name (string): The metric queried.
+        locale (string): The locale queried.
+        start (tuple): First month queried, as ints (year, month).
+        end (tuple): Last month queried, as ints (year, month).
+        expand (string): 'children' if the locale's children were queried,
+            otherwise None.
+
+    Returns:
+        (datetime) When the queried data was loaded, or None if it's unknown.
+    """
+    locale = query_engine.NormalizeLocale(locale)
+    if locale is None:
+        return None
+
+    versions = []
+    if expand == 'children':
+        # All children share a locale scope, so any child's version will do.
+        versions.append(_locales_manager.LastRefreshTime())
+        try:
+            if locale == 'world':
+                children = _locales_manager.LocalesByType('country')
+            else:
+                children = _locales_manager.Locale(locale).children
+        except (KeyError, locales.Error):
+            return None
+        if not children:
+            return None
+        locale = children[0]
+
+    try:
+        versions.append(
+            _metrics_manager.LastLoadTime(metric_name, start, end, locale))
+    except KeyError:  # Malformed locale.
+        return None
+
+    if None in versions:
+        return None
+    return max(versions)
+
 
 @route('/details')
 @route('/details/<metric_name>')
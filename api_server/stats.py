@@ -0,0 +1,328 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Author: Dylan Curley
+
+"""This module records in-process statistics about the API Server.
+
+Statistics include latency and response size histograms for each route, and
+call counts, error counts, and latency histograms for each backend method.
+They're exposed, along with cache statistics, by the /api/stats endpoint as
+JSON or as Prometheus text.
+
+Recording is cheap enough to do on every request: a bisect and a few integer
+increments.  Counters aren't locked, so under heavy concurrency an occasional
+increment may be lost, which is acceptable for monitoring.
+"""
+
+import bisect
+import time
+import types
+
+# Upper bounds of histogram buckets for latencies, in seconds.
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0,
+                   2.0, 5.0, 10.0, 30.0)
+
+# Upper bounds of histogram buckets for response sizes, in bytes.
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+_start_time = time.time()
+_route_latency = {}  # Route -> Histogram of request latencies.
+_route_bytes = {}  # Route -> Histogram of response sizes.
+_backend_latency = {}  # Backend method -> Histogram of call latencies.
+_backend_errors = {}  # Backend method -> number of calls that raised.
+
+
+class Histogram(object):
+    """Counts observations in buckets with fixed upper bounds.
+
+    Members:
+        bounds (tuple): Upper bound of each bucket, in increasing order.  A
+            final bucket holds observations larger than all bounds.
+        counts (list): Number of observations in each bucket.
+        count (int): Total number of observations.
+        sum (float): Sum of all observations.
+    """
+    def __init__(self, bounds):
+        """Constructor.
+
+        Args:
+            bounds (tuple): Upper bound of each bucket, in increasing order.
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def Record(self, value):
+        """Records an observation.
+
+        Args:
+            value (float): The observed value.
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def Percentile(self, percentile):
+        """Estimates a percentile of the observations.
+
+        Args:
+            percentile (float): Percentile of interest, from 0 to 100.
+
+        Returns:
+            (float) Upper bound of the bucket holding the percentile, or None
+            if there are no observations.  If the percentile is larger than all
+            bounds, the largest bound is returned.
+        """
+        counts = list(self.counts)
+        total = sum(counts)
+        if not total:
+            return None
+
+        rank = total * percentile / 100.0
+        seen = 0
+        for (bound, count) in zip(self.bounds, counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.bounds[-1]
+
+    def Stats(self):
+        """Summarizes the histogram.
+
+        Returns:
+            (dict) Summary statistics.  Specifically,
+            { 'count': (int) <number of observations>,
+              'sum': (float) <sum of observations>,
+              'p50': (float) <estimated median>,
+              'p99': (float) <estimated 99th percentile>,
+              'buckets': (list) <[upper bound, count] for each bucket, with
+                         None for the last bucket's bound> }
+        """
+        return {'count': self.count,
+                'sum': self.sum,
+                'p50': self.Percentile(50),
+                'p99': self.Percentile(99),
+                'buckets': [list(b) for b in
+                            zip(self.bounds + (None,), self.counts)]}
+
+
+class Middleware(object):
+    """WSGI middleware recording the latency and response size of each route.
+
+    Latency is measured until the response body has been fully produced, so
+    it includes JSON encoding, compression, and streaming.
+    """
+    def __init__(self, app):
+        """Constructor.
+
+        Args:
+            app (WSGI application): The Bottle application.
+        """
+        self._app = app
+
+    def __call__(self, environ, start_response):
+        start_time = time.time()
+        body = self._app(environ, start_response)
+        return self._Measure(environ, body, start_time)
+
+    def _Measure(self, environ, body, start_time):
+        """Passes through the response body, then records statistics.
+
+        Yields:
+            (string) Chunks of the response body.
+        """
+        size = 0
+        try:
+            for chunk in body:
+                size += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            route = environ.get('bottle.route')
+            rule = route.rule if route is not None else '<unrouted>'
+            _Get(_route_latency, rule, LATENCY_BUCKETS).Record(
+                time.time() - start_time)
+            _Get(_route_bytes, rule, SIZE_BUCKETS).Record(size)
+
+
+class InstrumentedBackend(object):
+    """Backend wrapper recording the count, errors, and latency of each call.
+
+    Calls are passed through to the wrapped backend unchanged.  Calls that
+    return a generator, eg IterMetricDataRange(), are recorded once the
+    generator is done: their latency is the time spent in the backend over the
+    whole iteration, and errors raised while iterating are counted.
+    """
+    def __init__(self, backend):
+        """Constructor.
+
+        Args:
+            backend (Backend object): Datastore backend to be instrumented.
+        """
+        self._backend = backend
+
+    def __getattr__(self, name):
+        attr = getattr(self._backend, name)
+        if not callable(attr):
+            return attr
+
+        def Call(*args, **kwargs):
+            start_time = time.time()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception:
+                _RecordBackendCall(name, time.time() - start_time, error=True)
+                raise
+            if isinstance(result, types.GeneratorType):
+                return _Iterate(name, result, time.time() - start_time)
+            _RecordBackendCall(name, time.time() - start_time)
+            return result
+        return Call
+
+
+def Stats(caches):
+    """Summarizes all recorded statistics.
+
+    Args:
+        caches (dict): Cache statistics, as returned by LRUCache.Stats(), keyed
+            by cache name.
+
+    Returns:
+        (dict) All statistics.  Specifically,
+        { 'uptime': (float) <seconds since the instance started>,
+          'routes': (dict) <{'latency': ..., 'bytes': ...} for each route,
+                    as returned by Histogram.Stats()>,
+          'backend': (dict) <{'latency': ..., 'errors': ...} for each backend
+                     method>,
+          'caches': (dict) <'caches'> }
+    """
+    return {
+        'uptime': time.time() - _start_time,
+        'routes': dict((rule, {'latency': _route_latency[rule].Stats(),
+                               'bytes': _Get(_route_bytes, rule,
+                                             SIZE_BUCKETS).Stats()})
+                       for rule in _route_latency.keys()),
+        'backend': dict((name, {'latency': _backend_latency[name].Stats(),
+                                'errors': _backend_errors.get(name, 0)})
+                        for name in _backend_latency.keys()),
+        'caches': caches}
+
+
+def PrometheusText(caches):
+    """Formats all recorded statistics in the Prometheus text format.
+
+    Args:
+        caches (dict): Cache statistics, as returned by LRUCache.Stats(), keyed
+            by cache name.
+
+    Returns:
+        (string) The statistics, in Prometheus text exposition format.
+    """
+    lines = ['# TYPE api_uptime_seconds gauge',
+             'api_uptime_seconds %r' % (time.time() - _start_time)]
+
+    _PrometheusHistogram(lines, 'api_request_duration_seconds', 'route',
+                         _route_latency)
+    _PrometheusHistogram(lines, 'api_response_bytes', 'route', _route_bytes)
+    _PrometheusHistogram(lines, 'api_backend_call_duration_seconds', 'method',
+                         _backend_latency)
+
+    lines.append('# TYPE api_backend_errors_total counter')
+    for (name, errors) in sorted(_backend_errors.items()):
+        lines.append('api_backend_errors_total{method="%s"} %d'
+                     % (name, errors))
+
+    for stat in ('entries', 'bytes', 'hits', 'misses', 'evictions'):
+        metric = 'api_cache_%s' % stat
+        if stat in ('hits', 'misses', 'evictions'):
+            metric += '_total'
+            lines.append('# TYPE %s counter' % metric)
+        else:
+            lines.append('# TYPE %s gauge' % metric)
+        for (cache, cache_stats) in sorted(caches.items()):
+            lines.append('%s{cache="%s"} %d' % (metric, cache,
+                                                cache_stats[stat]))
+
+    return '\n'.join(lines) + '\n'
+
+
+def _PrometheusHistogram(lines, metric, label, histograms):
+    """Appends Prometheus text for a set of labelled histograms to 'lines'.
+    """
+    lines.append('# TYPE %s histogram' % metric)
+    for (value, histogram) in sorted(histograms.items()):
+        value = value.replace('\\', '\\\\').replace('"', '\\"')
+        cumulative = 0
+        for (bound, count) in zip(histogram.bounds + ('+Inf',),
+                                  list(histogram.counts)):
+            cumulative += count
+            lines.append('%s_bucket{%s="%s",le="%s"} %d'
+                         % (metric, label, value, bound, cumulative))
+        lines.append('%s_sum{%s="%s"} %r' % (metric, label, value,
+                                             histogram.sum))
+        lines.append('%s_count{%s="%s"} %d' % (metric, label, value,
+                                               cumulative))
+
+
+def _Get(histograms, key, bounds):
+    """Retrieves the histogram for 'key', creating it if necessary.
+
+    Returns:
+        (Histogram) The histogram.
+    """
+    histogram = histograms.get(key)
+    if histogram is None:
+        histogram = histograms.setdefault(key, Histogram(bounds))
+    return histogram
+
+
+def _Iterate(name, generator, seconds):
+    """Passes through the items of a backend generator, then records the call.
+
+    Args:
+        name (string): Name of the backend method that returned 'generator'.
+        generator (generator): Result of the call.
+        seconds (float): Time already spent in the call.
+
+    Yields:
+        (object) Each item of 'generator'.
+    """
+    error = False
+    try:
+        while True:
+            start_time = time.time()
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+            except Exception:
+                error = True
+                raise
+            finally:
+                seconds += time.time() - start_time
+            yield item
+    finally:
+        generator.close()
+        _RecordBackendCall(name, seconds, error=error)
+
+
+def _RecordBackendCall(name, seconds, error=False):
+    """Records the latency, and any error, of a backend call.
+    """
+    if error:
+        _backend_errors[name] = _backend_errors.get(name, 0) + 1
+    _Get(_backend_latency, name, LATENCY_BUCKETS).Record(seconds)
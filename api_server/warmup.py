@@ -0,0 +1,276 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Author: Dylan Curley
+
+"""This module pre-warms the API Server's caches before it serves users.
+
+AppEngine sends a warmup request to each new instance before routing user
+requests to it.  Warming loads the metric definitions, the locale table, the
+nearest-neighbor GeoTree, and the most recent months of every metric, so that
+the first users of an instance don't pay for those loads.
+
+What's warmed is configured by the 'env_variables' of app.yaml (see Config()),
+so that it can be changed without changing code.
+"""
+
+from datetime import date
+from datetime import datetime
+import logging
+import os
+import threading
+
+from common import locales
+from common import metrics
+from common import parallel
+
+# Metrics to warm, or None for all metrics.
+WARMUP_METRICS = None
+
+# Number of most recent months of data to warm for each metric.
+WARMUP_MONTHS = 3
+
+# Locale types whose metric data is warmed.  Cities are left out, since they're
+# loaded one country at a time.
+WARMUP_LOCALE_TYPES = ('world', 'country', 'region')
+
+# Countries whose cities are warmed, when cities are, or None for all.
+WARMUP_CITY_COUNTRIES = None
+
+# Maximum number of concurrent backend loads while warming.
+WARMUP_THREADS = 8
+
+# Locale types that can be warmed.
+_LOCALE_TYPES = ('world', 'country', 'region', 'city')
+
+
+def Config(environ=None):
+    """Reads the warmup configuration from environment variables.
+
+    AppEngine sets these from the 'env_variables' of app.yaml:
+        WARMUP_METRICS: Comma separated metrics to warm, or empty for all.
+        WARMUP_MONTHS: Number of most recent months of data to warm.
+        WARMUP_LOCALE_TYPES: Comma separated locale types to warm.
+        WARMUP_CITY_COUNTRIES: Comma separated countries whose cities are
+            warmed, or empty for all.
+    Unset variables default to the module constants above.
+
+    Args:
+        environ (dict): Environment variables.  If None, os.environ.
+
+    Raises:
+        ValueError: A variable is malformed.
+
+    Returns:
+        (dict) Keyword arguments for Warmup().  Specifically,
+        { 'metric_names': (list) <metrics to warm, or None for all>,
+          'months': (int) <number of months to warm>,
+          'locale_types': (list) <locale types to warm>,
+          'city_countries': (list) <countries whose cities to warm, or None
+                                    for all> }
+    """
+    if environ is None:
+        environ = os.environ
+
+    metric_names = WARMUP_METRICS
+    if 'WARMUP_METRICS' in environ:
+        metric_names = _SplitList(environ['WARMUP_METRICS']) or None
+
+    months = WARMUP_MONTHS
+    if 'WARMUP_MONTHS' in environ:
+        months = int(environ['WARMUP_MONTHS'])
+        if months < 1:
+            raise ValueError('WARMUP_MONTHS must be positive: %d' % months)
+
+    locale_types = WARMUP_LOCALE_TYPES
+    if 'WARMUP_LOCALE_TYPES' in environ:
+        locale_types = _SplitList(environ['WARMUP_LOCALE_TYPES'])
+        unknown = set(locale_types) - set(_LOCALE_TYPES)
+        if unknown:
+            raise ValueError('Unknown WARMUP_LOCALE_TYPES: %s'
+                             % ', '.join(sorted(unknown)))
+
+    city_countries = WARMUP_CITY_COUNTRIES
+    if 'WARMUP_CITY_COUNTRIES' in environ:
+        city_countries = _SplitList(environ['WARMUP_CITY_COUNTRIES']) or None
+
+    return {'metric_names': metric_names,
+            'months': months,
+            'locale_types': locale_types,
+            'city_countries': city_countries}
+
+
+def Warmup(metrics_manager, locales_manager, locale_finder,
+           metric_names=WARMUP_METRICS, months=WARMUP_MONTHS,
+           locale_types=WARMUP_LOCALE_TYPES,
+           city_countries=WARMUP_CITY_COUNTRIES, max_threads=WARMUP_THREADS):
+    """Loads the API Server's caches.
+
+    Each locale scope (see metrics.DetermineLocaleScope()) of the warmed
+    locale types is loaded, so cities are loaded for every country, or for
+    each of 'city_countries'.
+
+    Failures are logged rather than raised, since a partially warmed instance
+    can still serve.
+
+    Args:
+        metrics_manager (MetricsManager object): Metrics manager.
+        locales_manager (LocalesManager object): Locale manager.
+        locale_finder (LocaleFinder object): Locale finder.
+        metric_names (list): Metrics to warm, or None for all metrics.
+        months (int): Number of most recent months of data to warm for each
+            metric.
+        locale_types (list): Locale types whose metric data is warmed.
+        city_countries (list): Countries whose cities are warmed, or None for
+            all countries.
+        max_threads (int): Maximum number of concurrent backend loads.
+
+    Returns:
+        (dict) A summary of the warmup.  Specifically,
+        { 'seconds': (float) <time taken>,
+          'loads': (int) <number of metric data loads>,
+          'errors': (int) <number of failed loads> }
+    """
+    start_time = datetime.now()
+
+    # Metric definitions and locales are independent, so load them
+    # concurrently.
+    def LoadDefinitions(load_fn):
+        try:
+            return load_fn()
+        except (locales.Error, metrics.Error) as e:
+            logging.error('Warmup failed to load definitions: %s' % e)
+            return None
+
+    metric_infos, _ = parallel.Map(LoadDefinitions, (
+        metrics_manager.MetricNames,
+        lambda: locales_manager.LocalesByType('country')), max_threads)
+
+    # The GeoTrees are built from the locales just loaded, rather than loading
+    # them again, while metric data loads.
+    tree_builder = threading.Thread(target=_BuildTrees,
+                                    args=(locale_finder, locales_manager))
+    tree_builder.start()
+
+    if metric_names is None:
+        metric_names = metric_infos or []
+
+    # One load per metric and locale scope pulls every month at once.
+    loads = []
+    examples = []
+    for locale_type in locale_types:
+        examples.extend(_ExampleLocales(locales_manager, locale_type,
+                                        city_countries))
+    for metric in metric_names:
+        for locale in examples:
+            loads.append((metric, locale))
+
+    def LoadData(load):
+        metric, locale = load
+        try:
+            dates = _RecentDates(metrics_manager, metric, months)
+            if dates:
+                metrics_manager.LookupRange(metric, dates[0], dates[-1],
+                                            locale)
+            return True
+        except (KeyError, metrics.Error) as e:
+            logging.error('Warmup failed to load %s for %s: %s'
+                          % (metric, locale, e))
+            return False
+
+    results = parallel.Map(LoadData, loads, max_threads)
+    tree_builder.join()
+
+    summary = {'seconds': (datetime.now() - start_time).total_seconds(),
+               'loads': len(results),
+               'errors': results.count(False)}
+    logging.info('Warmup loaded %d metrics (%d loads, %d errors) in %.2fs.'
+                 % (len(metric_names), summary['loads'], summary['errors'],
+                    summary['seconds']))
+    return summary
+
+
+def _BuildTrees(locale_finder, locales_manager):
+    """Builds the locale finder's GeoTrees from the locale manager's locales,
+    unless the finder's are already as recent, eg from a snapshot.
+    """
+    locales_time = locales_manager.LastRefreshTime()
+    trees_time = locale_finder.LastRefreshTime()
+    if locales_time is None or (trees_time is not None and
+                                trees_time >= locales_time):
+        return
+
+    try:
+        locale_finder.BuildTrees(locales_manager)
+    except (KeyError, locales.Error) as e:
+        logging.error('Warmup failed to build the GeoTrees: %s' % e)
+
+
+def _ExampleLocales(locales_manager, locale_type, city_countries=None):
+    """Picks one locale of the given type from each of its locale scopes,
+    whose scopes will be loaded.
+
+    Args:
+        locales_manager (LocalesManager object): Locale manager.
+        locale_type (string): Locale type.
+        city_countries (list): If provided, only cities of these countries
+            are picked.
+
+    Returns:
+        (list) A locale from each scope of the type, in order.
+    """
+    try:
+        locale_names = locales_manager.LocalesByType(locale_type)
+    except (KeyError, locales.Error):
+        return []
+
+    if locale_type == 'city' and city_countries is not None:
+        prefixes = tuple('%s_' % country for country in city_countries)
+        locale_names = [name for name in locale_names
+                        if name.startswith(prefixes)]
+
+    examples = {}
+    for name in locale_names:
+        try:
+            examples.setdefault(metrics.DetermineLocaleScope(name), name)
+        except KeyError:  # Malformed locale.
+            continue
+    return sorted(examples.itervalues())
+
+
+def _RecentDates(metrics_manager, metric, months):
+    """Determines the most recent months of data for a metric.
+
+    Returns:
+        (list) Up to 'months' of the most recent months with data, as tuples
+        of ints (year, month), in order.
+    """
+    existing_dates = metrics_manager.ExistingDates(metric)
+    if existing_dates is None:  # The backend can't tell, so assume all.
+        today = date.today()
+        end = (today.year, today.month)
+        start = (today.year - (months + 11 - today.month) // 12,
+                 (today.month - months) % 12 + 1)
+        existing_dates = metrics.MonthRange(start, end)
+
+    return sorted(existing_dates)[-months:]
+
+
+def _SplitList(value):
+    """Splits a comma separated list, dropping empty items.
+
+    Returns:
+        (list) The items, stripped of whitespace.
+    """
+    return [item.strip() for item in value.split(',') if item.strip()]
@@ -66,7 +66,7 @@ class Backend(object):
     """
     def SetClientHTTP(self, http):
         pass
-    def ExistingDates(self):
+    def ExistingDates(self, metric_name=None):
         pass
 
     def DeleteMetricInfo(self, metric_name):
@@ -81,7 +81,14 @@ class Backend(object):
 
     def DeleteMetricData(self, metric_name, date=None):
         pass
-    def GetMetricData(self, metric_name, date, locale):
+    def GetMetricData(self, metric_name, date, locale_type=None,
+                      locale_prefix=None):
+        pass
+    def GetMetricDataRange(self, metric_name, start, end, locale_type=None,
+                           locale_prefix=None):
+        pass
+    def IterMetricDataRange(self, metric_name, start, end, locale_type=None,
+                            locale_prefix=None):
         pass
     def SetMetricData(self, metric_name, date, locale, value):
         pass
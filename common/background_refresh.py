@@ -0,0 +1,159 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Author: Dylan Curley
+
+"""This module runs cache refreshes in the background, off the request path.
+
+Cache managers keep serving their current snapshot of data while a refresh
+builds a new snapshot.  The manager swaps in the new snapshot when it's
+complete.  If the refresh fails, the error is logged and the manager keeps
+serving its last good snapshot.
+
+Caches are held per instance, so each instance must refresh its own.  On
+AppEngine a frontend request doesn't complete until the threads it started
+have finished, so a refresh started while handling a request wrapped by
+Middleware is deferred until that request's response is complete, and then
+run on the same instance.  Elsewhere, eg in tools and benchmarks, refreshes
+run in threads.  Either way each refresher runs at most one refresh at a time.
+"""
+
+from datetime import datetime
+from datetime import timedelta
+import logging
+import threading
+
+# Minimum time between refresh attempts, so that a failing backend isn't
+# hammered with a refresh on every request.
+RETRY_DELAY = timedelta(minutes=5)
+
+# Refreshers deferred until the current request's response is complete.  Set
+# only while Middleware is handling a request.
+_local = threading.local()
+
+
+class BackgroundRefresher(object):
+    """Runs a refresh function in the background, one run at a time.
+    """
+    def __init__(self, name, refresh_fn):
+        """Constructor.
+
+        Args:
+            name (string): Name of the data being refreshed, for logging.
+            refresh_fn (function): Called with no arguments to refresh the data.
+                It should build and swap in a new snapshot of the data, and
+                raise an exception if it can't.
+        """
+        self._name = name
+        self._refresh_fn = refresh_fn
+        self._lock = threading.Lock()
+        self._running = False
+        self._last_attempt = datetime.fromtimestamp(0)
+
+    def Start(self):
+        """Starts a background refresh, unless one is already running or the
+        last attempt was less than 'RETRY_DELAY' ago.
+
+        While Middleware is handling a request, the refresh is deferred until
+        the request's response is complete instead.
+
+        Returns:
+            (bool) True if a refresh was started or deferred, otherwise False.
+        """
+        with self._lock:
+            if self._running:
+                return False
+            if datetime.now() - self._last_attempt < RETRY_DELAY:
+                return False
+            self._last_attempt = datetime.now()
+            self._running = True
+
+        deferred = getattr(_local, 'deferred', None)
+        if deferred is not None:
+            deferred.append(self)
+            return True
+
+        thread = threading.Thread(target=self._Run,
+                                  name='refresh-%s' % self._name)
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _Run(self):
+        """Runs the refresh function, logging any error it raises.
+
+        Returns:
+            (bool) True if the refresh succeeded, otherwise False.
+        """
+        start_time = datetime.now()
+        try:
+            self._refresh_fn()
+        except Exception as e:
+            logging.error('Background refresh of %s failed, keeping the last'
+                          ' good data: %s' % (self._name, e))
+            return False
+        finally:
+            with self._lock:
+                self._running = False
+
+        logging.info('Background refresh of %s completed in %s.'
+                     % (self._name, datetime.now() - start_time))
+        return True
+
+
+class Middleware(object):
+    """WSGI middleware running the refreshes started while handling a request
+    once the request's response is complete.
+
+    It should wrap any other middleware, so that refreshes aren't counted as
+    part of the request.
+    """
+    def __init__(self, app):
+        """Constructor.
+
+        Args:
+            app (WSGI application): The application.
+        """
+        self._app = app
+
+    def __call__(self, environ, start_response):
+        _local.deferred = []
+        try:
+            body = self._app(environ, start_response)
+        except:
+            self._RunDeferred()
+            raise
+        return self._PassThrough(body)
+
+    def _PassThrough(self, body):
+        """Passes through the response body, then runs deferred refreshes.
+
+        Yields:
+            (string) Chunks of the response body.
+        """
+        try:
+            for chunk in body:
+                yield chunk
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            self._RunDeferred()
+
+    def _RunDeferred(self):
+        """Runs the refreshes deferred by the current request, in order.
+        """
+        deferred = getattr(_local, 'deferred', None) or []
+        _local.deferred = None
+        for refresher in deferred:
+            refresher._Run()
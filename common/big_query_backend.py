@@ -37,6 +37,14 @@ METADATA_TABLE = 'definitions'
 DATE_TABLES_RE = r'^([1-9][0-9]{3})_([0-9]{2})$'
 DATE_TABLES_FMT = r'%04d_%02d'
 
+# Regular expressions matching the locale names of each locale type.
+_LOCALE_TYPE_RES = {
+    'world': r'^world$',
+    'country': r'^[^_]+$',
+    'region': r'^[^_]+_[^_]+$',
+    'city': r'^[^_]+_[^_]+_[^_]+$',
+}
+
 class QueryResults():
     """A query results generator, parseable by methods Rows() and ColumnNames().
     """
@@ -155,9 +163,13 @@ class BigQueryBackend(backend.Backend):
         """
         return QueryResults(self._bigquery, query)
 
-    def ExistingDates(self):
+    def ExistingDates(self, metric_name=None):
         """Retrieves a list of existing months.
 
+        Args:
+            metric_name (string): Ignored.  The raw data in BigQuery is shared
+                by all metrics, so the same months exist for each.
+
         Returns:
             (list) A list of datetime.date objects, one for each month that data
             exists in BigQuery.
@@ -248,13 +260,17 @@ class BigQueryBackend(backend.Backend):
         """
         pass
 
-    def GetMetricData(self, metric_name, date, locale):
-        """Retrieves data for this metric for the given 'date' and 'locale'.
+    def GetMetricData(self, metric_name, date, locale_type=None,
+                      locale_prefix=None):
+        """Retrieves data for this metric for the given 'date' and locales.
 
         Args:
             date (tuple): Date for which data should be loaded, given as a tuple
                 consisting of ints (year, month).
-            locale (string): Locale for which data should be loaded.
+            locale_type (string): If provided, only data for locales of this
+                type ('world', 'country', 'region', or 'city') is loaded.
+            locale_prefix (string): If provided, only data for locales whose
+                names start with this prefix is loaded, eg '840_'.
 
         Raises:
             backend.LoadError: The requested metric data could not be read. This
@@ -268,6 +284,41 @@ class BigQueryBackend(backend.Backend):
                  '  FROM %s.%s'
                  ' WHERE date = "%s"' %
                  (self._bigquery.dataset, metric_name, '%d-%02d' % date))
+        query += _LocaleConditions(locale_type, locale_prefix)
+
+        try:
+            result = self._bigquery.Query(query)
+        except big_query_client.Error as e:
+            raise backend.LoadError('Could not load metric data for "%s" from'
+                                    ' BigQuery: %s' % (metric_name, e))
+        return result
+
+    def GetMetricDataRange(self, metric_name, start, end, locale_type=None,
+                           locale_prefix=None):
+        """Retrieves data for this metric for a range of dates and locales.
+
+        Args:
+            start (tuple): First date for which data should be loaded, given as
+                a tuple consisting of ints (year, month).
+            end (tuple): Last date for which data should be loaded, inclusive.
+            locale_type (string): If provided, only data for locales of this
+                type ('world', 'country', 'region', or 'city') is loaded.
+            locale_prefix (string): If provided, only data for locales whose
+                names start with this prefix is loaded, eg '840_'.
+
+        Raises:
+            backend.LoadError: The requested metric data could not be read.
+
+        Returns:
+            (dict) Result data from the query, with keys "date", "locale", and
+            "value".
+        """
+        query = ('SELECT date, locale, value'
+                 '  FROM %s.%s'
+                 ' WHERE date >= "%s" AND date <= "%s"' %
+                 (self._bigquery.dataset, metric_name, '%d-%02d' % start,
+                  '%d-%02d' % end))
+        query += _LocaleConditions(locale_type, locale_prefix)
 
         try:
             result = self._bigquery.Query(query)
@@ -276,6 +327,54 @@ class BigQueryBackend(backend.Backend):
                                     ' BigQuery: %s' % (metric_name, e))
         return result
 
+    def IterMetricDataRange(self, metric_name, start, end, locale_type=None,
+                            locale_prefix=None):
+        """Generates data for this metric for a range of dates and locales.
+
+        Like GetMetricDataRange(), but rows are streamed from BigQuery a page
+        at a time rather than loaded all at once.  Rows are in no particular
+        order.
+
+        Args:
+            start (tuple): First date for which data should be loaded, given as
+                a tuple consisting of ints (year, month).
+            end (tuple): Last date for which data should be loaded, inclusive.
+            locale_type (string): If provided, only data for locales of this
+                type ('world', 'country', 'region', or 'city') is loaded.
+            locale_prefix (string): If provided, only data for locales whose
+                names start with this prefix is loaded, eg '840_'.
+
+        Raises:
+            backend.LoadError: There was an error issuing the query.
+
+        Returns:
+            (generator) Rows of result data, each a list [date, locale, value].
+            The generator raises backend.LoadError if BigQuery fails while it's
+            being iterated.
+        """
+        query = ('SELECT date, locale, value'
+                 '  FROM %s.%s'
+                 ' WHERE date >= "%s" AND date <= "%s"' %
+                 (self._bigquery.dataset, metric_name, '%d-%02d' % start,
+                  '%d-%02d' % end))
+        query += _LocaleConditions(locale_type, locale_prefix)
+
+        try:
+            results = self.RawQuery(query)
+        except (backend.QueryError, big_query_client.Error) as e:
+            raise backend.LoadError('Could not load metric data for "%s" from'
+                                    ' BigQuery: %s' % (metric_name, e))
+
+        def Rows():
+            try:
+                for row in results.Rows():
+                    yield row
+            except (backend.QueryError, big_query_client.Error) as e:
+                raise backend.LoadError('Could not load metric data for "%s"'
+                                        ' from BigQuery: %s' % (metric_name, e))
+
+        return Rows()
+
     def DeleteMetricData(self, metric_name, date):
         """Deletes data for this metric for the given 'date'.
 
@@ -329,3 +428,28 @@ class BigQueryBackend(backend.Backend):
                 dates[datetime.date(year, month, 1)] = table
 
         return dates
+
+
+def _LocaleConditions(locale_type, locale_prefix):
+    """Builds conditions restricting a query to the requested locales.
+
+    Args:
+        locale_type (string): Locale type to select, or None for all types.
+        locale_prefix (string): Locale name prefix to select, or None for all
+            locale names.
+
+    Returns:
+        (string) Conditions to be appended to a query's WHERE clause.  Empty if
+        neither 'locale_type' nor 'locale_prefix' is given.
+    """
+    conditions = ''
+    if locale_type is not None:
+        conditions += (' AND REGEXP_MATCH(locale, r"%s")' %
+                       _LOCALE_TYPE_RES[locale_type])
+        if locale_type == 'country':
+            conditions += ' AND locale != "world"'
+    if locale_prefix is not None:
+        escaped = locale_prefix.replace('\\', '\\\\').replace('"', '\\"')
+        conditions += (' AND LEFT(locale, %d) = "%s"' %
+                       (len(locale_prefix), escaped))
+    return conditions
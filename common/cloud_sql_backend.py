@@ -23,6 +23,8 @@ that define specific details of the CloudSQL instance and its interactions.
 import logging
 import pprint
 
+from google.appengine.api import rdbms
+
 import backend
 from metrics import DetermineLocaleType
 
@@ -33,6 +35,15 @@ LOCALES_TABLE = 'locales'
 METADATA_TABLE = 'definitions'
 SAMPLE_METRIC_TABLE = 'num_of_clients'  # Expect 'num_of_clients' metric exists.
 
+# SQL conditions selecting the locales of each locale type, based on the number
+# of '_' separators in the locale name.
+_LOCALE_TYPE_CONDITIONS = {
+    'world': 'locale = "world"',
+    'country': 'locale != "world" AND locale NOT LIKE "%\\_%"',
+    'region': 'locale LIKE "%\\_%" AND locale NOT LIKE "%\\_%\\_%"',
+    'city': 'locale LIKE "%\\_%\\_%"',
+}
+
 
 class CloudSQLBackend(backend.Backend):
     """CloudSQL backend interface honoring the backend.Backend abstraction.
@@ -58,6 +69,9 @@ class CloudSQLBackend(backend.Backend):
             metric_name (string): The metric/table to query dates for. Defualts
                 to the global 'SAMPLE_METRIC_TABLE'.
 
+        Raises:
+            backend.LoadError: The months could not be read from CloudSQL.
+
         Returns:
             (list) A list of strings, each one containing a month in the format
             'YYYY_MM' for which data exists for the specified metric name.
@@ -65,7 +79,11 @@ class CloudSQLBackend(backend.Backend):
         query = ('SELECT DISTINCT date'
                  '  FROM %s' % metric_name)
 
-        dates = self._cloudsql.Query(query)
+        try:
+            dates = self._cloudsql.Query(query)
+        except rdbms.Error as e:
+            raise backend.LoadError('Could not load existing dates for "%s"'
+                                    ' from CloudSQL: %s' % (metric_name, e))
         return tuple(d[0] for d in dates['data'])
 
     def DeleteMetricInfo(self, metric_name):
@@ -170,13 +188,17 @@ class CloudSQLBackend(backend.Backend):
                  % metric_name)
         self._cloudsql.Query(query)
 
-    def GetMetricData(self, metric_name, date, locale):
-        """Retrieves data for this metric for the given 'date' and 'locale'.
+    def GetMetricData(self, metric_name, date, locale_type=None,
+                      locale_prefix=None):
+        """Retrieves data for this metric for the given 'date' and locales.
 
         Args:
             date (tuple): Date for which data should be loaded, given as a tuple
                 consisting of ints (year, month).
-            locale (string): Locale for which data should be loaded.
+            locale_type (string): If provided, only data for locales of this
+                type ('world', 'country', 'region', or 'city') is loaded.
+            locale_prefix (string): If provided, only data for locales whose
+                names start with this prefix is loaded, eg '840_'.
 
         Returns:
             (dict) Result data from the query, with keys "locale" and "value".
@@ -185,8 +207,73 @@ class CloudSQLBackend(backend.Backend):
                  '  FROM %s'
                  ' WHERE date="%s"' %
                  (metric_name, '%4d-%02d-01' % date))
+        query += _LocaleConditions(locale_type, locale_prefix)
+        return self._cloudsql.Query(query)
+
+    def GetMetricDataRange(self, metric_name, start, end, locale_type=None,
+                           locale_prefix=None):
+        """Retrieves data for this metric for a range of dates and locales.
+
+        Args:
+            start (tuple): First date for which data should be loaded, given as
+                a tuple consisting of ints (year, month).
+            end (tuple): Last date for which data should be loaded, inclusive.
+            locale_type (string): If provided, only data for locales of this
+                type ('world', 'country', 'region', or 'city') is loaded.
+            locale_prefix (string): If provided, only data for locales whose
+                names start with this prefix is loaded, eg '840_'.
+
+        Returns:
+            (dict) Result data from the query, with keys "date", "locale", and
+            "value".
+        """
+        query = ('SELECT date, locale, value'
+                 '  FROM %s'
+                 ' WHERE date BETWEEN "%s" AND "%s"' %
+                 (metric_name, '%4d-%02d-01' % start, '%4d-%02d-01' % end))
+        query += _LocaleConditions(locale_type, locale_prefix)
         return self._cloudsql.Query(query)
 
+    def IterMetricDataRange(self, metric_name, start, end, locale_type=None,
+                            locale_prefix=None):
+        """Generates data for this metric for a range of dates and locales.
+
+        Like GetMetricDataRange(), but rows are streamed from CloudSQL as they
+        arrive, in order of date and locale, rather than loaded all at once.
+
+        Args:
+            start (tuple): First date for which data should be loaded, given as
+                a tuple consisting of ints (year, month).
+            end (tuple): Last date for which data should be loaded, inclusive.
+            locale_type (string): If provided, only data for locales of this
+                type ('world', 'country', 'region', or 'city') is loaded.
+            locale_prefix (string): If provided, only data for locales whose
+                names start with this prefix is loaded, eg '840_'.
+
+        Returns:
+            (generator) Rows of result data, each a tuple (date, locale, value).
+            The generator raises backend.LoadError if CloudSQL fails while it's
+            being iterated.
+        """
+        query = ('SELECT date, locale, value'
+                 '  FROM %s'
+                 ' WHERE date BETWEEN "%s" AND "%s"' %
+                 (metric_name, '%4d-%02d-01' % start, '%4d-%02d-01' % end))
+        query += _LocaleConditions(locale_type, locale_prefix)
+        query += ' ORDER BY date, locale'
+
+        # The query is only issued once iteration starts, so connection errors
+        # are raised mid-stream too.
+        def Rows():
+            try:
+                for row in self._cloudsql.QueryIter(query):
+                    yield row
+            except rdbms.Error as e:
+                raise backend.LoadError('Could not load metric data for "%s"'
+                                        ' from CloudSQL: %s' % (metric_name, e))
+
+        return Rows()
+
     def SetMetricData(self, metric_name, date, locale, value):
         """Sets data for this metric for the given 'date' and 'locale'.
 
@@ -314,3 +401,29 @@ class CloudSQLBackend(backend.Backend):
             self._city_ids_by_name[locale] = city_id['data'][0][0]
 
         return True
+
+
+def _LocaleConditions(locale_type, locale_prefix):
+    """Builds SQL conditions restricting a query to the requested locales.
+
+    Args:
+        locale_type (string): Locale type to select, or None for all types.
+        locale_prefix (string): Locale name prefix to select, or None for all
+            locale names.
+
+    Returns:
+        (string) Conditions to be appended to a query's WHERE clause.  Empty if
+        neither 'locale_type' nor 'locale_prefix' is given.
+    """
+    conditions = ''
+    if locale_type is not None:
+        conditions += ' AND %s' % _LOCALE_TYPE_CONDITIONS[locale_type]
+    if locale_prefix is not None:
+        # Backslashes are unescaped once by the string literal and once more by
+        # LIKE, so they're escaped twice.
+        escaped = (locale_prefix.replace('\\', '\\\\\\\\')
+                   .replace('"', '\\"')
+                   .replace('%', '\\%')
+                   .replace('_', '\\_'))
+        conditions += ' AND locale LIKE "%s%%"' % escaped
+    return conditions
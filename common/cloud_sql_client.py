@@ -70,6 +70,33 @@ class CloudSQLClient(object):
         conn.close()
         return result
 
+    def QueryIter(self, query, batch_size=1000):
+        """Issues a query to CloudSQL, generating result rows as they arrive.
+
+        Rows are fetched from the server 'batch_size' at a time, so the full
+        result is never held in memory.  The connection stays open until the
+        generator is exhausted or closed.
+
+        Args:
+            query (string): The query to be issued.  It should be a SELECT.
+            batch_size (int): Number of rows fetched from the server at a time.
+
+        Yields:
+            (tuple) One row of result data.
+        """
+        conn = rdbms.connect(instance=self._instance, database=self._database)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            conn.close()
+
     def Update(self, table_name, metric_name, data):
         """Updates data for a given table and metric name.
 
@@ -0,0 +1,308 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Author: Dylan Curley
+
+"""This module contains an array-backed KD-Tree for nearest neighbor search.
+
+The tree is stored in flat arrays rather than as linked node objects: the
+coordinates of every point in one contiguous buffer of doubles, and the split
+axis, split value, and child indices of every node in parallel arrays.
+Building and searching are iterative, with explicit stacks, so neither is
+limited by the recursion depth.
+
+Each node splits its points at their median along one axis, until at most
+'LEAF_SIZE' points remain, which are kept together in a leaf and scanned
+linearly.  Leaves cut the number of nodes, and so the per-node overhead of
+both building and searching, by about 'LEAF_SIZE' times.  The median is found
+by sorting each node's points, so building takes O(n log^2 n) time rather than
+the O(n log n) of presorting.
+
+Besides the single nearest point, the tree can find the 'count' nearest points
+within some distance, which covers both k-nearest and fixed radius searches.
+"""
+
+import array
+import heapq
+import math
+
+# Maximum number of points held in a leaf.
+LEAF_SIZE = 8
+
+# Split axis marking a node as a leaf.
+_LEAF = -1
+
+
+class KDTree(object):
+    """A tree for nearest neighbor search in a k-dimensional space.
+
+    Node i is a leaf if _axes[i] is _LEAF, in which case it holds points
+    _left[i] to _right[i] - 1.  Otherwise its children are nodes _left[i] and
+    _right[i], which hold the points no larger and no smaller than _splits[i]
+    along axis _axes[i], respectively.  The root is node 0.
+
+    After construction KDTree is immutable, so it can be searched from several
+    threads at once.
+    """
+    def __init__(self, k, objects):
+        """Constructor.
+
+        Args:
+            k (int): Number of dimensions.
+            objects (list): Points to be searched, as (point, label) tuples,
+                where 'point' is a tuple of 'k' numbers and 'label' is any
+                object identifying the point.
+        """
+        objects = list(objects)
+        self._k = k
+        self._coords = array.array('d')  # Point i at [i * k, (i + 1) * k).
+        self._labels = []
+        self._axes = array.array('b')
+        self._splits = array.array('d')
+        self._left = array.array('i')
+        self._right = array.array('i')
+
+        if not objects:
+            return
+
+        # Coordinates of the input points along each axis, by input index.
+        values = [array.array('d', [o[0][axis] for o in objects])
+                  for axis in xrange(k)]
+
+        # Nodes are numbered in the order they're built.  Each stack item is
+        # (input indices, depth, parent node, is left).
+        stack = [(range(len(objects)), 0, None, False)]
+        while stack:
+            items, depth, parent, is_left = stack.pop()
+
+            node = len(self._axes)
+            if parent is not None:
+                if is_left:
+                    self._left[parent] = node
+                else:
+                    self._right[parent] = node
+
+            if len(items) <= LEAF_SIZE:
+                self._axes.append(_LEAF)
+                self._splits.append(0.0)
+                self._left.append(len(self._labels))
+                self._right.append(len(self._labels) + len(items))
+                for i in items:
+                    self._coords.extend(objects[i][0])
+                    self._labels.append(objects[i][1])
+                continue
+
+            # Sorting each node costs O(n log n) per level, but runs in C,
+            # keyed by a C accessor.  Under CPython that beats presorting each
+            # axis once and partitioning per level, even with itertools, for
+            # any tree that fits in memory.
+            axis = depth % k
+            items.sort(key=values[axis].__getitem__)
+            mid = len(items) // 2
+
+            self._axes.append(axis)
+            self._splits.append(values[axis][items[mid]])
+            self._left.append(_LEAF)  # Set when the children are built.
+            self._right.append(_LEAF)
+            stack.append((items[mid:], depth + 1, node, False))
+            stack.append((items[:mid], depth + 1, node, True))
+
+    def __len__(self):
+        return len(self._labels)
+
+    def Arrays(self):
+        """Retrieves the arrays the tree is stored in, eg to save it.
+
+        Returns:
+            (dict) The arrays 'coords', 'axes', 'splits', 'left', and 'right'
+            (see the class docstring), and the list 'labels', from which
+            FromArrays() restores the tree without rebuilding it.
+        """
+        return {'coords': self._coords,
+                'labels': self._labels,
+                'axes': self._axes,
+                'splits': self._splits,
+                'left': self._left,
+                'right': self._right}
+
+    def NearestNeighbor(self, point):
+        """Finds the point in the tree nearest to a given point.
+
+        Args:
+            point (tuple): Point of interest, as 'k' numbers.
+
+        Returns:
+            (tuple) Three items (point, label, distance), where 'point' and
+            'label' identify the nearest point in the tree and 'distance' is
+            its euclidean distance from the point of interest.  If the tree is
+            empty, (None, None, inf).
+        """
+        if not self._labels:
+            return (None, None, float('inf'))
+
+        k = self._k
+        coords = self._coords
+        axes = self._axes
+        splits = self._splits
+        left = self._left
+        right = self._right
+        dimensions = range(k)
+
+        best = -1
+        best_distance = float('inf')  # Squared.
+
+        # Each stack item is (node, lower bound on the squared distance to any
+        # point in the node).  The near side of each split is searched first,
+        # without a trip through the stack.
+        stack = [(0, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            while bound < best_distance:
+                axis = axes[node]
+                if axis == _LEAF:
+                    for i in xrange(left[node], right[node]):
+                        base = i * k
+                        distance = 0.0
+                        for d in dimensions:
+                            diff = coords[base + d] - point[d]
+                            distance += diff * diff
+                        if distance < best_distance:
+                            best = i
+                            best_distance = distance
+                    break
+
+                diff = point[axis] - splits[node]
+                if diff < 0:
+                    node, far = left[node], right[node]
+                else:
+                    node, far = right[node], left[node]
+                # Points across the split are at least 'diff' away along
+                # 'axis'.
+                stack.append((far, max(bound, diff * diff)))
+
+        return (tuple(coords[best * k:(best + 1) * k]), self._labels[best],
+                math.sqrt(best_distance))
+
+    def NearestNeighborOfEach(self, points):
+        """Finds the point in the tree nearest to each of several points.
+
+        This is a loop over NearestNeighbor(), one independent search per
+        point, which only saves callers the method lookup per point.
+
+        Args:
+            points (list): Points of interest, each as 'k' numbers.
+
+        Returns:
+            (list) The nearest point to each point of interest, in order, each
+            as returned by NearestNeighbor().
+        """
+        nearest_neighbor = self.NearestNeighbor
+        return [nearest_neighbor(point) for point in points]
+
+    def KNearestNeighbors(self, point, count, max_distance=float('inf')):
+        """Finds the points in the tree nearest to a given point.
+
+        The search keeps the nearest points found so far in a heap of at most
+        'count' items, and once it's full prunes any node that can't hold a
+        point nearer than the farthest of them.  Until then, nodes farther than
+        'max_distance' are pruned.  So to find every point within some
+        distance, let 'count' be len(tree).
+
+        Args:
+            point (tuple): Point of interest, as 'k' numbers.
+            count (int): Maximum number of points to find.
+            max_distance (float): Maximum euclidean distance of the points to
+                find from the point of interest, inclusive.
+
+        Returns:
+            (list) Up to 'count' nearest points within 'max_distance' of the
+            point of interest, nearest first, each as returned by
+            NearestNeighbor().
+        """
+        if count < 1:
+            return []
+
+        k = self._k
+        coords = self._coords
+        axes = self._axes
+        splits = self._splits
+        left = self._left
+        right = self._right
+        dimensions = range(k)
+
+        # A max-heap of (-distance, index) of the nearest points so far.
+        nearest = []
+        limit = max_distance * max_distance  # Squared.
+
+        stack = [(0, 0.0)] if self._labels else []
+        while stack:
+            node, bound = stack.pop()
+            while bound <= limit:
+                axis = axes[node]
+                if axis == _LEAF:
+                    for i in xrange(left[node], right[node]):
+                        base = i * k
+                        distance = 0.0
+                        for d in dimensions:
+                            diff = coords[base + d] - point[d]
+                            distance += diff * diff
+                        if distance <= limit:
+                            if len(nearest) < count:
+                                heapq.heappush(nearest, (-distance, i))
+                            else:
+                                heapq.heapreplace(nearest, (-distance, i))
+                            if len(nearest) == count:
+                                limit = -nearest[0][0]
+                    break
+
+                diff = point[axis] - splits[node]
+                if diff < 0:
+                    node, far = left[node], right[node]
+                else:
+                    node, far = right[node], left[node]
+                stack.append((far, max(bound, diff * diff)))
+
+        nearest.sort(reverse=True)
+        return [(tuple(coords[i * k:(i + 1) * k]), self._labels[i],
+                 math.sqrt(-distance)) for (distance, i) in nearest]
+
+
+def FromArrays(k, arrays):
+    """Restores a KDTree from the arrays it was stored in.
+
+    Args:
+        k (int): Number of dimensions.
+        arrays (dict): The tree's arrays, as returned by KDTree.Arrays(), with
+            the same array typecodes.
+
+    Raises:
+        ValueError: The arrays don't describe a tree of 'k' dimensions.
+
+    Returns:
+        (KDTree) The restored tree.
+    """
+    tree = KDTree(k, [])
+    tree._coords = arrays['coords']
+    tree._labels = list(arrays['labels'])
+    tree._axes = arrays['axes']
+    tree._splits = arrays['splits']
+    tree._left = arrays['left']
+    tree._right = arrays['right']
+
+    nodes = len(tree._axes)
+    if (len(tree._coords) != k * len(tree._labels) or
+        len(tree._splits) != nodes or len(tree._left) != nodes or
+        len(tree._right) != nodes or (tree._labels and not nodes)):
+        raise ValueError('Arrays of mismatched lengths for a %d-d tree.' % k)
+    return tree
@@ -23,12 +23,25 @@ import logging
 import math
 import os
 
+import background_refresh
 import backend as backend_interface
-from deps.kdtree import KDTree
+import kd_tree
+import lru_cache
+
+try:
+    import numpy
+except ImportError:  # Coordinates are converted one at a time without numpy.
+    numpy = None
 
 # Timeout when cached locales should be considered old.
 LOCALE_REFRESH_RATE = timedelta(days=2)
 
+# Mean radius of the Earth, used for great-circle distances.
+EARTH_RADIUS_KM = 6371.0
+
+# Locale types that LocaleFinder searches, each in its own GeoTree.
+NEAREST_LOCALE_TYPES = ('country', 'region', 'city')
+
 
 class Error(Exception):
     """Common exception that all other exceptions in this module inherit from.
@@ -75,18 +88,35 @@ class Locale(object):
 
 class LocalesManager(object):
     """Manage locale data, specifically hiding the details of data caching.
+
+    Locale data is refreshed every 'LOCALE_REFRESH_RATE'.  Only the first
+    refresh is done synchronously; later ones build a new snapshot of the
+    locales in the background while the current snapshot is served.
+
+    Members:
+        hits (int): Number of lookups of locales that exist.
+        misses (int): Number of lookups of locales that don't exist.
     """
-    def __init__(self, backend):
+    def __init__(self, backend, locale_index=None):
         """Constructor.
 
         Args:
             backend (Backend object): Datastore backend.
+            locale_index (LocaleIndex object): If provided, every locale is
+                assigned an ordinal in this index when locales are refreshed,
+                so that metric data indexed by it is laid out in locale order.
         """
         self.disable_refresh = False
+        self.hits = 0
+        self.misses = 0
         self._backend = backend
+        self._locale_index = locale_index
         self._locales = None
         self._locales_by_type = None
+        self._bytes = 0  # Estimated size of the locales.
         self._last_refresh = datetime.fromtimestamp(0)
+        self._refresher = background_refresh.BackgroundRefresher(
+            'locales', self._RefreshNow)
 
     def Exists(self, locale):
         """Whether or not a given locale exists.
@@ -101,7 +131,12 @@ class LocalesManager(object):
             (bool) True if the locale exists and can be queried, otherwise false.
         """
         self._Refresh()
-        return locale in self._locales
+        # Counters aren't locked, so an increment may rarely be lost.
+        if locale in self._locales:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
 
     def Locale(self, locale):
         """Retrieves the given locale.
@@ -142,21 +177,108 @@ class LocalesManager(object):
 
         return self._locales_by_type[locale_type]
 
+    def CacheStats(self):
+        """Retrieves usage statistics for the locale data.
+
+        Locales are replaced all at once by a refresh, never evicted.
+
+        Returns:
+            (dict) Statistics, in the form returned by LRUCache.Stats().
+        """
+        locales = self._locales
+        return {'entries': 0 if locales is None else len(locales),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': 0}
+
+    def LastRefreshTime(self):
+        """Determines when the locale data being served was loaded.
+
+        Returns:
+            (datetime) When the locale data was last refreshed, or None if it
+            hasn't been loaded yet.
+        """
+        if self._locales is None:
+            return None
+        return self._last_refresh
+
     def ForceRefresh(self):
         """Forces a refresh of the internal locale data.
+
+        Unlike periodic refreshes, this refresh is done synchronously.
+
+        Raises:
+            RefreshError: An error occurred while refreshing the locale cache.
         """
-        self._last_refresh = datetime.fromtimestamp(0)
-        self._Refresh()
+        self._RefreshNow()
+
+    def LoadSnapshot(self, snapshot):
+        """Loads locale data from a snapshot, in place of a refresh.
+
+        The data is refreshed from the backend as usual once it's older than
+        'LOCALE_REFRESH_RATE', measured from when the snapshot was created.
+
+        Args:
+            snapshot (Snapshot object): Snapshot of locale data.
+        """
+        self.LoadRows(snapshot.locale_rows, snapshot.created)
+
+    def LoadRows(self, rows_by_type, load_time):
+        """Loads locale data from locale table rows, in place of a refresh.
+
+        Args:
+            rows_by_type (dict): Locale table rows, as returned in the 'data' of
+                Backend.GetLocaleData(), keyed by locale type.
+            load_time (datetime): When the rows were loaded.
+        """
+        self._BuildLocales(rows_by_type, load_time)
 
     def _Refresh(self):
         """Refreshes LocalesManager data at most every 'LOCALE_REFRESH_RATE'.
+
+        Raises:
+            RefreshError: An error occurred during the first refresh, so there
+                is no locale data to serve.
         """
         if self.disable_refresh:
             return
 
         if datetime.now() - self._last_refresh < LOCALE_REFRESH_RATE:
             return
- 
+
+        if self._locales is None:
+            self._RefreshNow()  # First refresh.  Nothing to serve until done.
+        else:
+            self._refresher.Start()
+
+    def _RefreshNow(self):
+        """Refreshes LocalesManager data, swapping in a new snapshot of the
+        locales when complete.
+
+        Raises:
+            RefreshError: An error occurred while refreshing the locale cache.
+                The current snapshot is left unchanged.
+        """
+        rows_by_type = {}
+        for locale_type in ('country', 'region', 'city'):
+            try:
+                info = self._backend.GetLocaleData(locale_type)
+            except backend_interface.LoadError as e:
+                logging.error('Failed to refresh locales: %s' % e)
+                raise RefreshError(e)
+            rows_by_type[locale_type] = info['data']
+
+        self._BuildLocales(rows_by_type, datetime.now())
+
+    def _BuildLocales(self, rows_by_type, load_time):
+        """Builds a new snapshot of the locales and swaps it in.
+
+        Args:
+            rows_by_type (dict): Locale table rows, as returned in the 'data' of
+                Backend.GetLocaleData(), keyed by locale type.
+            load_time (datetime): When the rows were loaded.
+        """
         # Start fresh, since locales may have been removed.
         locales_by_id = {}
         locales_by_type = {'world': ['world'], 'country': [], 'region': [], 'city': []}
@@ -165,15 +287,8 @@ class LocalesManager(object):
         # Build Locales in largest-to-smallest order so that parent references
         # can be resolved.
         for locale_type in ('country', 'region', 'city'):
-            try:
-                info = self._backend.GetLocaleData(locale_type)
-            except backend_interface.LoadError as e:
-                logging.error('Failed to refresh locales: %s' % e)
-                if self._locales is None:  # First refresh. Cannot fail silently.
-                    raise RefreshError(e)
- 
             # Parse and build Locales into the dict.
-            for row in info['data']:
+            for row in rows_by_type.get(locale_type, ()):
                 locale_id, locale, name, parent_id, lat, lon = row
                 locale_id = int(locale_id)
                 parent_id = int(parent_id)
@@ -193,10 +308,18 @@ class LocalesManager(object):
                 else:
                     locales[locale].parent = None
  
+        if self._locale_index is not None:
+            for locale_type in ('world', 'country', 'region', 'city'):
+                for locale in locales_by_type[locale_type]:
+                    self._locale_index.Assign(locale)
+
         # Update data members.
-        self._locales = locales
         self._locales_by_type = locales_by_type
-        self._last_refresh = datetime.now()
+        self._locales = locales
+        self._bytes = (lru_cache.EstimateSize(locales) +
+                       sum(lru_cache.EstimateSize(names)
+                           for names in locales_by_type.itervalues()))
+        self._last_refresh = load_time
 
 
 class LocaleFinder(object):
@@ -208,16 +331,32 @@ class LocaleFinder(object):
     is expected that locale data is provided as countries, regions, and cities,
     though this is not strictly necessary.
 
+    Each locale type is searched in its own GeoTree, built from that type's
+    own coordinates.  So the nearest region is the region whose coordinates are
+    nearest, not the region of the nearest city, and a search for countries
+    alone is over a tree of a few hundred countries rather than every city.
+
     Once the locale data has been catalogued, this class supports efficient
     lookup of nearest locales neighboring a given set of latitude and logitude
     coordinates.
+
+    Members:
+        hits (int): Number of lookups served by already built GeoTrees.
+        misses (int): Number of lookups that waited for the GeoTrees to be
+            built.
     """
     def __init__(self, backend):
         """Constructor.
         """
+        self.hits = 0
+        self.misses = 0
         self._backend = backend
-        self._cities = None
+        self._trees = None  # GeoTrees by locale type.
+        self._size = 0  # Number of locales in the GeoTrees.
+        self._bytes = 0  # Estimated size of the GeoTrees.
         self._last_refresh = datetime.fromtimestamp(0)
+        self._refresher = background_refresh.BackgroundRefresher(
+            'locale finder', self._RefreshNow)
 
     class GeoTree(object):
         """Tree that holds geographically located data.
@@ -234,24 +373,78 @@ class LocaleFinder(object):
         coordinates into Cartesian (3-D), and building a KD-Tree.  This allows
         relatively efficient lookup for finding the nearest neighbor to a given
         Lat-Lon coordinate.
+
+        Locales are placed on a sphere, so the straight line (chord) distance
+        between two of them grows with the great-circle distance between them.
+        Nearest by one is nearest by the other, and a great-circle radius is
+        searched as the equivalent chord length.
         """
-        def __init__(self, target_locales, locales_manager):
+        # Radius of the sphere locales are placed on, in cartesian units.
+        _R = (2 ** 31) - 1
+
+        def __init__(self, target_locales, locales_manager, tree_data=None):
             """Constructor.
 
             Args:
                 target_locales (list): List of locales to pull out of the passed
                     LocaleManager.
                 locale_manager (LocaleManager object): Locale manager.
+                tree_data (dict): If provided, the GeoTree is restored from this
+                    data, as returned by TreeData(), instead of being built
+                    from 'target_locales'.
+
+            Raises:
+                ValueError: 'tree_data' is malformed.
             """
-            self._data = []  # pairs of (coordinates, locale)
+            if tree_data is not None:
+                self._data = []
+                self._names = list(tree_data['names'])
+                self._tree = kd_tree.FromArrays(3, tree_data['arrays'])
+                return
 
+            self._data = []  # pairs of (coordinates, locale index)
+            self._names = []  # locale names, by locale index
+
+            unplaced = 0
             for tgt in target_locales:
                 locale = locales_manager.Locale(tgt)
+                if locale.latitude is None or locale.longitude is None:
+                    unplaced += 1
+                    continue
                 cart = self._LatLonToCartesian(locale.latitude, locale.longitude)
-                self._data.append((cart, tgt))
+                self._data.append((cart, len(self._names)))
+                self._names.append(tgt)
 
+            if unplaced:
+                logging.warning('GeoTree skipped %d locales without a latitude'
+                                ' and longitude.' % unplaced)
             self._ReportCollisions()
-            self._tree = KDTree(3, self._data)
+            self._tree = kd_tree.KDTree(3, self._data)
+
+        def __len__(self):
+            return len(self._names)
+
+        def EstimateSize(self):
+            """Estimates the number of bytes of memory used by the GeoTree.
+
+            Returns:
+                (int) Estimated size of the GeoTree, in bytes.
+            """
+            return (lru_cache.EstimateSize(self._names) +
+                    sum(lru_cache.EstimateSize(values)
+                        for values in self._tree.Arrays().itervalues()))
+
+        def TreeData(self):
+            """Retrieves the data the GeoTree is built from, eg to save it.
+
+            Returns:
+                (dict) The GeoTree's data, from which the constructor restores
+                it.  Specifically,
+                { 'names': (list) <locale names, by locale index>,
+                  'arrays': (dict) <KD-Tree arrays, as returned by
+                                    KDTree.Arrays()> }
+            """
+            return {'names': self._names, 'arrays': self._tree.Arrays()}
 
         def FindNearestNeighbor(self, lat, lon):
             """Finds the nearest neighbor to a given latitude & longitude.
@@ -262,18 +455,92 @@ class LocaleFinder(object):
 
             Returns:
                 (string) The name of the locale located closest to the given
-                latitude & longitude.
+                latitude & longitude, or None if the tree is empty.
             """
             cart = self._LatLonToCartesian(lat, lon)
-            _, locale, _ = self._tree.nearest_neighbor(cart)
-            return locale
+            _, index, _ = self._tree.NearestNeighbor(cart)
+            if index is None:
+                return None
+            return self._names[index]
+
+        def FindKNearestNeighbors(self, lat, lon, count, radius_km=None):
+            """Finds the nearest neighbors to a given latitude & longitude.
+
+            Args:
+                lat (float): Target latitude.
+                lon (float): Target longitude.
+                count (int): Maximum number of locales to find.
+                radius_km (float): If not None, only locales within this
+                    great-circle distance, in kilometers, are found.
+
+            Returns:
+                (list) Up to 'count' pairs (locale, distance) for the locales
+                located closest to the given latitude & longitude, nearest
+                first, where 'distance' is the great-circle distance in
+                kilometers.
+            """
+            max_chord = float('inf')
+            if radius_km is not None:
+                max_chord = self._KmToChord(radius_km)
+
+            cart = self._LatLonToCartesian(lat, lon)
+            return [(self._names[index], self._ChordToKm(chord))
+                    for (_, index, chord) in
+                    self._tree.KNearestNeighbors(cart, count, max_chord)]
+
+        def FindNearestNeighbors(self, lats, lons):
+            """Finds the nearest neighbor to each of many latitudes &
+            longitudes.
+
+            Args:
+                lats (list): Target latitudes, as floats.
+                lons (list): Target longitudes, as floats, in the same order.
+
+            Returns:
+                (list) The name of the locale located closest to each given
+                latitude & longitude, in order, or None for each if the tree
+                is empty.
+            """
+            if not self._names:
+                return [None] * len(lats)
+            names = self._names
+            return [names[index] for (_, index, _) in
+                    self._tree.NearestNeighborOfEach(
+                        self._LatLonsToCartesian(lats, lons))]
+
+        def _ChordToKm(self, chord):
+            """Translates a chord length to a great-circle distance.
+
+            Args:
+                chord (float): Straight line distance between two points on the
+                    sphere, in cartesian units.
+
+            Returns:
+                (float) Great-circle distance between the points, in kilometers.
+            """
+            half_angle = math.asin(min(1.0, chord / (2.0 * self._R)))
+            return 2.0 * half_angle * EARTH_RADIUS_KM
+
+        def _KmToChord(self, km):
+            """Translates a great-circle distance to a chord length.
+
+            Args:
+                km (float): Great-circle distance between two points, in
+                    kilometers.
+
+            Returns:
+                (float) Straight line distance between the points on the
+                sphere, in cartesian units.
+            """
+            half_angle = min(km / EARTH_RADIUS_KM, math.pi) / 2.0
+            return 2.0 * self._R * math.sin(half_angle)
 
         def _LatLonToCartesian(self, lat, lon):
             """Translates latitude & longitude to cartesian coordinates.
 
-            x = r sin(lat) cos(lon)
-            y = r sin(lat) sin(lon)
-            z = r cos(lat)
+            x = r cos(lat) cos(lon)
+            y = r cos(lat) sin(lon)
+            z = r sin(lat)
             
             To optimize so that we store in 4 byte integers, let r = 2**31 - 1.
             The more bytes we use the higher precision we get, but we want to
@@ -289,13 +556,47 @@ class LocaleFinder(object):
             lat = math.radians(lat)
             lon = math.radians(lon)
 
-            r = (2 ** 31) - 1
-            x = r * math.sin(lat) * math.cos(lon)
-            y = r * math.sin(lat) * math.sin(lon)
-            z = r * math.cos(lat)
+            r = self._R
+            x = r * math.cos(lat) * math.cos(lon)
+            y = r * math.cos(lat) * math.sin(lon)
+            z = r * math.sin(lat)
 
             return (int(x), int(y), int(z))
 
+        def _LatLonsToCartesian(self, lats, lons):
+            """Translates many latitudes & longitudes to cartesian
+            coordinates.
+
+            If numpy is available, all coordinates are converted in one
+            vectorized pass.  numpy's trigonometric functions may then differ
+            from math's in the last bit, so a coordinate may be one unit (a few
+            millimeters) off from _LatLonToCartesian()'s.  Otherwise the
+            coordinates are exactly _LatLonToCartesian()'s.
+
+            Args:
+                lats (list): Latitudes, as floats.
+                lons (list): Longitudes, as floats, in the same order.
+
+            Returns:
+                (list) 3-tuples representing x, y, z cartesian coordinates.
+            """
+            if numpy is None:
+                return [self._LatLonToCartesian(lat, lon)
+                        for (lat, lon) in zip(lats, lons)]
+
+            lats = numpy.radians(numpy.asarray(lats, dtype=numpy.float64))
+            lons = numpy.radians(numpy.asarray(lons, dtype=numpy.float64))
+
+            r = self._R
+            xs = r * numpy.cos(lats) * numpy.cos(lons)
+            ys = r * numpy.cos(lats) * numpy.sin(lons)
+            zs = r * numpy.sin(lats)
+
+            # Casting truncates toward zero, just like int().
+            return zip(xs.astype(numpy.int64).tolist(),
+                       ys.astype(numpy.int64).tolist(),
+                       zs.astype(numpy.int64).tolist())
+
         def _ReportCollisions(self):
             """Logs collisions between locales.
 
@@ -305,36 +606,179 @@ class LocaleFinder(object):
             This means that there could be two cities that collide at the same
             coordinates.
 
-            If collisions occur, one can increase the radius term 'r' in
-            _LatLonToCartesian(), which will increase precision.
+            If collisions occur, one can increase the radius term '_R', which
+            will increase precision.
             """
             collection = dict()
             for geo in self._data:
                 if geo[0] in collection:
                     logging.warning(
                         'GeoTree collision between "%s" and "%s".  Consider'
-                        'increasing the "r" term in _LatLonToCartesian().'
-                        % (collection[geo[0]], geo[1]))
+                        'increasing the "_R" term of GeoTree.'
+                        % (collection[geo[0]], self._names[geo[1]]))
                 else:
-                    collection[geo[0]] = geo[1]
+                    collection[geo[0]] = self._names[geo[1]]
+
+    def CacheStats(self):
+        """Retrieves usage statistics for the GeoTrees.
+
+        GeoTrees are replaced all at once by a refresh, never evicted.
+
+        Returns:
+            (dict) Statistics, in the form returned by LRUCache.Stats().
+        """
+        return {'entries': self._size,
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': 0}
+
+    def LastRefreshTime(self):
+        """Determines when the locale data being searched was loaded.
+
+        Returns:
+            (datetime) When the locale data was last refreshed, or None if it
+            hasn't been loaded yet.
+        """
+        if self._trees is None:
+            return None
+        return self._last_refresh
+
+    def ForceRefresh(self):
+        """Forces a refresh of the internal locale data.
 
-    def FindNearestNeighbors(self, lat, lon):
+        Unlike periodic refreshes, this refresh is done synchronously.
+
+        Raises:
+            RefreshError: An error occurred while refreshing the locale cache.
+        """
+        self._RefreshNow()
+
+    def BuildTrees(self, locales_manager):
+        """Builds the GeoTrees from an already loaded LocalesManager, in place
+        of a refresh.
+
+        The trees are refreshed from the backend as usual once they're older
+        than 'LOCALE_REFRESH_RATE', measured from when the LocalesManager's
+        data was loaded.
+
+        Args:
+            locales_manager (LocalesManager object): Locales to build from.
+
+        Raises:
+            RefreshError: An error occurred while refreshing the locale cache.
+        """
+        self._SetTrees(self._BuildTrees(locales_manager),
+                       locales_manager.LastRefreshTime())
+
+    def LoadSnapshot(self, snapshot):
+        """Loads the GeoTrees from a snapshot, in place of a refresh.
+
+        The trees are restored as they were saved, without rebuilding them, or
+        built from the snapshot's locale data if it lacks any of them.  They're
+        refreshed from the backend as usual once they're older than
+        'LOCALE_REFRESH_RATE', measured from when the snapshot was created.
+
+        Args:
+            snapshot (Snapshot object): Snapshot of locale data.
+
+        Raises:
+            ValueError: The snapshot's trees are malformed.
+        """
+        if snapshot.trees and all(locale_type in snapshot.trees
+                                  for locale_type in NEAREST_LOCALE_TYPES):
+            trees = dict((locale_type,
+                          self.GeoTree(None, None, snapshot.trees[locale_type]))
+                         for locale_type in NEAREST_LOCALE_TYPES)
+        else:
+            lm = LocalesManager(self._backend)
+            lm.LoadSnapshot(snapshot)
+            lm.disable_refresh = True
+            trees = self._BuildTrees(lm)
+
+        self._SetTrees(trees, snapshot.created)
+
+    def TreeData(self):
+        """Retrieves the data the GeoTrees are built from, eg to save it in a
+        snapshot.
+
+        Raises:
+            RefreshError: An error occurred during the first refresh, so there
+                are no GeoTrees.
+
+        Returns:
+            (dict) The data of each GeoTree, as returned by GeoTree.TreeData(),
+            keyed by locale type.
+        """
+        self._Refresh()
+        trees = self._trees
+        return dict((locale_type, trees[locale_type].TreeData())
+                    for locale_type in NEAREST_LOCALE_TYPES)
+
+    def FindNearestNeighbors(self, lat, lon,
+                             locale_types=NEAREST_LOCALE_TYPES):
         """Finds the nearest city, region, and country to given coordinates.
 
+        Each type is searched in its own tree, so that the nearest region and
+        country are found from their own coordinates rather than from the
+        nearest city's.  By default that's three tree searches per lookup,
+        where taking the city's ancestors took one.  Requesting fewer
+        'locale_types' searches fewer trees.
+
         Args:
             lat (float): Target latitude.
             lon (float): Target longitude.
+            locale_types (tuple): Types of locales to find, each one of
+                NEAREST_LOCALE_TYPES.  Only the trees of these types are
+                searched.
+
+        Raises:
+            RefreshError: An error occurred during the first refresh, so there
+                is no locale data to search.
 
         Returns:
             (dict) Names of the nearest locales for each locale type.
             Specifically,
             { 'country': (string) <nearest country ID>,
               'region': (string) <nearest region ID>,
-              'city': (string) <nearest city ID>}.
+              'city': (string) <nearest city ID>},
+            holding only the requested types.
+        """
+        self._Refresh()
+        trees = self._trees  # One set of trees, even if a refresh swaps them.
+        return dict((locale_type,
+                     trees[locale_type].FindNearestNeighbor(lat, lon))
+                    for locale_type in locale_types)
+
+    def FindNearestNeighborsMany(self, lats, lons,
+                                 locale_types=NEAREST_LOCALE_TYPES):
+        """Finds the nearest city, region, and country to each of many
+        coordinates.
+
+        Args:
+            lats (list): Target latitudes, as floats.
+            lons (list): Target longitudes, as floats, in the same order.
+            locale_types (tuple): Types of locales to find, each one of
+                NEAREST_LOCALE_TYPES.  Only the trees of these types are
+                searched.
+
+        Raises:
+            RefreshError: An error occurred during the first refresh, so there
+                is no locale data to search.
+
+        Returns:
+            (dict) Names of the nearest locales for each locale type, each a
+            list in the same order as the coordinates.  Specifically,
+            { 'country': (list) <nearest country IDs>,
+              'region': (list) <nearest region IDs>,
+              'city': (list) <nearest city IDs> },
+            holding only the requested types.
         """
-        return {'country': self.FindNearestCountry(lat, lon),
-                'region': self.FindNearestRegion(lat, lon),
-                'city': self.FindNearestCity(lat, lon)}
+        self._Refresh()
+        trees = self._trees  # One set of trees, even if a refresh swaps them.
+        return dict((locale_type,
+                     trees[locale_type].FindNearestNeighbors(lats, lons))
+                    for locale_type in locale_types)
 
     def FindNearestCountry(self, lat, lon):
         """Finds the nearest country to given coordinates.
@@ -346,8 +790,7 @@ class LocaleFinder(object):
         Returns:
             (string) Locale name for the nearest country.  For example '123'.
         """
-        self._Refresh()
-        return self._cities.FindNearestNeighbor(lat, lon).parent.parent
+        return self.FindNearestNeighbors(lat, lon, ('country',))['country']
 
     def FindNearestRegion(self, lat, lon):
         """Finds the nearest region to given coordinates.
@@ -359,8 +802,7 @@ class LocaleFinder(object):
         Returns:
             (string) Locale name for the nearest region.  For example '123_g'.
         """
-        self._Refresh()
-        return self._cities.FindNearestNeighbor(lat, lon).parent
+        return self.FindNearestNeighbors(lat, lon, ('region',))['region']
 
     def FindNearestCity(self, lat, lon):
         """Finds the nearest city to given coordinates.
@@ -372,21 +814,97 @@ class LocaleFinder(object):
         Returns:
             (string) Locale name for the nearest city.  For example '123_g_abc'.
         """
+        return self.FindNearestNeighbors(lat, lon, ('city',))['city']
+
+    def FindNearestLocales(self, lat, lon, locale_type, count, radius_km=None):
+        """Finds the nearest locales of one type to given coordinates.
+
+        Args:
+            lat (float): Target latitude.
+            lon (float): Target longitude.
+            locale_type (string): Type of locales to find, one of
+                NEAREST_LOCALE_TYPES.
+            count (int): Maximum number of locales to find.
+            radius_km (float): If not None, only locales within this
+                great-circle distance, in kilometers, are found.
+
+        Raises:
+            RefreshError: An error occurred during the first refresh, so there
+                is no locale data to search.
+
+        Returns:
+            (list) Up to 'count' pairs (locale, distance) for the nearest
+            locales, nearest first, where 'distance' is the great-circle
+            distance in kilometers.
+        """
         self._Refresh()
-        return self._cities.FindNearestNeighbor(lat, lon)
+        return self._trees[locale_type].FindKNearestNeighbors(
+            lat, lon, count, radius_km)
 
     def _Refresh(self):
         """Refreshes LocaleFinder data at most every 'LOCALE_REFRESH_RATE'.
+
+        Only the first refresh is done synchronously; later ones rebuild the
+        GeoTrees in the background while the current ones are served.
+
+        Raises:
+            RefreshError: An error occurred during the first refresh, so there
+                is no locale data to serve.
         """
+        # Counters aren't locked, so an increment may rarely be lost.
+        if self._trees is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
         if datetime.now() - self._last_refresh < LOCALE_REFRESH_RATE:
             return
 
+        if self._trees is None:
+            self._RefreshNow()  # First refresh.  Nothing to serve until done.
+        else:
+            self._refresher.Start()
+
+    def _RefreshNow(self):
+        """Refreshes LocaleFinder data, swapping in new GeoTrees when complete.
+
+        Raises:
+            RefreshError: An error occurred while refreshing the locale cache.
+                The current GeoTrees are left unchanged.
+        """
         lm = LocalesManager(self._backend)
         lm.ForceRefresh()
         lm.disable_refresh = True  # Not necessary to refresh from here on.
 
-        cities = self.GeoTree(lm.LocalesByType('city'), lm)
- 
+        self._SetTrees(self._BuildTrees(lm), datetime.now())
+
+    def _SetTrees(self, trees, load_time):
+        """Swaps in new GeoTrees.
+
+        Args:
+            trees (dict): The new GeoTrees, keyed by locale type.
+            load_time (datetime): When the trees' locale data was loaded.
+        """
+        size = sum(len(tree) for tree in trees.itervalues())
+        estimated_bytes = sum(tree.EstimateSize()
+                              for tree in trees.itervalues())
+
         # Update data members.
-        self._cities = cities
-        self._last_refresh = datetime.now()
+        self._trees = trees
+        self._size = size
+        self._bytes = estimated_bytes
+        self._last_refresh = load_time
+
+    def _BuildTrees(self, locales_manager):
+        """Builds a GeoTree for each of NEAREST_LOCALE_TYPES.
+
+        Args:
+            locales_manager (LocalesManager object): Locales to build from.
+
+        Returns:
+            (dict) The new GeoTrees, keyed by locale type.
+        """
+        return dict((locale_type,
+                     self.GeoTree(locales_manager.LocalesByType(locale_type),
+                                  locales_manager))
+                    for locale_type in NEAREST_LOCALE_TYPES)
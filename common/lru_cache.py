@@ -0,0 +1,203 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Author: Dylan Curley
+
+"""This module contains a bounded, least-recently-used (LRU) cache.
+
+The cache is bounded both by the number of entries it holds and by the
+estimated number of bytes those entries occupy.  Whichever limit is hit first
+causes the least recently used entries to be evicted.
+"""
+
+import collections
+import sys
+import threading
+
+
+def EstimateSize(value):
+    """Estimates the number of bytes of memory used by 'value'.
+
+    This is an estimate, not a measurement.  Containers are measured one level
+    deep, which is sufficient for the flat dicts and arrays held in the cache.
+
+    Args:
+        value (object): The value to be measured.
+
+    Returns:
+        (int) Estimated size of 'value', in bytes.
+    """
+    size = sys.getsizeof(value)
+
+    if isinstance(value, dict):
+        for (k, v) in value.iteritems():
+            size += sys.getsizeof(k) + sys.getsizeof(v)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for v in value:
+            size += sys.getsizeof(v)
+
+    return size
+
+
+class LRUCache(object):
+    """Least-recently-used cache, bounded by entry count and estimated bytes.
+
+    Public members 'hits', 'misses', and 'evictions' count cache activity since
+    construction, and can be used to size the cache.
+
+    All methods are thread-safe.
+    """
+    def __init__(self, max_entries, max_bytes=None):
+        """Constructor.
+
+        Args:
+            max_entries (int): Maximum number of entries held by the cache.
+            max_bytes (int): Maximum estimated bytes held by the cache.  If
+                None, the cache is bounded only by 'max_entries'.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def Get(self, key, default=None):
+        """Retrieves the value cached for 'key', marking it as recently used.
+
+        Args:
+            key (hashable): Cache key.
+            default (object): Value returned if 'key' is not cached.
+
+        Returns:
+            (object) The cached value, or 'default' if it's not in the cache.
+        """
+        with self._lock:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._entries[key] = entry  # Re-insert as the most recently used.
+            self.hits += 1
+            return entry[0]
+
+    def Peek(self, key, default=None):
+        """Retrieves the value cached for 'key' without marking it as used.
+
+        Peeking doesn't affect eviction order or the hit and miss counts.
+
+        Args:
+            key (hashable): Cache key.
+            default (object): Value returned if 'key' is not cached.
+
+        Returns:
+            (object) The cached value, or 'default' if it's not in the cache.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def Set(self, key, value, size=None):
+        """Caches 'value' for 'key', evicting old entries as necessary.
+
+        Args:
+            key (hashable): Cache key.
+            value (object): Value to be cached.
+            size (int): Size of 'value' in bytes.  If None, it's estimated.
+        """
+        if size is None:
+            size = EstimateSize(value)
+
+        with self._lock:
+            self._Delete(key)
+            self._entries[key] = (value, size)
+            self._bytes += size
+            self._Evict()
+
+    def Delete(self, key):
+        """Removes 'key' from the cache, if it exists.
+
+        Args:
+            key (hashable): Cache key.
+        """
+        with self._lock:
+            self._Delete(key)
+
+    def DeleteIf(self, predicate):
+        """Removes all entries whose key satisfies 'predicate'.
+
+        Args:
+            predicate (function): Called with each key, returning True if the
+                entry should be removed.
+        """
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                self._Delete(key)
+
+    def Clear(self):
+        """Removes all entries from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def Stats(self):
+        """Retrieves cache usage statistics.
+
+        Returns:
+            (dict) Cache statistics.  Specifically,
+            { 'entries': (int) <number of cached entries>,
+              'bytes': (int) <estimated bytes cached>,
+              'hits': (int) <number of cache hits>,
+              'misses': (int) <number of cache misses>,
+              'evictions': (int) <number of evicted entries> }
+        """
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'bytes': self._bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def _Delete(self, key):
+        """Removes 'key' from the cache.  The caller must hold the lock.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def _Evict(self):
+        """Evicts least recently used entries until the cache is within bounds.
+
+        The most recently added entry is never evicted, even if it alone
+        exceeds 'max_bytes'.  The caller must hold the lock.
+        """
+        while len(self._entries) > 1 and (
+                len(self._entries) > self.max_entries or
+                (self.max_bytes is not None and self._bytes > self.max_bytes)):
+            _, (_, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
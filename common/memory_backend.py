@@ -0,0 +1,226 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Author: Dylan Curley
+
+"""This module contains an in-memory datastore backend with synthetic data.
+
+MemoryBackend generates locales and metric data with realistic cardinalities,
+so that the API query path can be exercised and measured locally without
+CloudSQL or BigQuery.  Metric values are computed from their metric, date, and
+locale when they're queried rather than stored, so even full-size data costs
+little memory.
+"""
+
+from datetime import date
+import random
+import time
+
+import backend
+
+# Default cardinalities, roughly matching production data.
+DEFAULT_COUNTRIES = 250
+DEFAULT_REGIONS = 5000
+DEFAULT_CITIES = 100000
+DEFAULT_MONTHS = 150
+DEFAULT_METRICS = 30
+
+# Fraction of locales without data in any given month.
+MISSING_DATA_FRACTION = 0.1
+
+
+class MemoryBackend(backend.Backend):
+    """Backend serving synthetic locales and metric data from memory.
+
+    Methods behave as described for CloudSQLBackend.  Public member 'calls'
+    counts the backend calls made.
+    """
+    def __init__(self, countries=DEFAULT_COUNTRIES, regions=DEFAULT_REGIONS,
+                 cities=DEFAULT_CITIES, months=DEFAULT_MONTHS,
+                 metrics=DEFAULT_METRICS, latency=0.0, seed=0):
+        """Constructor.
+
+        Args:
+            countries (int): Number of countries.
+            regions (int): Number of regions, spread across the countries.
+            cities (int): Number of cities, spread across the regions.
+            months (int): Number of months with data, ending last month.
+            metrics (int): Number of metrics.
+            latency (float): Seconds each backend call sleeps, to simulate a
+                remote datastore.
+            seed (int): Seed for the generated data.
+        """
+        self.latency = latency
+        self.calls = 0
+        rand = random.Random(seed)
+
+        self._metric_infos = {}
+        for i in xrange(metrics):
+            name = 'metric_%d' % i
+            self._metric_infos[name] = {
+                'name': name, 'units': 'ms',
+                'short_desc': 'Synthetic metric %d.' % i,
+                'long_desc': 'Synthetic metric %d, for benchmarking.' % i,
+                'query': 'SELECT 1'}
+
+        today = date.today()
+        year, month = today.year, today.month
+        self._dates = []
+        for _ in xrange(months):
+            year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+            self._dates.append(date(year, month, 1))
+        self._dates.reverse()
+
+        # Locale table rows (id, locale, name, parent_id, lat, lon), by type.
+        self._locale_rows = {'country': [], 'region': [], 'city': []}
+        # Locale names by scope, as metrics.DetermineLocaleScope() would give.
+        self._scope_locales = {('world', None): ['world']}
+        next_id = [1]
+
+        def AddLocale(locale_type, locale, parent_id):
+            row = (next_id[0], locale, locale.upper(), parent_id,
+                   rand.uniform(-60, 70), rand.uniform(-180, 180))
+            next_id[0] += 1
+            self._locale_rows[locale_type].append(row)
+            return row
+
+        country_rows = [AddLocale('country', '%d' % (100 + i), 0)
+                        for i in xrange(countries)]
+        region_rows = []
+        for i in xrange(regions):
+            country = country_rows[i % countries]
+            region_rows.append(AddLocale(
+                'region', '%s_r%d' % (country[1], i // countries), country[0]))
+        for i in xrange(cities):
+            region = region_rows[i % regions]
+            AddLocale('city', '%s_c%d' % (region[1], i // regions), region[0])
+
+        self._scope_locales[('country', None)] = [
+            row[1] for row in self._locale_rows['country']]
+        self._scope_locales[('region', None)] = [
+            row[1] for row in self._locale_rows['region']]
+        for row in self._locale_rows['city']:
+            scope = ('city', '%s_' % row[1].split('_')[0])
+            self._scope_locales.setdefault(scope, []).append(row[1])
+
+    def ExistingDates(self, metric_name=None):
+        self._Call()
+        return list(self._dates)
+
+    def GetMetricInfo(self, metric_name=None):
+        self._Call()
+        if metric_name is not None:
+            return dict(self._metric_infos[metric_name])
+        return dict((m, dict(info))
+                    for (m, info) in self._metric_infos.iteritems())
+
+    def SetMetricInfo(self, request_type, metric_name, metric_info):
+        self._Call()
+        if request_type == backend.RequestType.DELETE:
+            self._metric_infos.pop(metric_name, None)
+        else:
+            self._metric_infos[metric_name] = dict(metric_info[metric_name])
+
+    def DeleteMetricData(self, metric_name, date=None):
+        self._Call()
+
+    def GetMetricData(self, metric_name, date, locale_type=None,
+                      locale_prefix=None):
+        self._Call()
+        row_date = self._Date(date)
+        data = []
+        if row_date is not None:
+            data = [(locale, value) for (_, locale, value) in
+                    self._Rows(metric_name, [row_date], locale_type,
+                               locale_prefix)]
+        return {'fields': ('locale', 'value'), 'data': data}
+
+    def GetMetricDataRange(self, metric_name, start, end, locale_type=None,
+                           locale_prefix=None):
+        self._Call()
+        return {'fields': ('date', 'locale', 'value'),
+                'data': list(self._Rows(metric_name,
+                                        self._DateRange(start, end),
+                                        locale_type, locale_prefix))}
+
+    def IterMetricDataRange(self, metric_name, start, end, locale_type=None,
+                            locale_prefix=None):
+        self._Call()
+        return self._Rows(metric_name, self._DateRange(start, end),
+                          locale_type, locale_prefix)
+
+    def GetLocaleData(self, locale_type):
+        self._Call()
+        return {'fields': ('id', 'locale', 'name', 'parent_id', 'lat', 'lon'),
+                'data': list(self._locale_rows[locale_type])}
+
+    def _Call(self):
+        """Accounts for, and simulates the latency of, a backend call.
+        """
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _Date(self, month):
+        """Finds the date with data for a month, given as (year, month).
+
+        Returns:
+            (date) The date, or None if there's no data for the month.
+        """
+        row_date = date(month[0], month[1], 1)
+        if self._dates[0] <= row_date <= self._dates[-1]:
+            return row_date
+        return None
+
+    def _DateRange(self, start, end):
+        """Lists the dates with data from 'start' to 'end' inclusive.
+        """
+        start = date(start[0], start[1], 1)
+        end = date(end[0], end[1], 1)
+        return [d for d in self._dates if start <= d <= end]
+
+    def _Rows(self, metric_name, dates, locale_type, locale_prefix):
+        """Generates synthetic metric data.
+
+        Yields:
+            (tuple) Rows of data, each (date, locale, value).
+        """
+        if metric_name not in self._metric_infos:
+            raise backend.LoadError('Unknown metric: %s' % metric_name)
+
+        if (locale_type, locale_prefix) in self._scope_locales:
+            scopes = [(locale_type, locale_prefix)]
+        else:
+            scopes = [scope for scope in self._scope_locales
+                      if locale_type in (None, scope[0])]
+        for row_date in dates:
+            for scope in scopes:
+                for locale in self._scope_locales[scope]:
+                    if (locale_prefix is not None and
+                        not locale.startswith(locale_prefix)):
+                        continue
+                    value = self._Value(metric_name, row_date, locale)
+                    if value is not None:
+                        yield (row_date, locale, value)
+
+    def _Value(self, metric_name, row_date, locale):
+        """Computes the synthetic metric value for a metric, date and locale.
+
+        Returns:
+            (float) The value, or None if the locale has no data that month.
+        """
+        h = hash((metric_name, row_date.year, row_date.month, locale))
+        if (h % 1000) < MISSING_DATA_FRACTION * 1000:
+            return None
+        return (h % 100000) / 100.0
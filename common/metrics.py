@@ -17,18 +17,46 @@
 """This module contains classes and functions for dealing with Metric data.
 """
 
+import array
+import bisect
 from datetime import datetime
 from datetime import timedelta
 import logging
+import re
+import sys
+import threading
 
+import background_refresh
 import backend as backend_interface
+import lru_cache
+import parallel
+import single_flight
 
-#todo: use this or delete it
-MAX_LOADED_METRICS_KEYS = 300
+# Limits on the metric data cache shared by all metrics in a MetricsManager.
+# Each cache entry holds one month of data for one metric and locale scope, or
+# a ranking built from such data.
+MAX_LOADED_METRICS_KEYS = 3000
+MAX_LOADED_METRICS_BYTES = 48 * 1024 * 1024
+
+# Well-formed locale names other than 'world', eg '840', '840_ca', or
+# '840_ca_sf'.  Locale names are spliced into backend queries, so nothing else
+# is accepted.
+LOCALE_NAME_RE = re.compile(r'^[A-Za-z0-9]+(_[A-Za-z0-9]+){0,2}$')
 
 # Timeout when cached metrics should be considered old.
 METRICS_REFRESH_RATE = timedelta(days=2)
 
+# Timeout when the cached set of months with data for a metric should be
+# considered old.  This is shorter than 'METRICS_REFRESH_RATE' so that newly
+# computed months are served soon after they're added.
+EXISTING_DATES_REFRESH_RATE = timedelta(hours=1)
+
+# Limit on the cache of lookups known to have no data.
+MAX_MISSED_LOOKUPS = 50000
+
+# Placeholder for locales without data in array-backed metric data.
+_NO_DATA = float('nan')
+
 _last_metrics_info_refresh = datetime.fromtimestamp(0)
 
 
@@ -59,9 +87,10 @@ class Metric(object):
     is loaded on demand instead of up front.  This is intended to mitigate RAM
     usage at the expense of load time, but load time is only impacted on first
     request and should be fast for all subsequent requests (until the cache
-    expires).
+    expires or evicts the data).
     """
-    def __init__(self, name, units, short_desc, long_desc, query):
+    def __init__(self, name, units, short_desc, long_desc, query, cache=None,
+                 locale_index=None, loads=None):
         """Constructor.
 
         Args:
@@ -70,14 +99,32 @@ class Metric(object):
             short_desc (string): Short description.
             long_desc (string): Long description.
             query (string): BigQuery query string to compute this metric.
+            cache (LRUCache object): Cache holding loaded metric data, which
+                may be shared with other metrics.  If None, a private cache is
+                created.
+            locale_index (LocaleIndex object): Ordinals indexing the loaded
+                metric data, which must be shared by all metrics sharing
+                'cache'.  If None, a private index is created.
+            loads (SingleFlight object): Coalesces concurrent loads of the same
+                data, and should be shared by all metrics sharing 'cache'.  If
+                None, a private one is created.
         """
         self.name = name
         self.units = units
         self.short_desc = short_desc
         self.long_desc = long_desc
         self.query = query
-        self._data = dict()
-        self._metadata = dict()
+        self.defined = datetime.now()  # Versions the definition.
+        if cache is None:
+            cache = lru_cache.LRUCache(MAX_LOADED_METRICS_KEYS,
+                                       MAX_LOADED_METRICS_BYTES)
+        if locale_index is None:
+            locale_index = LocaleIndex()
+        if loads is None:
+            loads = single_flight.SingleFlight()
+        self._cache = cache
+        self._locale_index = locale_index
+        self._loads = loads
 
     def Lookup(self, backend, year, month, locale):
         """Looks up metric data for a given year, month, and locale.
@@ -99,53 +146,584 @@ class Metric(object):
         """
         #todo: allow regex lookups
         date = (year, month)
+        month_data = self._LoadData(backend, date,
+                                    DetermineLocaleScope(locale))
+        value = month_data.Value(self._locale_index.Ordinal(locale))
 
-        if date not in self._metadata:
-            self._metadata[date] = dict()
-        self._metadata[date]['last_request_time'] = datetime.now()
-
-        if date not in self._data or locale not in self._data[date]:
-            self._LoadData(backend, date, locale)
-
-        if date not in self._data or locale not in self._data[date]:
+        if value is None:
             raise LookupError('No data for metric=%s, year=%d, month=%d,'
                               ' locale=%s.' % (self.name, year, month, locale))
 
         return {'metric': self.name,
                 'units' : self.units,
-                'value' : self._data[date][locale]}
+                'value' : value}
+
+    def LookupMany(self, backend, year, month, locales):
+        """Looks up metric data for a given year, month, and several locales.
+
+        Each locale scope (see DetermineLocaleScope) is loaded at most once, no
+        matter how many of the requested locales share it.
+
+        Args:
+            backend (Backend): Datastore backend.
+            year (int): Year to retrieve.
+            month (int): Month to retrieve.
+            locales (list): Locales for which metric data should be given.
+
+        Raises:
+            KeyError: A locale name is malformed.
+            RefreshError: An error occurred while loading the metric data.
+
+        Returns:
+            (dict) The (float) metric value for each requested locale, keyed by
+            locale, or None for locales that have no data.
+        """
+        date = (year, month)
+        month_datas = {}
+        values = {}
+
+        for locale in locales:
+            scope = DetermineLocaleScope(locale)
+            if scope not in month_datas:
+                month_datas[scope] = self._LoadData(backend, date, scope)
+            values[locale] = month_datas[scope].Value(
+                self._locale_index.Ordinal(locale))
+
+        return values
+
+    def LookupRange(self, backend, start, end, locale, max_threads=1):
+        """Looks up metric data for a range of months and a given locale.
+
+        With one thread, all months in the range that aren't already cached
+        are loaded from the backend with a single query.  With more, they're
+        split into up to about 'max_threads' smaller ranges, loaded
+        concurrently.
 
-    def _LoadData(self, backend, date, locale):
+        Args:
+            backend (Backend): Datastore backend.
+            start (tuple): First month to retrieve, as ints (year, month).
+            end (tuple): Last month to retrieve, as ints (year, month).
+            locale (string): Locale for which metric data should be given.
+            max_threads (int): Maximum number of concurrent backend loads.
+
+        Raises:
+            RefreshError: An error occurred while loading the metric data.
+
+        Returns:
+            (list) One (date, value) tuple for each month from 'start' to 'end'
+            inclusive, in order, where 'date' is a tuple (year, month) and
+            'value' is the (float) metric value, or None if there is no data for
+            that month.
+        """
+        dates = list(MonthRange(start, end))
+        locale_type, locale_prefix = DetermineLocaleScope(locale)
+
+        month_datas = {}
+        for date in dates:
+            month_data = self._CachedData((date, locale_type, locale_prefix))
+            if month_data is not None:
+                month_datas[date] = month_data
+
+        missing_dates = [d for d in dates if d not in month_datas]
+        if len(missing_dates) == 1 or (missing_dates and max_threads <= 1):
+            month_datas.update(self._LoadDataRange(
+                backend, missing_dates[0], missing_dates[-1], locale))
+        elif missing_dates:
+            loads = parallel.Map(
+                lambda dates: self._LoadDataRange(
+                    backend, dates[0], dates[1], locale),
+                _SplitDates(missing_dates, max_threads), max_threads)
+            for loaded in loads:
+                month_datas.update(loaded)
+
+        ordinal = self._locale_index.Ordinal(locale)
+        return [(date, month_datas[date].Value(ordinal)) for date in dates]
+
+    def Rank(self, backend, year, month, locale_type, parent=None):
+        """Ranks locales by their value of this metric for a given month.
+
+        The ranking is built from the month's cached data the first time it's
+        needed, then cached alongside that data until the data is reloaded.
+
+        Args:
+            backend (Backend): Datastore backend.
+            year (int): Year to rank.
+            month (int): Month to rank.
+            locale_type (string): Type of locales to rank, as accepted by
+                RankingScope().
+            parent (string): If provided, only locales within this locale are
+                ranked, as accepted by RankingScope().
+
+        Raises:
+            KeyError: The locale type or parent is malformed.
+            RefreshError: An error occurred while loading the metric data.
+
+        Returns:
+            (Ranking) The ranked locales.
+        """
+        date = (year, month)
+        scope, prefix = RankingScope(locale_type, parent)
+        month_data = self._LoadData(backend, date, scope)
+
+        ranking_key = (self.name, date) + scope + (prefix,)
+        ranking = self._cache.Get(ranking_key)
+        if ranking is not None and ranking.load_time == month_data.load_time:
+            return ranking
+
+        return self._loads.Do(ranking_key, self._BuildRanking, ranking_key,
+                              month_data, scope, prefix)
+
+    def LastLoadTime(self, start, end, locale, absent_dates=frozenset(),
+                     absent_time=None):
+        """Determines when cached data for a range of months was loaded.
+
+        This is a version for the cached data: it changes whenever any of the
+        data is reloaded, or the metric is redefined.  The cache is only peeked
+        at, so no data is loaded.
+
+        Args:
+            start (tuple): First month, as ints (year, month).
+            end (tuple): Last month, as ints (year, month).
+            locale (string): Locale of interest.
+            absent_dates (frozenset): Months known to have no data, which are
+                never cached.  They count as loaded at 'absent_time'.
+            absent_time (datetime): When 'absent_dates' were loaded.
+
+        Returns:
+            (datetime) When the most recently loaded month of the range was
+            loaded, or the metric defined if that's later, or None if any other
+            month isn't cached or is due for reload.
+        """
+        scope = DetermineLocaleScope(locale)
+        last_load_time = None
+
+        for date in MonthRange(start, end):
+            if date in absent_dates:
+                load_time = absent_time
+            else:
+                month_data = self._cache.Peek((self.name, date) + scope)
+                if (month_data is None or
+                    datetime.now() - month_data.load_time >=
+                    METRICS_REFRESH_RATE):
+                    return None
+                load_time = month_data.load_time
+            if last_load_time is None or load_time > last_load_time:
+                last_load_time = load_time
+
+        if last_load_time is None:
+            return None
+        return max(last_load_time, self.defined)
+
+    def LastRankLoadTime(self, year, month, locale_type, parent=None):
+        """Determines when the data of a cached ranking was loaded.
+
+        Like LastLoadTime(), but for a ranking as returned by Rank().
+
+        Args:
+            year (int): Year ranked.
+            month (int): Month ranked.
+            locale_type (string): Type of locales ranked.
+            parent (string): Locale within which locales were ranked, or None.
+
+        Raises:
+            KeyError: The locale type or parent is malformed.
+
+        Returns:
+            (datetime) When the ranked data was loaded, or the metric defined if
+            that's later, or None if the ranking isn't cached or is due for
+            rebuilding.
+        """
+        date = (year, month)
+        scope, prefix = RankingScope(locale_type, parent)
+        month_data = self._cache.Peek((self.name, date) + scope)
+        ranking = self._cache.Peek((self.name, date) + scope + (prefix,))
+        if (month_data is None or ranking is None or
+            ranking.load_time != month_data.load_time or
+            datetime.now() - month_data.load_time >= METRICS_REFRESH_RATE):
+            return None
+        return max(ranking.load_time, self.defined)
+
+    def Reload(self, backend, date, scope):
+        """Reloads one month of data for this metric from the backend,
+        replacing any cached data that's older than 'METRICS_REFRESH_RATE'.
+
+        Args:
+            backend (Backend): Datastore backend.
+            date (tuple): Month to reload, as ints (year, month).
+            scope (tuple): Locale scope, as returned by DetermineLocaleScope().
+
+        Raises:
+            RefreshError: An error occurred while loading the metric data.
+        """
+        scope_key = (date,) + tuple(scope)
+        self._loads.Do((self.name,) + scope_key, self._FetchData,
+                       backend, scope_key)
+
+    def _LoadData(self, backend, date, scope):
         """Loads/updates data for this metric from the backend datastore.
 
-        The metric data is not returned, it's loaded into memory so that it can
-        be queried later.
+        Only the locales in 'scope' (see DetermineLocaleScope) are loaded, so
+        that, eg, a country lookup does not pull data for every city.  Data is
+        served from the cache if it was loaded less than 'METRICS_REFRESH_RATE'
+        ago, otherwise it's (re)loaded from the backend and cached.
+
+        Concurrent requests for the same uncached data share a single backend
+        load.
+
+        Returns:
+            (_MonthData) The metric data for the given date and locale scope.
         """
-        locale_type = DetermineLocaleType(locale)
-        m_key = (date, locale_type)
-        if m_key not in self._metadata:
-            self._metadata[m_key] = {'last_load_time': datetime.fromtimestamp(0)}
+        scope_key = (date,) + tuple(scope)
+        month_data = self._CachedData(scope_key)
+        if month_data is not None:
+            return month_data
 
-        metrics_age = datetime.now() - self._metadata[m_key]['last_load_time']
-        if metrics_age < METRICS_REFRESH_RATE:
-            return
-        self._metadata[m_key]['last_load_time'] = datetime.now()
+        return self._loads.Do((self.name,) + scope_key, self._FetchData,
+                              backend, scope_key)
+
+    def _FetchData(self, backend, scope_key):
+        """Loads data for one month and locale scope from the backend.
+
+        Data cached by a load that completed since the caller checked the cache
+        is returned without loading it again.
+
+        Returns:
+            (_MonthData) The metric data for the given date and locale scope.
+        """
+        month_data = self._CachedData(scope_key, fresh_only=True)
+        if month_data is not None:
+            return month_data
+
+        date, locale_type, locale_prefix = scope_key
+        try:
+            info = backend.GetMetricData(self.name, date, locale_type,
+                                         locale_prefix)
+        except backend_interface.LoadError as e:
+            raise RefreshError(e)
+
+        return self._CacheData(scope_key, info['data'])
+
+    def _LoadDataRange(self, backend, start, end, locale):
+        """Loads/updates data for this metric for a range of months.
+
+        Like _LoadData(), but loads every month from 'start' to 'end' inclusive
+        with one backend query, regardless of what's already cached.
+
+        Returns:
+            (dict) The _MonthData for each month in the range, keyed by date.
+        """
+        scope = DetermineLocaleScope(locale)
+        return self._loads.Do((self.name, start, end) + scope,
+                              self._FetchDataRange, backend, start, end, scope)
+
+    def _FetchDataRange(self, backend, start, end, scope):
+        """Loads data for a range of months and a locale scope from the backend.
+
+        Returns:
+            (dict) The _MonthData for each month in the range, keyed by date.
+        """
+        locale_type, locale_prefix = scope
 
         try:
-            info = backend.GetMetricData(self.name, date, locale)
+            info = backend.GetMetricDataRange(self.name, start, end,
+                                              locale_type, locale_prefix)
         except backend_interface.LoadError as e:
             raise RefreshError(e)
 
-        if date not in self._data:
-            self._data[date] = dict()
+        rows_by_date = dict((date, []) for date in MonthRange(start, end))
+        for (row_date, row_locale, value) in info['data']:
+            date = ParseDate(row_date)
+            if date in rows_by_date:
+                rows_by_date[date].append((row_locale, value))
+
+        return dict((date, self._CacheData((date, locale_type, locale_prefix),
+                                           rows))
+                    for (date, rows) in rows_by_date.iteritems())
+
+    def _CachedData(self, scope_key, fresh_only=False):
+        """Retrieves cached data, if it was loaded less than
+        'METRICS_REFRESH_RATE' ago.
+
+        Stale data loaded from a snapshot is also retrieved, unless
+        'fresh_only', since it's served until the MetricsManager reloads it.
 
-        for row in info['data']:
-            locale, value = row
-            self._data[date][locale] = float(value)
+        Args:
+            scope_key (tuple): Date and locale scope, as a tuple (date,
+                locale_type, locale_prefix).
+            fresh_only (bool): Whether stale snapshot data is treated as stale.
+
+        Returns:
+            (_MonthData) The cached data, or None if it's not cached or stale.
+        """
+        month_data = self._cache.Get((self.name,) + scope_key)
+        if month_data is None:
+            return None
+        if datetime.now() - month_data.load_time < METRICS_REFRESH_RATE:
+            return month_data
+        if month_data.from_snapshot and not fresh_only:
+            return month_data
+        return None
+
+    def _CacheData(self, scope_key, rows):
+        """Caches newly loaded data.
+
+        The data is stored as an array of metric values indexed by locale
+        ordinal (see LocaleIndex), which is far more compact than a dict keyed
+        by locale name.
+
+        Args:
+            scope_key (tuple): Date and locale scope, as a tuple (date,
+                locale_type, locale_prefix).
+            rows (list): Loaded data, as (locale, value) pairs.
+
+        Returns:
+            (_MonthData) The newly cached data.
+        """
+        ordinals = [(self._locale_index.Assign(locale), float(value))
+                    for (locale, value) in rows]
+
+        values = array.array('d', [_NO_DATA]) * self._locale_index.Size(
+            scope_key[1:])
+        for (ordinal, value) in ordinals:
+            values[ordinal] = value
+
+        month_data = _MonthData(values)
+        self._cache.Set((self.name,) + scope_key, month_data,
+                        lru_cache.EstimateSize(values))
+        return month_data
+
+    def _BuildRanking(self, ranking_key, month_data, scope, prefix):
+        """Builds and caches the ranking of one month of data.
+
+        Args:
+            ranking_key (tuple): Cache key of the ranking.
+            month_data (_MonthData): The data to be ranked.
+            scope (tuple): Locale scope of 'month_data'.
+            prefix (string): If not None, only locales with names starting
+                with 'prefix' are ranked.
+
+        Returns:
+            (Ranking) The newly cached ranking.
+        """
+        ranking = Ranking(month_data, self._locale_index.Names(scope), prefix)
+        # Locale names are shared with the locale index, so aren't counted.
+        self._cache.Set(ranking_key, ranking,
+                        lru_cache.EstimateSize(ranking.values) +
+                        sys.getsizeof(ranking.locales))
+        return ranking
+
+
+class _MonthData(object):
+    """One month of data for a single metric and locale scope, as held in the
+    metric cache.
+
+    Members:
+        values (array): Metric values indexed by locale ordinal, with NaN for
+            locales that have no data.
+        load_time (datetime): When the data was loaded from the backend.
+        from_snapshot (bool): Whether the data was loaded from a snapshot, in
+            which case it's served even once it's older than
+            'METRICS_REFRESH_RATE', until it's reloaded.
+    """
+    def __init__(self, values, load_time=None, from_snapshot=False):
+        """Constructor.
+
+        Args:
+            values (array): Metric values indexed by locale ordinal.
+            load_time (datetime): When the data was loaded.  If None, now.
+            from_snapshot (bool): Whether the data was loaded from a snapshot.
+        """
+        self.values = values
+        self.load_time = load_time or datetime.now()
+        self.from_snapshot = from_snapshot
+
+    def Value(self, ordinal):
+        """Retrieves the metric value for a given locale ordinal.
+
+        Args:
+            ordinal (int): Locale ordinal, or None for an unknown locale.
+
+        Returns:
+            (float) The metric value, or None if there is no data.
+        """
+        if ordinal is None or ordinal >= len(self.values):
+            return None
+        value = self.values[ordinal]
+        if value != value:  # NaN, ie no data.
+            return None
+        return value
+
+
+class Ranking(object):
+    """Locales ranked by their value of a metric for one month.
+
+    Values are kept sorted, so that the top locales are a slice and the rank
+    or percentile of any value is a binary search.
+
+    Members:
+        locales (list): Locale names, in increasing order of value.  Locales
+            with equal values are ordered by name.
+        values (array): Metric values, in increasing order, where values[i] is
+            the value of locales[i].
+        load_time (datetime): When the ranked data was loaded from the backend.
+    """
+    def __init__(self, month_data, names, prefix=None):
+        """Constructor.
+
+        Args:
+            month_data (_MonthData): The data to be ranked.
+            names (list): Locale names of the data's scope, by ordinal.
+            prefix (string): If not None, only locales with names starting
+                with 'prefix' are ranked.
+        """
+        ranked = sorted((value, names[ordinal])
+                        for (ordinal, value) in enumerate(month_data.values)
+                        if value == value and  # Not NaN, ie has data.
+                        (prefix is None or names[ordinal].startswith(prefix)))
+        self.locales = [locale for (_, locale) in ranked]
+        self.values = array.array('d', [value for (value, _) in ranked])
+        self.load_time = month_data.load_time
+
+    def __len__(self):
+        return len(self.values)
+
+    def Top(self, n, descending=True):
+        """Lists the top ranked locales.
+
+        Args:
+            n (int): Maximum number of locales to list.
+            descending (bool): Whether larger values rank higher.
+
+        Returns:
+            (list) Up to 'n' tuples (locale, value), highest ranked first.
+        """
+        if descending:
+            indices = xrange(len(self.values) - 1,
+                             max(len(self.values) - n, 0) - 1, -1)
+        else:
+            indices = xrange(min(n, len(self.values)))
+        return [(self.locales[i], self.values[i]) for i in indices]
+
+    def Position(self, value, descending=True):
+        """Determines the rank of a value among the ranked locales.
+
+        Args:
+            value (float): Metric value.
+            descending (bool): Whether larger values rank higher.
+
+        Returns:
+            (int) One more than the number of locales ranked higher than
+            'value', so that equal values share a rank.
+        """
+        if descending:
+            return (len(self.values) -
+                    bisect.bisect_right(self.values, value) + 1)
+        return bisect.bisect_left(self.values, value) + 1
+
+    def Percentile(self, value):
+        """Determines the percentile rank of a value among the ranked locales.
+
+        Args:
+            value (float): Metric value.
+
+        Returns:
+            (float) The percentage of locales with a smaller value, counting
+            locales with an equal value as half, or None if no locales are
+            ranked.
+        """
+        if not self.values:
+            return None
+        below = bisect.bisect_left(self.values, value)
+        equal = bisect.bisect_right(self.values, value) - below
+        return 100.0 * (below + 0.5 * equal) / len(self.values)
+
+
+class LocaleIndex(object):
+    """Assigns dense ordinals to locale names, to index array-backed data.
+
+    Ordinals are assigned separately within each locale scope (see
+    DetermineLocaleScope), counting up from zero in the order locales are first
+    seen.  An ordinal never changes once assigned, so arrays indexed by
+    ordinals remain valid as new locales are added.
+
+    All methods are thread-safe.
+    """
+    def __init__(self):
+        """Constructor.
+        """
+        self._ordinals = {}  # Locale name -> ordinal.
+        self._names = {}  # Locale scope -> list of locale names, by ordinal.
+        self._lock = threading.Lock()
+
+    def Assign(self, locale):
+        """Retrieves the ordinal for a locale, assigning one if necessary.
+
+        Args:
+            locale (string): Locale name.
+
+        Raises:
+            KeyError: The locale name is malformed.
+
+        Returns:
+            (int) The locale's ordinal within its scope.
+        """
+        ordinal = self._ordinals.get(locale)
+        if ordinal is not None:
+            return ordinal
+
+        scope = DetermineLocaleScope(locale)
+        with self._lock:
+            ordinal = self._ordinals.get(locale)
+            if ordinal is None:
+                names = self._names.setdefault(scope, [])
+                ordinal = len(names)
+                names.append(locale)
+                self._ordinals[locale] = ordinal
+        return ordinal
+
+    def Ordinal(self, locale):
+        """Retrieves the ordinal for a locale.
+
+        Args:
+            locale (string): Locale name.
+
+        Returns:
+            (int) The locale's ordinal within its scope, or None if no ordinal
+            has been assigned.
+        """
+        return self._ordinals.get(locale)
+
+    def Names(self, scope):
+        """Retrieves the names of all locales in a scope, by ordinal.
+
+        Args:
+            scope (tuple): Locale scope, as returned by DetermineLocaleScope().
+
+        Returns:
+            (list) Locale names, where each name's index is its ordinal.
+        """
+        with self._lock:
+            return list(self._names.get(tuple(scope), []))
+
+    def Size(self, scope):
+        """Retrieves the number of ordinals assigned in a scope.
+
+        Args:
+            scope (tuple): Locale scope, as returned by DetermineLocaleScope().
+
+        Returns:
+            (int) Number of ordinals assigned.
+        """
+        with self._lock:
+            return len(self._names.get(tuple(scope), []))
 
 
 class MetricsManager(object):
     """Manage metrics data, specifically hiding the details of data caching.
+
+    Metric definitions are refreshed every 'METRICS_REFRESH_RATE'.  Only the
+    first refresh is done synchronously; later ones build a new snapshot of the
+    definitions in the background while the current snapshot is served.
     """
     def __init__(self, backend):
         """Constructor.
@@ -154,8 +732,17 @@ class MetricsManager(object):
             backend (Backend object): Datastore backend.
         """
         self._backend = backend
+        self._cache = lru_cache.LRUCache(MAX_LOADED_METRICS_KEYS,
+                                         MAX_LOADED_METRICS_BYTES)
+        self.locale_index = LocaleIndex()
+        self._loads = single_flight.SingleFlight()
+        self._existing_dates = {}  # Metric -> (frozenset of dates, load time).
+        self._misses = lru_cache.LRUCache(MAX_MISSED_LOOKUPS)
         self._metrics = {}
+        self._snapshot_keys = set()  # Cache keys of snapshot data.
         self._last_refresh = datetime.fromtimestamp(0)
+        self._refresher = background_refresh.BackgroundRefresher(
+            'metrics', self._RefreshNow)
 
     def Exists(self, metric):
         """Whether or not a given metric exists.
@@ -219,14 +806,21 @@ class MetricsManager(object):
             request_type = backend_interface.RequestType.NEW
         else:
             request_type = backend_interface.RequestType.EDIT
-
-        self._metrics[metric] = Metric(metric, units, short_desc, long_desc, query)
-        infos = dict((m, {'name'      : self._metrics[m].name,
-                          'short_desc': self._metrics[m].short_desc,
-                          'long_desc' : self._metrics[m].long_desc,
-                          'units'     : self._metrics[m].units,
-                          'query'     : self._metrics[m].query})
-                     for m in self._metrics)
+            # Data cached under the old definition may no longer be right.
+            self._UncacheMetric(metric)
+
+        metrics = dict(self._metrics)
+        metrics[metric] = Metric(metric, units, short_desc, long_desc, query,
+                                 cache=self._cache,
+                                 locale_index=self.locale_index,
+                                 loads=self._loads)
+        self._metrics = metrics
+        infos = dict((m, {'name'      : metrics[m].name,
+                          'short_desc': metrics[m].short_desc,
+                          'long_desc' : metrics[m].long_desc,
+                          'units'     : metrics[m].units,
+                          'query'     : metrics[m].query})
+                     for m in metrics)
         self._backend.SetMetricInfo(request_type, metric, infos)
 
     def DeleteMetric(self, metric):
@@ -242,7 +836,10 @@ class MetricsManager(object):
         if not self.Exists(metric):
             raise LookupError('Unknown metric: %s' % metric)
 
-        del self._metrics[metric]
+        metrics = dict(self._metrics)
+        del metrics[metric]
+        self._metrics = metrics
+        self._UncacheMetric(metric)
         self._backend.SetMetricInfo(backend_interface.RequestType.DELETE,
                                     metric, None)
         self._backend.DeleteMetricData(metric)
@@ -250,6 +847,9 @@ class MetricsManager(object):
     def LookupResult(self, metric, year, month, locale):
         """Looks up metric data for a given year, month, and locale.
 
+        Lookups for months without data for the metric, and lookups that
+        recently found no data, fail without querying the backend.
+
         Args:
             metric (string): Metric name.
             year (int): Year to retrieve.
@@ -269,52 +869,473 @@ class MetricsManager(object):
         if not self.Exists(metric):
             raise LookupError('Unknown metric: %s' % metric)
 
-        return self._metrics[metric].Lookup(self._backend, year, month, locale)
+        date = (year, month)
+        if (not self._DateExists(metric, date) or
+            self._RecentlyMissed(metric, date, locale)):
+            raise LookupError('No data for metric=%s, year=%d, month=%d,'
+                              ' locale=%s.' % (metric, year, month, locale))
+
+        try:
+            return self._metrics[metric].Lookup(self._backend, year, month,
+                                                locale)
+        except LookupError:
+            self._misses.Set((metric, date, locale), datetime.now())
+            raise
+
+    def LookupMany(self, metric, year, month, locales):
+        """Looks up metric data for a given year, month, and several locales.
+
+        Locales that recently had no data get None without querying the
+        backend, as in LookupResult().
+
+        Args:
+            metric (string): Metric name.
+            year (int): Year to retrieve.
+            month (int): Month to retrieve.
+            locales (list): Locales for which metric data should be given.
+
+        Raises:
+            KeyError: A locale name is malformed.
+            LookupError: If the requested metric doesn't exist.
+            RefreshError: An error occurred while refreshing the metric cache.
+
+        Returns:
+            (dict) The metric value for each requested locale, as returned by
+            Metric.LookupMany().
+        """
+        if not self.Exists(metric):
+            raise LookupError('Unknown metric: %s' % metric)
+
+        date = (year, month)
+        if not self._DateExists(metric, date):
+            return dict((locale, None) for locale in locales)
+
+        values = dict((locale, None) for locale in locales
+                      if self._RecentlyMissed(metric, date, locale))
+        lookups = [locale for locale in locales if locale not in values]
+        if lookups:
+            found = self._metrics[metric].LookupMany(self._backend, year,
+                                                     month, lookups)
+            now = datetime.now()
+            for locale, value in found.iteritems():
+                if value is None:
+                    self._misses.Set((metric, date, locale), now)
+            values.update(found)
+        return values
+
+    def LookupRange(self, metric, start, end, locale, max_threads=1):
+        """Looks up metric data for a range of months and a given locale.
+
+        Only the part of the range with data for the metric is loaded from the
+        backend, leaving out months that recently had no data for the locale,
+        as in LookupResult().
+
+        Args:
+            metric (string): Metric name.
+            start (tuple): First month to retrieve, as ints (year, month).
+            end (tuple): Last month to retrieve, as ints (year, month).
+            locale (string): Locale for which metric data should be given.
+            max_threads (int): Maximum number of concurrent backend loads.
+
+        Raises:
+            LookupError: If the requested metric doesn't exist.
+            RefreshError: An error occurred while refreshing the metric cache.
+
+        Returns:
+            (list) One (date, value) tuple for each month in the range, as
+            returned by Metric.LookupRange().
+        """
+        if not self.Exists(metric):
+            raise LookupError('Unknown metric: %s' % metric)
+
+        existing_dates = self.ExistingDates(metric)
+        dates = list(MonthRange(start, end))
+        dates_to_load = [d for d in dates
+                         if (existing_dates is None or d in existing_dates) and
+                         not self._RecentlyMissed(metric, d, locale)]
+        values = {}
+        if dates_to_load:
+            loaded = self._metrics[metric].LookupRange(
+                self._backend, dates_to_load[0], dates_to_load[-1], locale,
+                max_threads=max_threads)
+            now = datetime.now()
+            for date, value in loaded:
+                if value is None:
+                    self._misses.Set((metric, date, locale), now)
+            values = dict(loaded)
+
+        return [(date, values.get(date)) for date in dates]
+
+    def Rank(self, metric, year, month, locale_type, parent=None):
+        """Ranks locales by their value of a metric for a given year and month.
+
+        Args:
+            metric (string): Metric name.
+            year (int): Year to rank.
+            month (int): Month to rank.
+            locale_type (string): Type of locales to rank, as accepted by
+                RankingScope().
+            parent (string): If provided, only locales within this locale are
+                ranked, as accepted by RankingScope().
+
+        Raises:
+            KeyError: The locale type or parent is malformed.
+            LookupError: If the requested metric or month doesn't exist.
+            RefreshError: An error occurred while refreshing the metric cache.
+
+        Returns:
+            (Ranking) The ranked locales, as returned by Metric.Rank().
+        """
+        if not self.Exists(metric):
+            raise LookupError('Unknown metric: %s' % metric)
+
+        if not self._DateExists(metric, (year, month)):
+            raise LookupError('No data for metric=%s, year=%d, month=%d.'
+                              % (metric, year, month))
+
+        return self._metrics[metric].Rank(self._backend, year, month,
+                                          locale_type, parent)
+
+    def ExportData(self, metric, start, end, locale_type=None):
+        """Generates all data for a metric for a range of months.
+
+        The data is streamed from the backend, bypassing the metric cache, so
+        that bulk exports neither hold the full result in memory nor evict
+        data that's being queried.
+
+        Args:
+            metric (string): Metric name.
+            start (tuple): First month to retrieve, as ints (year, month).
+            end (tuple): Last month to retrieve, as ints (year, month).
+            locale_type (string): If provided, only data for locales of this
+                type ('world', 'country', 'region', or 'city') is retrieved.
+
+        Raises:
+            LookupError: If the requested metric doesn't exist.
+            RefreshError: An error occurred while refreshing the metric cache.
+
+        Returns:
+            (generator) The metric data, each item a tuple (date, locale,
+            value), where 'date' is a tuple of ints (year, month).  The
+            generator raises RefreshError if the backend fails while it's
+            being iterated.
+        """
+        if not self.Exists(metric):
+            raise LookupError('Unknown metric: %s' % metric)
+
+        def Rows():
+            try:
+                for (row_date, locale, value) in (
+                        self._backend.IterMetricDataRange(metric, start, end,
+                                                          locale_type)):
+                    yield (ParseDate(row_date), locale, float(value))
+            except backend_interface.LoadError as e:
+                raise RefreshError(e)
+
+        return Rows()
+
+    def LastLoadTime(self, metric, start, end, locale):
+        """Determines when cached data for a range of months was loaded.
+
+        Months that ExistingDates() last found to have no data are never
+        cached, so they count as loaded when the existing months were.
+
+        Args:
+            metric (string): Metric name.
+            start (tuple): First month, as ints (year, month).
+            end (tuple): Last month, as ints (year, month).
+            locale (string): Locale of interest.
+
+        Returns:
+            (datetime) As returned by Metric.LastLoadTime(), or None if the
+            metric doesn't exist.
+        """
+        metric = self._metrics.get(metric)
+        if metric is None:
+            return None
+
+        # Peek at the existing months, as for the data, rather than load them.
+        absent_dates, absent_time = frozenset(), None
+        entry = self._existing_dates.get(metric.name)
+        if (entry is not None and entry[0] is not None and
+            datetime.now() - entry[1] < EXISTING_DATES_REFRESH_RATE):
+            absent_dates = frozenset(date for date in MonthRange(start, end)
+                                     if date not in entry[0])
+            absent_time = entry[1]
+        return metric.LastLoadTime(start, end, locale, absent_dates,
+                                   absent_time)
+
+    def LastRankLoadTime(self, metric, year, month, locale_type, parent=None):
+        """Determines when the data of a cached ranking was loaded.
+
+        Args:
+            metric (string): Metric name.
+            year (int): Year ranked.
+            month (int): Month ranked.
+            locale_type (string): Type of locales ranked.
+            parent (string): Locale within which locales were ranked, or None.
+
+        Raises:
+            KeyError: The locale type or parent is malformed.
+
+        Returns:
+            (datetime) As returned by Metric.LastRankLoadTime(), or None if the
+            metric doesn't exist.
+        """
+        metric = self._metrics.get(metric)
+        if metric is None:
+            return None
+        return metric.LastRankLoadTime(year, month, locale_type, parent)
+
+    def CacheStats(self):
+        """Retrieves usage statistics for the metric data cache.
+
+        Returns:
+            (dict) Cache statistics, as returned by LRUCache.Stats().
+        """
+        return self._cache.Stats()
+
+    def MissCacheStats(self):
+        """Retrieves usage statistics for the cache of lookups without data.
+
+        Returns:
+            (dict) Cache statistics, as returned by LRUCache.Stats().
+        """
+        return self._misses.Stats()
+
+    def ExistingDates(self, metric):
+        """Retrieves the months for which the backend has data for a metric.
+
+        The months are cached for 'EXISTING_DATES_REFRESH_RATE'.
+
+        Args:
+            metric (string): Metric name.
+
+        Raises:
+            RefreshError: An error occurred while loading the existing months.
+
+        Returns:
+            (frozenset) Months with data, as ints (year, month), or None if the
+            backend can't tell.
+        """
+        entry = self._existing_dates.get(metric)
+        if (entry is not None and
+            datetime.now() - entry[1] < EXISTING_DATES_REFRESH_RATE):
+            return entry[0]
+
+        return self._loads.Do(('existing dates', metric),
+                              self._FetchExistingDates, metric)
 
     def ForceRefresh(self):
         """Forces a refresh of the internal metrics data.
+
+        Unlike periodic refreshes, this refresh is done synchronously.
+
+        Raises:
+            RefreshError: An error occurred while refreshing the metric cache.
         """
-        self._last_refresh = datetime.fromtimestamp(0)
-        self._Refresh()
+        self._RefreshNow()
+
+    def LoadSnapshot(self, snapshot):
+        """Loads metric definitions and data from a snapshot, in place of a
+        refresh.
+
+        Definitions are refreshed from the backend as usual once they're older
+        than 'METRICS_REFRESH_RATE', measured from when the snapshot was
+        created.  Data that old is still served, rather than loaded again on
+        request, until that refresh reloads it.  Locale data should be loaded
+        from the snapshot first, so that ordinals are assigned in the same
+        order as the snapshot's data and it can be cached without remapping.
+
+        Args:
+            snapshot (Snapshot object): Snapshot of metric data.
+        """
+        self._SetMetrics(snapshot.metric_infos, snapshot.created)
+
+        for (metric, date, scope, names, values) in snapshot.MonthData():
+            if metric not in self._metrics:
+                continue
+
+            ordinals = [self.locale_index.Assign(name) for name in names]
+            if ordinals != range(len(ordinals)):
+                # Remap the values to this index's ordinals.
+                remapped = array.array('d', [_NO_DATA]) * (
+                    self.locale_index.Size(scope))
+                for (ordinal, value) in zip(ordinals, values):
+                    remapped[ordinal] = value
+                values = remapped
+
+            self._cache.Set((metric, date) + scope,
+                            _MonthData(values, load_time=snapshot.created,
+                                       from_snapshot=True),
+                            lru_cache.EstimateSize(values))
+            self._snapshot_keys.add((metric, date) + scope)
 
     def _Refresh(self):
         """Refreshes MetricsManager data at most every 'METRICS_REFRESH_RATE'.
+
+        Raises:
+            RefreshError: An error occurred during the first refresh, so there
+                is no metric data to serve.
         """
         if datetime.now() - self._last_refresh < METRICS_REFRESH_RATE:
             return
 
+        if self._last_refresh == datetime.fromtimestamp(0):
+            self._RefreshNow()  # First refresh.  Nothing to serve until done.
+        else:
+            self._refresher.Start()
+
+    def _RefreshNow(self):
+        """Refreshes MetricsManager data, swapping in a new snapshot of the
+        metric definitions when complete, then reloading stale snapshot data.
+
+        Raises:
+            RefreshError: An error occurred while refreshing the metric cache.
+                The current snapshot is left unchanged.
+        """
         try:
             metric_infos = self._backend.GetMetricInfo()
         except backend_interface.LoadError as e:
             raise RefreshError(e)
 
+        self._SetMetrics(metric_infos, datetime.now())
+        self._ReloadSnapshotData()
+
+    def _ReloadSnapshotData(self):
+        """Reloads cached snapshot data older than 'METRICS_REFRESH_RATE'.
+
+        Data that fails to reload is still served, and retried on the next
+        refresh.
+        """
+        for key in sorted(self._snapshot_keys):
+            metric, date, scope = key[0], key[1], key[2:]
+            month_data = self._cache.Peek(key)
+            if (month_data is None or not month_data.from_snapshot or
+                metric not in self._metrics):
+                self._snapshot_keys.discard(key)  # Evicted or replaced.
+                continue
+            if datetime.now() - month_data.load_time < METRICS_REFRESH_RATE:
+                continue
+
+            try:
+                self._metrics[metric].Reload(self._backend, date, scope)
+            except RefreshError as e:
+                logging.error('Failed to reload snapshot data of %s for %s:'
+                              ' %s' % (metric, date, e))
+                continue
+            self._snapshot_keys.discard(key)
+
+    def _SetMetrics(self, metric_infos, load_time):
+        """Builds a new snapshot of the metric definitions and swaps it in.
+
+        Args:
+            metric_infos (dict): Metric definitions, as returned by
+                Backend.GetMetricInfo().
+            load_time (datetime): When the definitions were loaded.
+        """
+        metrics = dict(self._metrics)
         available_metrics = set(metric_infos.keys())
-        known_metrics = set(self._metrics.keys())
+        known_metrics = set(metrics.keys())
         old_metrics_for_deletion = known_metrics - available_metrics
         new_metrics_to_be_loaded = available_metrics - known_metrics
+
+        # Edited metrics are replaced, dropping data cached under the old
+        # definition.
+        for metric in known_metrics & available_metrics:
+            info = metric_infos[metric]
+            if ((metrics[metric].units, metrics[metric].short_desc,
+                 metrics[metric].long_desc, metrics[metric].query) !=
+                (info['units'], info['short_desc'], info['long_desc'],
+                 info['query'])):
+                old_metrics_for_deletion.add(metric)
+                new_metrics_to_be_loaded.add(metric)
         logging.info('Old metrics for deletion: %s'
                      % ' '.join(old_metrics_for_deletion))
         logging.info('New metrics to be loaded: %s'
                      % ' '.join(new_metrics_to_be_loaded))
  
         # Update data members.
-        if available_metrics != known_metrics:
+        if old_metrics_for_deletion or new_metrics_to_be_loaded:
             for old_metric in old_metrics_for_deletion:
-                del self._metrics[old_metric]
+                del metrics[old_metric]
+                self._UncacheMetric(old_metric)
             for new_metric in new_metrics_to_be_loaded:
-                self._metrics[new_metric] = Metric(
+                metrics[new_metric] = Metric(
                     new_metric,
                     metric_infos[new_metric]['units'],
                     metric_infos[new_metric]['short_desc'],
                     metric_infos[new_metric]['long_desc'],
-                    metric_infos[new_metric]['query'])
+                    metric_infos[new_metric]['query'],
+                    cache=self._cache,
+                    locale_index=self.locale_index,
+                    loads=self._loads)
         
-        self._last_refresh = datetime.now()
+        self._metrics = metrics
+        self._last_refresh = load_time
+
+    def _DateExists(self, metric, date):
+        """Whether or not the backend has data for a metric for a given month.
+
+        Args:
+            metric (string): Metric name.
+            date (tuple): Month of interest, as ints (year, month).
+
+        Raises:
+            RefreshError: An error occurred while loading the existing months.
+
+        Returns:
+            (bool) True if the month has data, or if the backend can't tell.
+        """
+        existing_dates = self.ExistingDates(metric)
+        return existing_dates is None or date in existing_dates
+
+    def _RecentlyMissed(self, metric, date, locale):
+        """Whether or not a lookup recently found no data.
+
+        Args:
+            metric (string): Metric name.
+            date (tuple): Month of interest, as ints (year, month).
+            locale (string): Locale of interest.
+
+        Returns:
+            (bool) True if the lookup found no data within the last
+            'METRICS_REFRESH_RATE', otherwise False.
+        """
+        missed = self._misses.Get((metric, date, locale))
+        return (missed is not None and
+                datetime.now() - missed < METRICS_REFRESH_RATE)
+
+    def _FetchExistingDates(self, metric):
+        """Loads the months for which the backend has data for a metric.
+
+        Returns:
+            (frozenset) As returned by ExistingDates().
+        """
+        try:
+            dates = self._backend.ExistingDates(metric_name=metric)
+        except backend_interface.LoadError as e:
+            raise RefreshError(e)
+
+        if dates is not None:
+            dates = frozenset(ParseDate(d) for d in dates)
+        self._existing_dates[metric] = (dates, datetime.now())
+        return dates
+
+    def _UncacheMetric(self, metric):
+        """Removes all cached data for the given metric.
+        """
+        self._cache.DeleteIf(lambda key: key[0] == metric)
+        self._misses.DeleteIf(lambda key: key[0] == metric)
+        self._existing_dates.pop(metric, None)
 
 
 def DetermineLocaleType(locale_str):
     """Determines the locale 'type' for a given locale name.
 
+    Raises:
+        KeyError: The locale name is malformed.
+
     Returns:
         (string) Always one of the following strings,
         'world' If the locale name refers to the world.
@@ -324,8 +1345,137 @@ def DetermineLocaleType(locale_str):
     """
     if locale_str == 'world':
         return 'world'
+    if not isinstance(locale_str, basestring) or not LOCALE_NAME_RE.match(
+            locale_str):
+        raise KeyError('Malformed locale: %r' % (locale_str,))
 
     depth_map = {1: 'country', 2: 'region', 3: 'city'}
     depth = len(locale_str.split('_'))
 
     return depth_map[depth]
+
+
+def MonthRange(start, end):
+    """Generates every month from 'start' to 'end', inclusive.
+
+    Args:
+        start (tuple): First month, as ints (year, month).
+        end (tuple): Last month, as ints (year, month).
+
+    Yields:
+        (tuple) Each month as ints (year, month), in order.
+    """
+    year, month = start
+    while (year, month) <= tuple(end):
+        yield (year, month)
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def _SplitDates(dates, parts):
+    """Splits months into ranges, to be loaded separately.
+
+    Each run of consecutive months is split into ranges of at most
+    len(dates) / 'parts' months, rounded up.
+
+    Args:
+        dates (list): Months, as tuples of ints (year, month), in order.
+        parts (int): Desired number of ranges.
+
+    Returns:
+        (list) Ranges as tuples (first month, last month), in order.
+    """
+    max_months = max(1, -(-len(dates) // parts))
+    ranges = []
+    months = 0  # Number of months in the last range.
+    for date in dates:
+        if ranges and months < max_months:
+            first, last = ranges[-1]
+            if (date[0] * 12 + date[1]) - (last[0] * 12 + last[1]) == 1:
+                ranges[-1] = (first, date)
+                months += 1
+                continue
+        ranges.append((date, date))
+        months = 1
+    return ranges
+
+
+def ParseDate(date):
+    """Converts a backend date, eg a datetime.date, '2012-01', or '2012_01',
+    to a tuple.
+
+    Returns:
+        (tuple) The date's month as ints (year, month).
+    """
+    if hasattr(date, 'year'):
+        return (date.year, date.month)
+    year, month = str(date).replace('_', '-').split('-')[:2]
+    return (int(year), int(month))
+
+
+def DetermineLocaleScope(locale_str):
+    """Determines the scope of locales loaded together with a given locale.
+
+    Metric data is loaded from the backend in scopes rather than for the whole
+    month at once.  Worlds, countries, and regions are each loaded for all
+    locales of the same type.  Cities are loaded for all cities of the same
+    country, since there are far too many to load at once.
+
+    Returns:
+        (tuple) Two items (locale_type, locale_prefix), where 'locale_type' is
+        as returned by DetermineLocaleType() and 'locale_prefix' is either None
+        or a prefix all locale names in the scope share, eg '840_'.
+
+    Raises:
+        KeyError: The locale name is malformed.
+    """
+    locale_type = DetermineLocaleType(locale_str)
+    if locale_type == 'city':
+        return (locale_type, '%s_' % locale_str.split('_')[0])
+    return (locale_type, None)
+
+
+def RankingScope(locale_type, parent=None):
+    """Determines which locales are ranked together.
+
+    Locales of a type are ranked within a parent locale of a higher type, or
+    across the world.  Cities must be ranked within a country or region, since
+    they're loaded one country at a time.
+
+    Args:
+        locale_type (string): Type of locales to rank, 'world', 'country',
+            'region', or 'city'.
+        parent (string): If provided, only locales within this locale are
+            ranked, eg '840' to rank the regions of a country.
+
+    Raises:
+        KeyError: The locale type or parent is malformed, or the parent isn't
+        of a higher type than the ranked locales.
+
+    Returns:
+        (tuple) Two items (scope, prefix), where 'scope' is the locale scope
+        holding the ranked locales, as returned by DetermineLocaleScope(), and
+        'prefix' is either None or a prefix all names of the ranked locales
+        share, eg '840_'.
+    """
+    types = ('world', 'country', 'region', 'city')
+    if locale_type not in types:
+        raise KeyError('Unknown locale type: %s' % locale_type)
+
+    parent_type = 'world' if parent in (None, 'world') else (
+        DetermineLocaleType(parent))
+    if (parent_type != 'world' and
+        types.index(parent_type) >= types.index(locale_type)):
+        raise KeyError('Cannot rank %s locales within %s.'
+                       % (locale_type, parent))
+    if locale_type == 'city' and parent_type == 'world':
+        raise KeyError('Cities can only be ranked within a country or region.')
+
+    if locale_type == 'city':
+        scope = (locale_type, '%s_' % parent.split('_')[0])
+    else:
+        scope = (locale_type, None)
+
+    prefix = None if parent_type == 'world' else '%s_' % parent
+    if prefix == scope[1]:  # Every locale of the scope is ranked.
+        prefix = None
+    return (scope, prefix)
@@ -0,0 +1,75 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Author: Dylan Curley
+
+"""This module runs independent calls concurrently, with bounded parallelism.
+
+Backend loads spend nearly all their time waiting on the datastore, so issuing
+several at once from threads cuts total latency roughly by the number of
+threads.  The number of threads is bounded so that a single request can't
+overload the datastore.
+"""
+
+import sys
+import threading
+
+
+def Map(fn, items, max_threads):
+    """Calls fn(item) for each item, using up to 'max_threads' threads.
+
+    Results are returned in the same order as 'items'.  If any call raises an
+    exception, the exception from the earliest such item is re-raised once all
+    calls have completed, just as if the calls had been made in order.
+
+    Args:
+        fn (function): Called with each item.
+        items (list): Items to be passed to 'fn'.
+        max_threads (int): Maximum number of concurrent calls.
+
+    Returns:
+        (list) The value returned by 'fn' for each item, in order.
+    """
+    items = list(items)
+    if max_threads <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    next_item = [0]
+    lock = threading.Lock()
+
+    def Worker():
+        while True:
+            with lock:
+                i = next_item[0]
+                if i >= len(items):
+                    return
+                next_item[0] += 1
+            try:
+                results[i] = fn(items[i])
+            except Exception:
+                errors[i] = sys.exc_info()
+
+    threads = [threading.Thread(target=Worker)
+               for _ in xrange(min(max_threads, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+    return results
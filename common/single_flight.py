@@ -0,0 +1,84 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Author: Dylan Curley
+
+"""This module coalesces concurrent, duplicate calls into a single call.
+
+When several threads miss the cache for the same data at once, only the first
+should load it from the backend.  The others wait for that load to complete and
+share its result (or its error).
+"""
+
+import threading
+
+
+class _Call(object):
+    """A call in flight, and its eventual result or error.
+    """
+    def __init__(self):
+        """Constructor.
+        """
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls made with the same key.
+    """
+    def __init__(self):
+        """Constructor.
+        """
+        self._lock = threading.Lock()
+        self._calls = {}  # Key -> _Call in flight.
+
+    def Do(self, key, fn, *args):
+        """Calls fn(*args), unless a call for 'key' is already in flight.
+
+        If a call with the same key is already in flight, waits for it to
+        complete instead and returns its result, or raises its error.
+
+        Args:
+            key (hashable): Identifies the data being loaded.
+            fn (function): Loads the data.
+            args (list): Arguments passed to 'fn'.
+
+        Returns:
+            (object) The value returned by 'fn'.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
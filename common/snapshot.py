@@ -0,0 +1,409 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Author: Dylan Curley
+
+"""This module reads and writes snapshots of metric and locale data.
+
+A snapshot holds the metric definitions, the locale table, the LocaleFinder's
+search trees, and recent months of metric data, so that a new API Server
+instance can serve from it as soon as it starts instead of waiting on the
+backend.  Snapshots are created offline, eg with:
+
+    cd api_server && python -m common.snapshot snapshot.bin
+
+and deployed alongside the API Server.
+
+The file is read whole with a plain read, and each month's values are copied
+out of it into an array for the metric cache.  The layout is columnar, so that
+those copies come straight from the file's bytes:
+
+    header:  8 byte magic, uint32 format version, uint32 index length
+    index:   JSON describing the snapshot, padded to a multiple of 8 bytes
+    data:    little-endian float64 metric values, then the search trees
+
+The index lists each locale scope once, with the names of its locales in
+order, and each block of data as (metric, year, month, scope, offset).  A
+block holds one value per locale in its scope, in the same order, with NaN for
+locales that have no data.
+
+The index also lists the locale names of each search tree, and where each of
+the tree's arrays (see kd_tree.KDTree) is, as (typecode, offset, length).
+Tree offsets are in bytes from the start of the data, and each array is
+little-endian and padded to a multiple of 8 bytes.  Version 1 snapshots have
+no trees, so their trees are built from the locale table instead.
+"""
+
+import array
+from datetime import datetime
+import json
+import logging
+import os
+import struct
+import sys
+import time
+
+import locales
+import metrics
+
+MAGIC = 'MLABSNAP'
+FORMAT_VERSION = 2
+_READABLE_VERSIONS = (1, 2)
+_HEADER = struct.Struct('<8sII')
+
+# What a snapshot holds by default.  Cities are left out, since there are far
+# too many of them and they're rarely queried in bulk.
+SNAPSHOT_MONTHS = 12
+SNAPSHOT_LOCALE_TYPES = ('world', 'country', 'region')
+
+# Placeholder for locales without data.
+_NO_DATA = float('nan')
+
+# Typecode of each search tree array, as stored.  Labels are locale indexes.
+_TREE_TYPECODES = {'coords': 'd', 'labels': 'i', 'axes': 'b', 'splits': 'd',
+                   'left': 'i', 'right': 'i'}
+
+
+class Error(Exception):
+    """Common exception that all other exceptions in this module inherit from.
+    """
+    pass
+
+class FormatError(Error):
+    """The snapshot file is malformed or has an unsupported format version.
+    """
+    pass
+
+
+class Snapshot(object):
+    """A snapshot of metric and locale data, as read from a snapshot file.
+
+    Members:
+        created (datetime): When the snapshot's data was loaded.
+        metric_infos (dict): Metric definitions, as returned by
+            Backend.GetMetricInfo().
+        locale_rows (dict): Locale table rows, as returned in the 'data' of
+            Backend.GetLocaleData(), keyed by locale type.
+        trees (dict): LocaleFinder search trees, as returned by
+            LocaleFinder.TreeData(), or None if the snapshot has none.
+    """
+    def __init__(self, created, metric_infos, locale_rows, scopes, blocks,
+                 data, data_offset, trees=None):
+        """Constructor.
+
+        Args:
+            created (datetime): When the snapshot's data was loaded.
+            metric_infos (dict): Metric definitions.
+            locale_rows (dict): Locale table rows, keyed by locale type.
+            scopes (list): Locale scopes, each a list [locale_type,
+                locale_prefix, locale names].
+            blocks (list): Blocks of metric data, each a list [metric, year,
+                month, scope number, offset in values].
+            data (string): Contents of the snapshot file.
+            data_offset (int): Offset of the metric data in 'data', in bytes.
+            trees (dict): LocaleFinder search trees, keyed by locale type.
+        """
+        self.created = created
+        self.metric_infos = metric_infos
+        self.locale_rows = locale_rows
+        self.trees = trees
+        self._scopes = scopes
+        self._blocks = blocks
+        self._data = data
+        self._data_offset = data_offset
+
+    def MonthData(self):
+        """Generates the snapshot's metric data, one month at a time.
+
+        Yields:
+            (tuple) Five items (metric, date, scope, names, values), where
+            'metric' is the metric name, 'date' is a tuple of ints (year,
+            month), 'scope' is the locale scope as returned by
+            metrics.DetermineLocaleScope(), 'names' lists the locales in the
+            scope, and 'values' is an array of doubles holding the metric
+            value for each of those locales, with NaN for no data.
+        """
+        item_size = array.array('d').itemsize
+        for (metric, year, month, scope_number, offset) in self._blocks:
+            locale_type, locale_prefix, names = self._scopes[scope_number]
+            start = self._data_offset + offset * item_size
+            values = array.array('d')
+            values.fromstring(buffer(self._data, start,
+                                     len(names) * item_size))
+            if sys.byteorder != 'little':
+                values.byteswap()
+            yield (metric, (year, month), (locale_type, locale_prefix), names,
+                   values)
+
+
+def Read(path):
+    """Reads a snapshot file.
+
+    Args:
+        path (string): Snapshot file.
+
+    Raises:
+        FormatError: The file isn't a snapshot, or has an unsupported format
+            version.
+        IOError: The file can't be read.
+
+    Returns:
+        (Snapshot) The snapshot.
+    """
+    with open(path, 'rb') as fd:
+        data = fd.read()
+
+    if len(data) < _HEADER.size:
+        raise FormatError('Truncated snapshot: %s' % path)
+    magic, version, index_size = _HEADER.unpack(data[:_HEADER.size])
+    if magic != MAGIC:
+        raise FormatError('Not a snapshot: %s' % path)
+    if version not in _READABLE_VERSIONS:
+        raise FormatError('Unsupported snapshot version %d (expected %d): %s'
+                          % (version, FORMAT_VERSION, path))
+
+    try:
+        index = json.loads(data[_HEADER.size:_HEADER.size + index_size])
+    except ValueError as e:
+        raise FormatError('Malformed snapshot index in %s: %s' % (path, e))
+
+    # Locale names are plain strings everywhere else.
+    scopes = [[str(locale_type),
+               None if locale_prefix is None else str(locale_prefix),
+               [str(name) for name in names]]
+              for (locale_type, locale_prefix, names) in index['scopes']]
+    blocks = [[str(metric), year, month, scope_number, offset]
+              for (metric, year, month, scope_number, offset)
+              in index['blocks']]
+    locale_rows = dict(
+        (str(locale_type), [[row[0], str(row[1])] + row[2:] for row in rows])
+        for (locale_type, rows) in index['locales'].iteritems())
+    metric_infos = dict((str(name), info)
+                        for (name, info) in index['metrics'].iteritems())
+
+    data_offset = _HEADER.size + _Padded(index_size)
+    trees = None
+    if 'trees' in index:
+        trees = dict((str(locale_type),
+                      _ReadTree(path, data, data_offset, tree))
+                     for (locale_type, tree) in index['trees'].iteritems())
+
+    return Snapshot(datetime.fromtimestamp(index['created']), metric_infos,
+                    locale_rows, scopes, blocks, data, data_offset, trees)
+
+
+def _ReadTree(path, data, data_offset, tree):
+    """Reads one search tree from a snapshot file.
+
+    Args:
+        path (string): Snapshot file, for error messages.
+        data (string): Contents of the snapshot file.
+        data_offset (int): Offset of the data in 'data', in bytes.
+        tree (dict): The tree's entry in the snapshot index.
+
+    Raises:
+        FormatError: The tree's arrays are malformed.
+
+    Returns:
+        (dict) The tree, as returned by GeoTree.TreeData().
+    """
+    arrays = {}
+    for (name, typecode) in _TREE_TYPECODES.iteritems():
+        try:
+            stored_typecode, offset, length = tree['arrays'][name]
+        except (KeyError, TypeError, ValueError):
+            raise FormatError('Malformed search tree in %s.' % path)
+        values = array.array(typecode)
+        start = data_offset + offset
+        end = start + length * values.itemsize
+        if stored_typecode != typecode or end > len(data):
+            raise FormatError('Malformed search tree in %s.' % path)
+        values.fromstring(buffer(data, start, end - start))
+        if sys.byteorder != 'little':
+            values.byteswap()
+        arrays[name] = values
+
+    return {'names': [str(name) for name in tree['names']],
+            'arrays': arrays}
+
+
+def Write(path, created, metric_infos, locale_rows, month_datas, trees=None):
+    """Writes a snapshot file.
+
+    The file is written under a temporary name and then renamed, so readers
+    never see a partially written snapshot.
+
+    Args:
+        path (string): Snapshot file.
+        created (datetime): When the snapshot's data was loaded.
+        metric_infos (dict): Metric definitions, as returned by
+            Backend.GetMetricInfo().
+        locale_rows (dict): Locale table rows, as returned in the 'data' of
+            Backend.GetLocaleData(), keyed by locale type.
+        month_datas (list): Metric data, each item a tuple (metric, date,
+            scope, values), where 'date' is a tuple of ints (year, month),
+            'scope' is as returned by metrics.DetermineLocaleScope(), and
+            'values' is a dict of (float) metric values keyed by locale.
+        trees (dict): LocaleFinder search trees, as returned by
+            LocaleFinder.TreeData(), or None to leave them out.
+    """
+    # Order each scope's locales as in the locale table, so that a reader
+    # assigning ordinals in that order can use the data without remapping.
+    locale_order = {}
+    for locale_type in ('country', 'region', 'city'):
+        for row in locale_rows.get(locale_type, []):
+            locale_order.setdefault(row[1], len(locale_order))
+
+    scope_names = {}
+    for (_, _, scope, values) in month_datas:
+        scope_names.setdefault(tuple(scope), set()).update(values)
+    scopes = sorted(scope_names)
+    scope_numbers = dict((scope, n) for (n, scope) in enumerate(scopes))
+    for scope in scopes:
+        scope_names[scope] = sorted(
+            scope_names[scope],
+            key=lambda name: (locale_order.get(name, len(locale_order)), name))
+
+    data = array.array('d')
+    blocks = []
+    for (metric, date, scope, values) in sorted(
+            month_datas, key=lambda month_data: month_data[1]):
+        scope = tuple(scope)
+        blocks.append([metric, date[0], date[1], scope_numbers[scope],
+                       len(data)])
+        data.extend(values.get(name, _NO_DATA) for name in scope_names[scope])
+    if sys.byteorder != 'little':
+        data.byteswap()
+    chunks = [data.tostring()]
+    offset = len(chunks[0])
+
+    # The search trees follow the metric data, one padded array at a time.
+    tree_index = {}
+    for (locale_type, tree) in sorted((trees or {}).iteritems()):
+        tree_arrays = {}
+        for (name, typecode) in sorted(_TREE_TYPECODES.iteritems()):
+            values = array.array(typecode, tree['arrays'][name])
+            if sys.byteorder != 'little':
+                values.byteswap()
+            chunk = values.tostring()
+            chunks.append(chunk + '\0' * (_Padded(len(chunk)) - len(chunk)))
+            tree_arrays[name] = [typecode, offset, len(values)]
+            offset += _Padded(len(chunk))
+        tree_index[locale_type] = {'names': tree['names'],
+                                   'arrays': tree_arrays}
+
+    index = json.dumps({
+        'created': time.mktime(created.timetuple()),
+        'metrics': metric_infos,
+        'locales': locale_rows,
+        'scopes': [list(scope) + [scope_names[scope]] for scope in scopes],
+        'blocks': blocks,
+        'trees': tree_index})
+
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'wb') as fd:
+        fd.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(index)))
+        fd.write(index)
+        fd.write('\0' * (_Padded(len(index)) - len(index)))
+        for chunk in chunks:
+            fd.write(chunk)
+    os.rename(tmp_path, path)
+
+
+def Create(backend, path, months=SNAPSHOT_MONTHS,
+           locale_types=SNAPSHOT_LOCALE_TYPES):
+    """Creates a snapshot file from the data in a backend.
+
+    Args:
+        backend (Backend object): Datastore backend.
+        path (string): Snapshot file.
+        months (int): Number of most recent months of metric data to include.
+        locale_types (list): Locale types whose metric data is included.
+
+    Raises:
+        backend.LoadError: An error occurred loading data from the backend.
+    """
+    created = datetime.now()
+    metric_infos = backend.GetMetricInfo()
+    locale_rows = dict(
+        (locale_type, [list(row) for row in
+                       backend.GetLocaleData(locale_type)['data']])
+        for locale_type in ('country', 'region', 'city'))
+
+    lm = locales.LocalesManager(backend)
+    lm.LoadRows(locale_rows, created)
+    lm.disable_refresh = True
+    finder = locales.LocaleFinder(backend)
+    finder.BuildTrees(lm)
+
+    month_datas = []
+    for metric in sorted(metric_infos):
+        dates = sorted(set(metrics.ParseDate(d) for d in
+                           backend.ExistingDates(metric_name=metric) or ()))
+        dates = dates[-months:]
+        if not dates:
+            logging.warning('No data for metric %s.' % metric)
+            continue
+
+        for locale_type in locale_types:
+            # Cities are split into scopes by country.
+            values_by_scope = {}
+            info = backend.GetMetricDataRange(metric, dates[0], dates[-1],
+                                              locale_type)
+            for (row_date, locale, value) in info['data']:
+                date = metrics.ParseDate(row_date)
+                scope = metrics.DetermineLocaleScope(locale)
+                values_by_scope.setdefault((date,) + scope, {})[locale] = (
+                    float(value))
+            for (scope_key, values) in values_by_scope.iteritems():
+                month_datas.append(
+                    (metric, scope_key[0], scope_key[1:], values))
+
+    Write(path, created, metric_infos, locale_rows, month_datas,
+          finder.TreeData())
+    logging.info('Wrote snapshot of %d metrics, %d months to %s in %s.'
+                 % (len(metric_infos), months, path, datetime.now() - created))
+
+
+def _Padded(size):
+    """Rounds 'size' up to a multiple of 8, so that values are aligned.
+    """
+    return (size + 7) // 8 * 8
+
+
+def main(argv):
+    """Creates a snapshot file from the CloudSQL backend.
+
+    Args:
+        argv (list): Command line arguments: the snapshot file to write, and
+            optionally the number of months of metric data to include.
+    """
+    import cloud_sql_backend
+    import cloud_sql_client
+
+    if len(argv) not in (2, 3):
+        print 'Usage: %s <snapshot file> [months]' % argv[0]
+        return 1
+
+    logging.getLogger().setLevel(logging.INFO)
+    client = cloud_sql_client.CloudSQLClient(
+        cloud_sql_backend.INSTANCE, cloud_sql_backend.DATABASE)
+    backend = cloud_sql_backend.CloudSQLBackend(client)
+    months = int(argv[2]) if len(argv) == 3 else SNAPSHOT_MONTHS
+    Create(backend, argv[1], months=months)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -27,6 +27,7 @@ from google.appengine.ext.webapp import template
 from google.appengine.ext.webapp.util import run_wsgi_app
 from oauth2client.appengine import OAuth2DecoratorFromClientSecrets
 
+from common import background_refresh
 from common import backend as backend_interface
 from common import metrics
 
@@ -64,7 +65,7 @@ def start(backend):
          ('/new',     NewMetricPageHandler),
          ('/contact', ContactUsPageHandler)],
         debug=True)
-    run_wsgi_app(application)
+    run_wsgi_app(background_refresh.Middleware(application))
 
 
 class Error(Exception):